@@ -3,32 +3,74 @@
 import os
 import csv
 import io
-import shutil
 import zipfile
 import secrets
 import random
+import re
 import string
 import logging
+import json
+import mimetypes
+import multiprocessing
+import base64
+import hashlib
+import shutil
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from functools import wraps
 
 # Flask y extensiones
-from flask import Flask, request, session, redirect, url_for, send_from_directory, jsonify
+from flask import Flask, request, session, redirect, url_for, send_from_directory, jsonify, g, Response, stream_with_context, render_template
+from markupsafe import Markup, escape
+from urllib.parse import urlencode
+import click
 from flask_wtf.csrf import CSRFProtect
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Procesamiento de datos
 import sqlite3
+import queue
+import heapq
+import itertools
+import numpy as np
 import pandas as pd
+from openpyxl import load_workbook
 
 # Validación de imágenes (Pillow)
 try:
-    from PIL import Image
+    from PIL import Image, ImageOps, features
     PIL_AVAILABLE = True
 except ImportError:
     PIL_AVAILABLE = False
 
+# Backend Redis opcional para OTP (OTP_BACKEND=redis)
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# Bloqueo entre procesos del almacén de respaldos (en Windows solo entre hilos)
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+# Compresión brotli opcional (si no está instalada se usa solo gzip)
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
 # =============================================================================
 # CONFIGURACIÓN DE LA APLICACIÓN
 # =============================================================================
@@ -48,19 +90,43 @@ app.config['SESSION_COOKIE_SECURE'] = os.environ.get('FLASK_ENV') == 'production
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB máximo para uploads
 
+# Proxies de confianza delante de la app (el router de la plataforma = 1). Con
+# ProxyFix, request.remote_addr es la IP real del cliente tomada de
+# X-Forwarded-For, y los límites por IP no cuentan a todos como el router.
+# 0 si la app recibe las conexiones directamente (las cabeceras se ignoran).
+PROXY_SALTOS = int(os.environ.get('PROXY_SALTOS', 1))
+if PROXY_SALTOS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_SALTOS, x_proto=PROXY_SALTOS)
+
 # Protección CSRF
 csrf = CSRFProtect(app)
 
 # Configuración de uploads
 UPLOAD_FOLDER = 'uploads'
 BACKUP_FOLDER = 'backups'
+CARPETA_MINIATURAS = os.path.join(UPLOAD_FOLDER, 'miniaturas')  # <tamaño>/<foto>.webp|.jpg
+CARPETA_PENDIENTES = os.path.join(UPLOAD_FOLDER, 'pendientes')  # subidas aún sin procesar
+ALMACEN_BACKUP = os.path.join(BACKUP_FOLDER, 'almacen')  # blobs/ por hash + manifiestos/ por snapshot
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(BACKUP_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Caché HTTP de archivos servidos (ver servir_archivo)
+CACHE_INMUTABLE_SEG = 365 * 24 * 3600  # Fotos y miniaturas: el nombre cambia si cambia la foto
+CACHE_CORTO_SEG = 60                   # Respuestas provisionales (original en lugar de miniatura)
+CACHE_LOGO_SEG = 24 * 3600
+SERVIDOR_ARCHIVOS = os.environ.get('SERVIDOR_ARCHIVOS', '').lower()  # '', 'x-sendfile' o 'x-accel'
+X_ACCEL_PREFIJO = os.environ.get('X_ACCEL_PREFIJO', '/interno/')
+app.config['USE_X_SENDFILE'] = SERVIDOR_ARCHIVOS == 'x-sendfile'
+
 # Base de datos
 DB = 'gallos.db'
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))        # Conexiones reutilizables por worker
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+DB_CACHE_KB = int(os.environ.get('DB_CACHE_KB', 16384))      # Caché de páginas por conexión
+DB_MMAP_BYTES = int(os.environ.get('DB_MMAP_BYTES', 128 * 1024 * 1024))
+DB_STATEMENT_CACHE = 256                                     # Sentencias preparadas por conexión
 
 # Datos de dominio
 RAZAS = [
@@ -69,9 +135,56 @@ RAZAS = [
 ]
 APARIENCIAS = ['Crestarosa', 'Cocolo', 'Tuceperne', 'Pava', 'Moton']
 TABLAS_PERMITIDAS = {'individuos', 'cruces'}
+LOTE_SQL = 500  # Máximo de parámetros por cláusula IN (límite de SQLite: 999)
+ARBOL_GEN_DEFECTO = 3  # Generaciones mostradas en /arbol (incluye al gallo: principal, padres, abuelos)
+ARBOL_GEN_MAX = 8      # Límite superior de ?gen= (2^7 ancestros en la última fila)
+PLANIFICADOR_LIMITE = 100  # Candidatas mostradas por defecto en /planificador
+COI_ANCESTROS_MAX = int(os.environ.get('COI_ANCESTROS_MAX', 3000))  # Ancestros por cálculo de COI (generaciones más cercanas)
+COI_TABULAR_MIN = 16       # F pendientes a partir de las cuales se calculan en bloque (matriz A float32, 36 MB con 3000)
+BUSQUEDA_LIMITE = 200      # Resultados máximos de /buscar
+CAMPOS_FTS = ('placa_traba', 'placa_regional', 'nombre', 'color', 'raza', 'codigo')
+PESOS_FTS = (0.0, 10.0, 5.0, 3.0, 1.0, 1.0, 8.0)  # bm25: traba, placa, regional, nombre, color, raza, código
+LISTA_POR_PAGINA = 50          # Filas por página en /lista
+LISTA_POR_PAGINA_MAX = 200
+API_POR_PAGINA = 100            # Filas por página en /api/v1 (?n=)
+API_POR_PAGINA_MAX = 500
+API_LOTE_MAX = 1000            # Elementos por petición de alta/edición masiva en /api/v1
+SYNC_POR_PAGINA = 500          # Cambios por respuesta de GET /api/sync (?n=)
+SYNC_POR_PAGINA_MAX = 2000
+LOTE_STREAM = 50               # Filas leídas del cursor y enviadas por fragmento en páginas streaming
+COMPRESION_MIN_BYTES = 500     # Respuestas más pequeñas se envían sin comprimir
+COMPRESION_NIVEL_GZIP = 6
+COMPRESION_CALIDAD_BR = 5      # brotli 0-11: 5 comprime mejor que gzip 6 a coste similar
+COMPRESION_TIPOS = {'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript',
+                    'application/javascript', 'application/json', 'image/svg+xml'}
+LOTE_EXPORTACION = 1000        # Filas por fetchmany al exportar CSV
+BACKUP_PAGINAS = 256            # Páginas SQLite copiadas por paso del backup en caliente
+BACKUP_BLOQUE = 1024 * 1024    # Bytes por escritura al volcar el snapshot en el ZIP
+BACKUP_HILOS = int(os.environ.get('BACKUP_HILOS', 2))  # Respaldos simultáneos por worker
+BACKUP_REPORTE_SEG = 1.0       # Cada cuánto se guarda el progreso de un respaldo
+BACKUP_CADUCA_SEG = 300        # Un respaldo sin progreso en este tiempo se da por perdido
+BACKUP_DIARIOS = int(os.environ.get('BACKUP_DIARIOS', 7))      # Últimos días con snapshot conservado
+BACKUP_SEMANALES = int(os.environ.get('BACKUP_SEMANALES', 4))  # Últimas semanas con snapshot conservado
+LOTE_IMPORTACION = 1000        # Filas validadas e insertadas por transacción en /importar
+IMPORTAR_ERRORES_MAX = 500     # Errores mostrados en el reporte de /importar
+FACETAS_COLOR_MAX = 30         # Colores distintos ofrecidos como filtro
+AUTOCOMPLETAR_LIMITE = 10      # Sugerencias por defecto (máximo 20)
+AUTOCOMPLETAR_TTL = 30         # Segundos que vive una respuesta en caché
+AUTOCOMPLETAR_CACHE_MAX = 256  # Consultas en caché por traba
+
+# OTP seguro: almacén compartido entre workers (ver crear_almacen_otp)
+OTP_TTL_SEG = 300              # 5 minutos
+OTP_MAX_INTENTOS = 3
+OTP_BACKEND = os.environ.get('OTP_BACKEND', 'sqlite')  # 'sqlite', 'redis' o 'memoria'
 
-# OTP seguro: {correo: {codigo, traba, expira, intentos}}
-OTP_TEMP = {}
+# Inicio de sesión: límites por cubeta de fichas (capacidad, fichas por segundo) y hashing acotado
+LOGIN_FICHAS_IP = (20, 20 / 60)        # Ráfaga de 20, luego 20 por minuto por IP
+LOGIN_FICHAS_CORREO = (5, 5 / 900)     # Ráfaga de 5, luego 5 cada 15 minutos por correo
+REGISTRO_FICHAS_IP = (5, 5 / 3600)     # Registros por IP: 5 por hora
+LIMITES_PURGA_SEG = 3600               # Cubetas sin uso más tiempo que esto ya están llenas
+HASH_HILOS = int(os.environ.get('HASH_HILOS', 2))   # Hashes de contraseña simultáneos por worker
+HASH_ESPERA_SEG = 2                    # Espera máxima por un hueco antes de responder 503
+HASH_METODO = os.environ.get('HASH_METODO', 'scrypt:32768:8:1')  # Cambiarlo rehashea al iniciar sesión
 
 # =============================================================================
 # CONFIGURACIÓN DE LOGGING
@@ -99,39 +212,259 @@ def allowed_file(filename):
 
 
 def is_valid_image(file_stream):
-    """Verifica que el archivo sea realmente una imagen válida (requiere Pillow)"""
+    """Comprobación rápida de cabecera (requiere Pillow).
+
+    Solo lee la cabecera; la verificación completa y la decodificación se
+    hacen en el pool de procesos (ver guardar_subida y encolar_foto).
+    """
     if not PIL_AVAILABLE:
         return True  # Si no hay Pillow, confiar en la extensión
     try:
         file_stream.seek(0)
-        img = Image.open(file_stream)
-        img.verify()
+        Image.open(file_stream)
         file_stream.seek(0)
         return True
     except Exception:
         return False
 
 
-def generar_codigo_unico(cursor):
-    """Genera un código único de 8 caracteres alfanuméricos"""
-    intentos = 0
-    while intentos < 100:
-        codigo = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-        cursor.execute('SELECT 1 FROM individuos WHERE codigo = ?', (codigo,))
-        if not cursor.fetchone():
-            return codigo
-        intentos += 1
-    # Fallback con timestamp si hay colisión extrema
-    return f"UNIQ{datetime.now().timestamp():.0f}"[-8:].upper()
+# Normalización al subir: orientación EXIF aplicada, sin metadatos, lado mayor
+# limitado y recomprimida (JPEG, o PNG si tiene transparencia)
+FOTO_LADO_MAX = int(os.environ.get('FOTO_LADO_MAX', 1600))
+FOTO_CALIDAD = int(os.environ.get('FOTO_CALIDAD', 82))
+IMAGEN_PROCESOS = int(os.environ.get('IMAGEN_PROCESOS', 2))    # Procesos del pool de imágenes por worker
 
 
-def limpiar_otps_expirados():
-    """Elimina OTPs vencidos de la memoria temporal"""
-    ahora = datetime.now()
-    expirados = [c for c, d in OTP_TEMP.items() if d['expira'] < ahora]
-    for correo in expirados:
-        del OTP_TEMP[correo]
-    return len(expirados)
+def extension_foto(file_stream):
+    """'.png' si la imagen tiene transparencia, '.jpg' si no (solo lee la cabecera)"""
+    file_stream.seek(0)
+    with Image.open(file_stream) as img:
+        con_alfa = 'A' in img.getbands() or 'transparency' in img.info
+    file_stream.seek(0)
+    return '.png' if con_alfa else '.jpg'
+
+
+def normalizar_foto(origen, fname):
+    """Escribe uploads/<fname> normalizada a partir del archivo `origen`.
+
+    Se guarda como PNG si `fname` termina en .png y como JPEG si no. En JPEG
+    `draft` decodifica directamente a escala reducida y el resto de pasos
+    trabajan sobre esa única copia.
+    """
+    with Image.open(origen) as img:
+        img.verify()
+    with Image.open(origen) as img:
+        img.draft('RGB', (FOTO_LADO_MAX, FOTO_LADO_MAX))
+        ImageOps.exif_transpose(img, in_place=True)
+        img.thumbnail((FOTO_LADO_MAX, FOTO_LADO_MAX), Image.LANCZOS)
+        png = fname.endswith('.png')
+        salida = img.convert('RGBA' if png else 'RGB')
+    ruta = os.path.join(UPLOAD_FOLDER, fname)
+    # Sin exif= ni icc_profile=: Pillow no copia los metadatos del original
+    if png:
+        salida.save(ruta + '.tmp', 'PNG', optimize=True)
+    else:
+        salida.save(ruta + '.tmp', 'JPEG', quality=FOTO_CALIDAD, optimize=True, progressive=True)
+    os.replace(ruta + '.tmp', ruta)
+
+
+# Miniaturas: lado mayor en px -> uso (64 listas, 160 fichas, 800 vista ampliada)
+TAMAÑOS_MINIATURA = (64, 160, 800)
+CALIDAD_MINIATURA = int(os.environ.get('CALIDAD_MINIATURA', 80))
+EXT_MINIATURA = '.webp' if PIL_AVAILABLE and features.check('webp') else '.jpg'
+
+
+def ruta_miniatura(foto, tamaño):
+    return os.path.join(CARPETA_MINIATURAS, str(tamaño), os.path.splitext(foto)[0] + EXT_MINIATURA)
+
+
+def url_foto(foto, tamaño):
+    """URL de la miniatura de una foto (se sirve el original mientras no exista)"""
+    return f"/uploads/{tamaño}/{foto}"
+
+
+def generar_miniaturas(foto, forzar=False):
+    """Genera las miniaturas de uploads/<foto> de mayor a menor tamaño.
+
+    Cada tamaño se reduce desde el anterior, y en JPEG `draft` decodifica ya
+    a escala reducida, así nunca hay más de una copia grande en memoria.
+    """
+    if not PIL_AVAILABLE:
+        return
+    pendientes = [t for t in sorted(TAMAÑOS_MINIATURA, reverse=True)
+                  if forzar or not os.path.exists(ruta_miniatura(foto, t))]
+    if not pendientes:
+        return
+    with Image.open(os.path.join(UPLOAD_FOLDER, foto)) as original:
+        original.draft('RGB', (pendientes[0], pendientes[0]))
+        img = ImageOps.exif_transpose(original)
+        img = img.convert('RGBA' if EXT_MINIATURA == '.webp' and 'A' in img.getbands() else 'RGB')
+        for tamaño in pendientes:
+            img.thumbnail((tamaño, tamaño), Image.LANCZOS)
+            ruta = ruta_miniatura(foto, tamaño)
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            img.save(ruta + '.tmp', 'WEBP' if EXT_MINIATURA == '.webp' else 'JPEG', quality=CALIDAD_MINIATURA)
+            os.replace(ruta + '.tmp', ruta)
+
+
+def eliminar_miniaturas(foto):
+    for tamaño in TAMAÑOS_MINIATURA:
+        ruta = ruta_miniatura(foto, tamaño)
+        if os.path.exists(ruta):
+            os.remove(ruta)
+
+
+def procesar_foto(fname):
+    """Trabajo del pool: verifica, normaliza y genera miniaturas de una subida pendiente (ya en la BD)"""
+    pendiente = os.path.join(CARPETA_PENDIENTES, fname)
+    try:
+        normalizar_foto(pendiente, fname)
+        generar_miniaturas(fname, forzar=True)
+    finally:
+        if os.path.exists(pendiente):
+            os.remove(pendiente)
+
+
+# Pool de procesos por worker: el trabajo de imagen no ocupa hilos de gunicorn.
+# Se usa 'spawn' para no heredar locks de los hilos del servidor al hacer fork.
+_IMAGEN_EJECUTOR = None
+_IMAGEN_EJECUTOR_PID = None
+
+
+def _ejecutor_imagenes():
+    global _IMAGEN_EJECUTOR, _IMAGEN_EJECUTOR_PID
+    if _IMAGEN_EJECUTOR_PID != os.getpid():
+        _IMAGEN_EJECUTOR = ProcessPoolExecutor(max_workers=IMAGEN_PROCESOS, mp_context=multiprocessing.get_context('spawn'))
+        _IMAGEN_EJECUTOR_PID = os.getpid()
+    return _IMAGEN_EJECUTOR
+
+
+def eliminar_foto(foto):
+    """Borra una foto con sus miniaturas y su subida pendiente, si aún la hay"""
+    for ruta in (os.path.join(UPLOAD_FOLDER, foto), os.path.join(CARPETA_PENDIENTES, foto)):
+        if os.path.exists(ruta):
+            os.remove(ruta)
+    eliminar_miniaturas(foto)
+
+
+def _foto_procesada(fname, futuro):
+    """Al terminar: la foto se reescribe en su fila, o se quita si la imagen no era válida.
+
+    Reescribir `foto` aunque no cambie dispara el trigger de versión, así los
+    clientes de /api/sync saben que ya pueden descargar la imagen final. Si
+    ninguna fila la usa ya (se cambió o se borró el gallo mientras se
+    procesaba), el resultado se borra en vez de quedar huérfano.
+    """
+    global _IMAGEN_EJECUTOR_PID
+    error = futuro.exception()
+    if isinstance(error, BrokenExecutor):
+        # El pool murió, no la imagen: queda en pendientes/ (flask miniaturas la procesa)
+        app.logger.error(f"❌ Pool de imágenes caído procesando {fname}: {error}")
+        _IMAGEN_EJECUTOR_PID = None
+        return
+    if error is None:
+        app.logger.info(f"🖼️ Foto procesada: {fname}")
+        final = fname
+    else:
+        app.logger.warning(f"⚠️ Foto descartada {fname}: {error}")
+        final = None
+    conn = abrir_conexion()
+    try:
+        usos = conn.execute('UPDATE individuos SET foto = ? WHERE foto = ?', (final, fname)).rowcount
+        usos += conn.execute('UPDATE cruces SET foto = ? WHERE foto = ?', (final, fname)).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    if final and not usos:
+        app.logger.info(f"🗑️ Foto procesada sin gallo que la use, se borra: {fname}")
+        eliminar_foto(fname)
+
+
+def guardar_subida(file, fname):
+    """Guarda la subida tal cual en pendientes/ y devuelve el nombre final.
+
+    La extensión de `fname` cambia a .jpg o .png según el formato de salida.
+    Hasta que el pool termina, /uploads/<foto> sirve un marcador. El nombre
+    se guarda en la fila y, tras el commit, se llama a encolar_foto.
+    """
+    if not PIL_AVAILABLE:
+        file.save(os.path.join(UPLOAD_FOLDER, fname))
+        return fname
+    fname = os.path.splitext(fname)[0] + extension_foto(file.stream)
+    os.makedirs(CARPETA_PENDIENTES, exist_ok=True)
+    file.save(os.path.join(CARPETA_PENDIENTES, fname))
+    return fname
+
+
+def encolar_foto(fname):
+    """Encola el procesamiento de una subida; solo después del commit de su fila"""
+    if not PIL_AVAILABLE:
+        return
+    futuro = _ejecutor_imagenes().submit(procesar_foto, fname)
+    futuro.add_done_callback(lambda f: _foto_procesada(fname, f))
+
+
+def descartar_subida(fname):
+    """Borra una subida cuya fila no llegó a guardarse (rollback)"""
+    carpeta = CARPETA_PENDIENTES if PIL_AVAILABLE else UPLOAD_FOLDER
+    ruta = os.path.join(carpeta, fname)
+    if os.path.exists(ruta):
+        os.remove(ruta)
+
+
+# Códigos únicos: permutación con clave del contador `secuencias.codigo`.
+# Cada número del contador da un código distinto, así que reservar un bloque
+# es un solo UPDATE atómico (seguro entre workers) y no hace falta sondear.
+ALFABETO_CODIGO = string.ascii_uppercase + string.digits
+LARGO_CODIGO = 8
+_ESPACIO_CODIGO = len(ALFABETO_CODIGO) ** LARGO_CODIGO
+_MITAD_FEISTEL = 21  # 2^42 >= 36^8; lo que cae fuera se vuelve a cifrar (cycle-walking)
+_MASCARA_FEISTEL = (1 << _MITAD_FEISTEL) - 1
+
+
+def _permutar_codigo(n, clave):
+    """Biyección de [0, 36^8) en sí mismo: red de Feistel de 4 rondas con blake2b"""
+    while True:
+        izq, der = n >> _MITAD_FEISTEL, n & _MASCARA_FEISTEL
+        for ronda in range(4):
+            f = hashlib.blake2b(bytes([ronda]) + der.to_bytes(3, 'big'), key=clave, digest_size=4).digest()
+            izq, der = der, izq ^ (int.from_bytes(f, 'big') & _MASCARA_FEISTEL)
+        n = (izq << _MITAD_FEISTEL) | der
+        if n < _ESPACIO_CODIGO:
+            return n
+
+
+def _codificar_codigo(n):
+    """Número -> código de 8 caracteres en base 36"""
+    caracteres = []
+    for _ in range(LARGO_CODIGO):
+        n, resto = divmod(n, len(ALFABETO_CODIGO))
+        caracteres.append(ALFABETO_CODIGO[resto])
+    return ''.join(reversed(caracteres))
+
+
+def reservar_codigos(cursor, n=1):
+    """Reserva n códigos únicos de 8 caracteres con un solo UPDATE del contador.
+
+    El UPDATE forma parte de la transacción del llamador: si esta se revierte,
+    el bloque vuelve a quedar libre. Solo las bases con códigos aleatorios
+    anteriores (`legado`) comprueban colisiones, una consulta por LOTE_SQL.
+    """
+    inicio, clave, legado = cursor.execute(
+        "UPDATE secuencias SET valor = valor + ? WHERE nombre = 'codigo' RETURNING valor - ?, clave, legado",
+        (n, n)
+    ).fetchone()
+    clave = bytes.fromhex(clave)
+    codigos = [_codificar_codigo(_permutar_codigo(k, clave)) for k in range(inicio, inicio + n)]
+    if legado:
+        usados = set()
+        for i in range(0, n, LOTE_SQL):
+            bloque = codigos[i:i + LOTE_SQL]
+            cursor.execute(f"SELECT codigo FROM individuos WHERE codigo IN ({','.join('?' * len(bloque))})", bloque)
+            usados.update(r[0] for r in cursor.fetchall())
+        if usados:
+            codigos = [c for c in codigos if c not in usados] + reservar_codigos(cursor, len(usados))
+    return codigos
 
 
 def proteger_ruta(f):
@@ -144,10 +477,75 @@ def proteger_ruta(f):
     return wrapper
 
 
+# =============================================================================
+# CONEXIONES A LA BASE DE DATOS
+# =============================================================================
+
+# Pool por worker: cada proceso de gunicorn mantiene sus propias conexiones
+_DB_POOL = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+_DB_POOL_PID = os.getpid()
+
+
+def abrir_conexion():
+    """Abre una conexión SQLite configurada (WAL, busy_timeout, FK y caché)"""
+    conn = sqlite3.connect(
+        DB,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=DB_STATEMENT_CACHE,
+        check_same_thread=False,  # El pool la entrega a un solo hilo a la vez
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")  # ✅ Lectores no bloquean escritores
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA foreign_keys = ON")  # ✅ Habilitar claves foráneas
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_BYTES}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+def _obtener_del_pool():
+    """Entrega una conexión caliente del pool del worker o abre una nueva"""
+    global _DB_POOL, _DB_POOL_PID
+    if _DB_POOL_PID != os.getpid():
+        # Proceso hijo (fork): no reutilizar conexiones heredadas del padre
+        _DB_POOL = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+        _DB_POOL_PID = os.getpid()
+    try:
+        return _DB_POOL.get_nowait()
+    except queue.Empty:
+        return abrir_conexion()
+
+
+def _devolver_al_pool(conn):
+    """Devuelve la conexión al pool descartando cualquier transacción pendiente"""
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        _DB_POOL.put_nowait(conn)
+    except (queue.Full, sqlite3.Error):
+        conn.close()
+
+
+def get_db():
+    """Conexión de la petición actual (una por request, ligada a flask.g)"""
+    if 'db' not in g:
+        g.db = _obtener_del_pool()
+    return g.db
+
+
+@app.teardown_appcontext
+def cerrar_db(exc):
+    """Devuelve al pool la conexión usada por la petición"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        _devolver_al_pool(conn)
+
+
 def init_db():
     """Inicializa la base de datos con todas las tablas e índices"""
-    conn = sqlite3.connect(DB)
-    conn.execute("PRAGMA foreign_keys = ON")  # ✅ Habilitar claves foráneas
+    conn = abrir_conexion()
     cursor = conn.cursor()
     
     # Tabla de usuarios (trabas)
@@ -177,6 +575,7 @@ def init_db():
         foto TEXT,
         generacion INTEGER DEFAULT 1,
         codigo TEXT UNIQUE,
+        consanguinidad REAL,
         UNIQUE(traba, placa_traba)
     )
     ''')
@@ -220,7 +619,13 @@ def init_db():
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_progenitores_individuo ON progenitores(individuo_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_progenitores_madre ON progenitores(madre_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_progenitores_padre ON progenitores(padre_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_individuos_raza ON individuos(traba, raza, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_individuos_apariencia ON individuos(traba, apariencia, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_individuos_color ON individuos(traba, color, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_individuos_generacion ON individuos(traba, generacion, id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_cruces_traba_fecha ON cruces(traba, fecha)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cruces_individuo1 ON cruces(individuo1_id, traba)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cruces_individuo2 ON cruces(individuo2_id, traba)')
     
     # Migraciones para versiones anteriores
     cols_trabas = [col[1] for col in cursor.execute("PRAGMA table_info(trabas)").fetchall()]
@@ -241,208 +646,1377 @@ def init_db():
             cursor.execute("ALTER TABLE individuos ADD COLUMN codigo TEXT UNIQUE")
         except sqlite3.OperationalError:
             pass
+    if 'consanguinidad' not in cols_individuos:
+        cursor.execute("ALTER TABLE individuos ADD COLUMN consanguinidad REAL")
+    
+    # La F memorizada de un gallo deja de valer si cambian sus progenitores
+    for evento, fila in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_progenitores_{evento.lower()}_coi
+            AFTER {evento} ON progenitores
+            BEGIN
+                UPDATE individuos SET consanguinidad = NULL WHERE id = {fila}.individuo_id;
+            END
+        ''')
+    
+    # Contador de códigos únicos (ver reservar_codigos); `legado` marca bases con códigos aleatorios previos
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS secuencias (
+        nombre TEXT PRIMARY KEY,
+        valor INTEGER NOT NULL DEFAULT 0,
+        clave TEXT NOT NULL,
+        legado INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    cursor.execute(
+        "INSERT OR IGNORE INTO secuencias (nombre, clave, legado) "
+        "VALUES ('codigo', ?, EXISTS (SELECT 1 FROM individuos WHERE codigo IS NOT NULL))",
+        (secrets.token_hex(16),)
+    )
+    
+    # Respaldos en segundo plano; el índice parcial impide dos activos por traba (entre workers)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS trabajos_backup (
+        id TEXT PRIMARY KEY,
+        traba TEXT NOT NULL,
+        estado TEXT NOT NULL DEFAULT 'en_curso',
+        procesados INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        archivo TEXT,
+        error TEXT,
+        creado TIMESTAMP NOT NULL,
+        actualizado TIMESTAMP NOT NULL
+    )
+    ''')
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_trabajos_backup_activo ON trabajos_backup(traba) WHERE estado = 'en_curso'")
+    
+    # OTP pendientes (almacén SQLite por defecto); el índice por expiración hace barata la purga
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS otps (
+        correo TEXT PRIMARY KEY,
+        codigo TEXT NOT NULL,
+        traba TEXT NOT NULL,
+        expira REAL NOT NULL,
+        intentos INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_otps_expira ON otps(expira)')
+    
+    # Cubetas de fichas para limitar intentos de inicio de sesión y registro
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS limites_acceso (
+        clave TEXT PRIMARY KEY,
+        fichas REAL NOT NULL,
+        actualizado REAL NOT NULL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_limites_acceso_actualizado ON limites_acceso(actualizado)')
+    
+    crear_seguimiento_cambios(cursor)
+    crear_indice_fts(cursor)
     
     conn.commit()
     conn.close()
     app.logger.info("✅ Base de datos inicializada correctamente")
 
 
-def generar_caracteristica(gallo_id, traba):
-    """Genera una descripción de roles del gallo en la genealogía"""
-    roles = []
-    conn2 = sqlite3.connect(DB)
-    conn2.row_factory = sqlite3.Row
-    cur = conn2.cursor()
-    
-    # Buscar descendientes donde este gallo es madre
-    cur.execute('''
-        SELECT i.placa_traba 
-        FROM individuos i 
-        JOIN progenitores p ON i.id = p.individuo_id 
-        WHERE p.madre_id = ?
-    ''', (gallo_id,))
-    for r in cur.fetchall():
-        roles.append(f"Madre de {r['placa_traba']}")
-        
-    # Buscar descendientes donde este gallo es padre
-    cur.execute('''
-        SELECT i.placa_traba 
-        FROM individuos i 
-        JOIN progenitores p ON i.id = p.individuo_id 
-        WHERE p.padre_id = ?
-    ''', (gallo_id,))
-    for r in cur.fetchall():
-        roles.append(f"Padre de {r['placa_traba']}")
+def crear_indice_fts(cursor):
+    """Crea el índice FTS5 de individuos con sus triggers y lo rellena si es nuevo"""
+    columnas = ', '.join(('traba',) + CAMPOS_FTS)
+    nuevas = ', '.join(f'new.{c}' for c in ('traba',) + CAMPOS_FTS)
+    viejas = ', '.join(f'old.{c}' for c in ('traba',) + CAMPOS_FTS)
+    existia = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'individuos_fts'").fetchone()
+    try:
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS individuos_fts USING fts5(
+                {columnas},
+                content='individuos', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        app.logger.warning(f"⚠️ FTS5 no disponible, /buscar usará LIKE: {e}")
+        return
+    
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS individuos_fts_ai AFTER INSERT ON individuos BEGIN
+            INSERT INTO individuos_fts(rowid, {columnas}) VALUES (new.id, {nuevas});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS individuos_fts_ad AFTER DELETE ON individuos BEGIN
+            INSERT INTO individuos_fts(individuos_fts, rowid, {columnas}) VALUES ('delete', old.id, {viejas});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS individuos_fts_au AFTER UPDATE OF {columnas} ON individuos BEGIN
+            INSERT INTO individuos_fts(individuos_fts, rowid, {columnas}) VALUES ('delete', old.id, {viejas});
+            INSERT INTO individuos_fts(rowid, {columnas}) VALUES (new.id, {nuevas});
+        END
+    ''')
+    if not existia:
+        cursor.execute("INSERT INTO individuos_fts(individuos_fts) VALUES ('rebuild')")
+        app.logger.info("✅ Índice de búsqueda FTS5 reconstruido")
+
+
+def _filtro_ids(ids, traba):
+    """Genera fragmentos SQL 'IN (...)' por lotes para un conjunto de ids o para toda la traba"""
+    if ids is None:
+        return [('IN (SELECT id FROM individuos WHERE traba = ?)', (traba,))]
+    ids = list(dict.fromkeys(ids))
+    return [
+        (f"IN ({','.join('?' * len(lote))})", tuple(lote))
+        for lote in (ids[i:i + LOTE_SQL] for i in range(0, len(ids), LOTE_SQL))
+    ]
+
+
+def calcular_caracteristicas(cursor, traba, ids=None):
+    """Calcula los roles ("Madre de", "Padre de", "Cruce ...") de varios gallos en consultas agrupadas.
+
+    Si `ids` es None se calcula para toda la traba. Devuelve {id: texto}; los gallos
+    sin roles no aparecen en el diccionario (usar .get(id, "—")).
+    """
+    madres, padres, cruces = defaultdict(list), defaultdict(list), defaultdict(list)
+    
+    for filtro, params in _filtro_ids(ids, traba):
+        # Descendientes donde el gallo es madre o padre (hasta 4 por rol: basta para saber si hay "...")
+        for rol, destino in (('madre_id', madres), ('padre_id', padres)):
+            cursor.execute(f'''
+                SELECT gid, placa_traba FROM (
+                    SELECT p.{rol} AS gid, i.placa_traba,
+                           ROW_NUMBER() OVER (PARTITION BY p.{rol} ORDER BY i.id) AS n
+                    FROM progenitores p
+                    JOIN individuos i ON i.id = p.individuo_id
+                    WHERE p.{rol} {filtro}
+                ) WHERE n <= 4
+            ''', params)
+            for gid, placa in cursor.fetchall():
+                destino[gid].append(placa)
         
-    # Buscar cruces recientes
-    cur.execute('''
-        SELECT tipo, fecha FROM cruces
-        WHERE (individuo1_id = ? OR individuo2_id = ?) AND traba = ?
-        ORDER BY fecha DESC LIMIT 2
-    ''', (gallo_id, gallo_id, traba))
-    for cr in cur.fetchall():
-        roles.append(f"Cruce {cr['tipo']} ({cr['fecha']})")
+        # Dos cruces más recientes por gallo
+        cursor.execute(f'''
+            SELECT gid, tipo, fecha FROM (
+                SELECT gid, tipo, fecha,
+                       ROW_NUMBER() OVER (PARTITION BY gid ORDER BY fecha DESC, id DESC) AS n
+                FROM (
+                    SELECT individuo1_id AS gid, id, tipo, fecha FROM cruces
+                    WHERE traba = ? AND individuo1_id {filtro}
+                    UNION
+                    SELECT individuo2_id AS gid, id, tipo, fecha FROM cruces
+                    WHERE traba = ? AND individuo2_id {filtro}
+                )
+            ) WHERE n <= 2
+        ''', (traba, *params, traba, *params))
+        for gid, tipo, fecha in cursor.fetchall():
+            cruces[gid].append((tipo, fecha))
     
-    conn2.close()
-    return "; ".join(roles[:3]) + ("..." if len(roles) > 3 else "") if roles else "—"
+    caracteristicas = {}
+    for gid in set(madres) | set(padres) | set(cruces):
+        roles = [f"Madre de {p}" for p in madres.get(gid, [])]
+        roles += [f"Padre de {p}" for p in padres.get(gid, [])]
+        roles += [f"Cruce {tipo} ({fecha})" for tipo, fecha in cruces.get(gid, [])]
+        caracteristicas[gid] = "; ".join(roles[:3]) + ("..." if len(roles) > 3 else "")
+    return caracteristicas
 
 
 # =============================================================================
-# RUTAS DE AUTENTICACIÓN
+# BÚSQUEDA DE TEXTO COMPLETO
 # =============================================================================
 
-@app.route('/solicitar-otp', methods=['POST'])
-@csrf.exempt  # Exento de CSRF para compatibilidad con formularios simples
-def solicitar_otp():
-    correo = request.form.get('correo', '').strip().lower()
-    if not correo:
-        return '<script>alert("❌ Ingresa tu correo."); window.location="/";</script>'
-    
-    conn = sqlite3.connect(DB)
-    cursor = conn.cursor()
-    cursor.execute('SELECT nombre_traba FROM trabas WHERE correo = ?', (correo,))
-    traba_row = cursor.fetchone()
-    conn.close()
-    
-    if not traba_row:
-        return '<script>alert("❌ Correo no registrado."); window.location="/";</script>'
-    
-    traba = traba_row[0]
-    codigo = str(secrets.randbelow(1000000)).zfill(6)
-    
-    # ✅ OTP con expiración (5 minutos) y límite de intentos
-    OTP_TEMP[correo] = {
-        'codigo': codigo,
-        'traba': traba,
-        'expira': datetime.now() + timedelta(minutes=5),
-        'intentos': 0
-    }
-    
-    # En producción: enviar email real con sendgrid, smtp, etc.
-    app.logger.info(f"📧 [OTP DEV para {correo}]: {codigo}")
-    
-    return f"""
-    <script>
-        alert("✅ Código enviado a tu correo. (Verifica la consola en desarrollo)");
-        window.location="/verificar-otp?correo={correo}";
-    </script>
-    """
+_FTS_DISPONIBLE = True
 
 
-@app.route('/verificar-otp')
-def pagina_verificar_otp():
-    correo = request.args.get('correo', '').strip()
-    if not correo:
-        return redirect(url_for('bienvenida'))
-    return f"""
-<!DOCTYPE html>
-<html><head><title>Verificar OTP</title>
-<meta name="viewport" content="width=device-width, initial-scale=1">
-</head>
-<body style="background:#01030a;color:white;text-align:center;padding:50px;font-family:sans-serif;">
-    <h2>🔐 Ingresar Código</h2>
-    <p>Código enviado a: <strong>{correo}</strong></p>
-    <p style="color:#f39c12;font-size:0.9em;">⏱️ Válido por 5 minutos • Máximo 3 intentos</p>
-    <form method="POST" action="/verificar-otp">
-        <input type="hidden" name="correo" value="{correo}">
-        <input type="text" name="codigo" required placeholder="Código de 6 dígitos" 
-               maxlength="6" pattern="[0-9]{{6}}" 
-               style="padding:10px;font-size:18px;text-align:center;letter-spacing:5px;width:200px;">
-        <br><br>
-        <button type="submit" style="padding:10px 20px;background:#2ecc71;color:#041428;border:none;border-radius:5px;font-weight:bold;">✅ Verificar</button>
-    </form>
-    <p><a href="/" style="color:#00ffff;text-decoration:none;">← Regresar</a></p>
-</body></html>
-"""
+def consulta_fts(termino, traba):
+    """Convierte el texto del usuario en una consulta FTS5 por prefijos restringida a la traba"""
+    tokens = re.findall(r'\w+', termino.lower())
+    if not tokens:
+        return None
+    prefijos = ' AND '.join(f'"{t}"*' for t in tokens)
+    traba_frase = traba.replace('"', '""')
+    return f'traba : "{traba_frase}" AND {{{" ".join(CAMPOS_FTS)}}} : ({prefijos})'
 
 
-@app.route('/verificar-otp', methods=['POST'])
-@csrf.exempt
-def verificar_otp():
-    correo = request.form.get('correo', '').strip()
-    codigo = request.form.get('codigo', '').strip()
-    
-    if not correo or not codigo:
-        return redirect(url_for('bienvenida'))
-    
-    # Limpiar OTPs expirados periódicamente
-    limpiar_otps_expirados()
-    
-    if correo not in OTP_TEMP:
-        return '<script>alert("❌ Código expirado o inválido."); window.location="/";</script>'
-    
-    otp_data = OTP_TEMP[correo]
-    
-    # Verificar expiración
-    if datetime.now() > otp_data['expira']:
-        del OTP_TEMP[correo]
-        return '<script>alert("❌ Código expirado. Solicita uno nuevo."); window.location="/";</script>'
-    
-    # Limitar intentos (máximo 3)
-    if otp_data['intentos'] >= 3:
-        del OTP_TEMP[correo]
-        return '<script>alert("❌ Demasiados intentos. Solicita un nuevo código."); window.location="/";</script>'
+def buscar_individuos(cursor, traba, termino, limite=BUSQUEDA_LIMITE):
+    """Busca gallos por placa, regional, nombre, color, raza o código, ordenados por relevancia.
+
+    Usa el índice FTS5 (prefijos + bm25); si la base no tiene FTS5, recurre a LIKE.
+    Devuelve el cursor ya ejecutado para recorrerlo de forma incremental.
+    """
+    global _FTS_DISPONIBLE
+    columnas = '''i.id, i.placa_traba, i.placa_regional, i.nombre, i.raza, i.color, i.apariencia, i.n_pelea, i.foto,
+               pr.madre_id, pr.padre_id'''
+    consulta = consulta_fts(termino, traba)
+    if _FTS_DISPONIBLE and consulta:
+        try:
+            cursor.execute(f'''
+                SELECT {columnas}
+                FROM individuos_fts f
+                JOIN individuos i ON i.id = f.rowid
+                LEFT JOIN progenitores pr ON i.id = pr.individuo_id
+                WHERE individuos_fts MATCH ? AND i.traba = ?
+                ORDER BY bm25(individuos_fts, {', '.join(map(str, PESOS_FTS))}), i.placa_traba
+                LIMIT ?
+            ''', (consulta, traba, limite))
+            return cursor
+        except sqlite3.OperationalError as e:
+            _FTS_DISPONIBLE = False
+            app.logger.warning(f"⚠️ Búsqueda FTS5 no disponible, usando LIKE: {e}")
     
-    if otp_data['codigo'] == codigo:
-        traba = otp_data['traba']
-        session['traba'] = traba.strip()
-        session.permanent = True
-        del OTP_TEMP[correo]
-        app.logger.info(f"✅ Login exitoso para traba: {traba}")
-        return redirect(url_for('menu_principal'))
-    else:
-        otp_data['intentos'] += 1
-        restantes = 3 - otp_data['intentos']
-        if restantes <= 0:
-            del OTP_TEMP[correo]
-            msg = "❌ Demasiados intentos. Solicita un nuevo código."
-        else:
-            msg = f"❌ Código incorrecto. Te quedan {restantes} intento(s)."
-        return f'<script>alert("{msg}"); window.history.back();</script>'
+    cursor.execute(f'''
+        SELECT {columnas}
+        FROM individuos i
+        LEFT JOIN progenitores pr ON i.id = pr.individuo_id
+        WHERE (i.nombre LIKE ? OR i.color LIKE ?) AND i.traba = ?
+        ORDER BY i.placa_traba
+        LIMIT ?
+    ''', (f'%{termino}%', f'%{termino}%', traba, limite))
+    return cursor
 
 
-@app.route('/registrar-traba', methods=['POST'])
-@csrf.exempt
-def registrar_traba():
-    nombre = request.form.get('nombre', '').strip()
-    apellido = request.form.get('apellido', '').strip()
-    traba = request.form.get('traba', '').strip()
-    correo = request.form.get('correo', '').strip().lower()
-    contraseña = request.form.get('contraseña', '')
-    
-    if not all([nombre, apellido, traba, correo, contraseña]):
-        return '<script>alert("❌ Todos los campos son obligatorios."); window.location="/";</script>'
-    
-    if len(contraseña) < 6:
-        return '<script>alert("❌ La contraseña debe tener al menos 6 caracteres."); window.location="/";</script>'
-    
-    contraseña_hash = generate_password_hash(contraseña)
-    nombre_completo = f"{nombre} {apellido}".strip()
+# Caché por worker: {traba: OrderedDict(consulta -> (expira, sugerencias))}
+_CACHE_AUTOCOMPLETAR = {}
+_CACHE_AUTOCOMPLETAR_LOCK = threading.Lock()
+
+
+def invalidar_autocompletar(traba):
+    """Descarta las sugerencias en caché de la traba (tras altas, ediciones o bajas)"""
+    with _CACHE_AUTOCOMPLETAR_LOCK:
+        _CACHE_AUTOCOMPLETAR.pop(traba, None)
+
+
+def autocompletar(cursor, traba, termino, limite=AUTOCOMPLETAR_LIMITE):
+    """Sugerencias compactas (id, placa, nombre, foto) por prefijo, con caché LRU/TTL por traba.
+
+    Las dos rutas ignoran mayúsculas, como la clave de la caché.
+    """
+    global _FTS_DISPONIBLE
+    clave = (termino.lower(), limite)
+    ahora = time.monotonic()
+    with _CACHE_AUTOCOMPLETAR_LOCK:
+        cache = _CACHE_AUTOCOMPLETAR.get(traba)
+        if cache and clave in cache and cache[clave][0] > ahora:
+            cache.move_to_end(clave)
+            return cache[clave][1]
     
-    conn = sqlite3.connect(DB)
-    cursor = conn.cursor()
-    try:
+    consulta = consulta_fts(termino, traba)
+    filas = None
+    if _FTS_DISPONIBLE and consulta:
+        try:
+            cursor.execute(f'''
+                SELECT i.id, i.placa_traba, i.nombre, i.foto
+                FROM individuos_fts f
+                JOIN individuos i ON i.id = f.rowid
+                WHERE individuos_fts MATCH ? AND i.traba = ?
+                ORDER BY bm25(individuos_fts, {', '.join(map(str, PESOS_FTS))}), i.placa_traba
+                LIMIT ?
+            ''', (consulta, traba, limite))
+            filas = cursor.fetchall()
+        except sqlite3.OperationalError as e:
+            _FTS_DISPONIBLE = False
+            app.logger.warning(f"⚠️ Búsqueda FTS5 no disponible, autocompletado por placa: {e}")
+    if filas is None:
+        # Placas de la traba (idx_individuos_traba_placa) que empiezan por el término, sin distinguir mayúsculas
         cursor.execute('''
-            INSERT INTO trabas (nombre_traba, nombre_completo, correo, contraseña_hash)
-            VALUES (?, ?, ?, ?)
-        ''', (traba, nombre_completo, correo, contraseña_hash))
-        conn.commit()
-        app.logger.info(f"✅ Nueva traba registrada: {traba} ({correo})")
-        return '<script>alert("✅ Registro exitoso. Ahora puedes iniciar sesión."); window.location="/";</script>'
-    except sqlite3.IntegrityError as e:
-        if "correo" in str(e).lower():
-            msg = "❌ El correo ya está registrado."
-        elif "nombre_traba" in str(e).lower() or "unique" in str(e).lower():
-            msg = "❌ El nombre de la traba ya existe."
-        else:
-            msg = "❌ Error en el registro. Intenta nuevamente."
-        app.logger.warning(f"⚠️ Error al registrar traba: {e}")
-        return f'<script>alert("{msg}"); window.location="/";</script>'
-    finally:
-        conn.close()
+            SELECT id, placa_traba, nombre, foto FROM individuos
+            WHERE traba = ? AND placa_traba >= ? COLLATE NOCASE AND placa_traba < ? COLLATE NOCASE
+            ORDER BY placa_traba COLLATE NOCASE
+            LIMIT ?
+        ''', (traba, termino, termino + '\U0010ffff', limite))
+        filas = cursor.fetchall()
+    
+    sugerencias = [
+        {'id': r['id'], 'placa': r['placa_traba'], 'nombre': r['nombre'],
+         'foto': url_foto(r['foto'], 64) if r['foto'] else None}
+        for r in filas
+    ]
+    with _CACHE_AUTOCOMPLETAR_LOCK:
+        cache = _CACHE_AUTOCOMPLETAR.setdefault(traba, OrderedDict())
+        cache[clave] = (ahora + AUTOCOMPLETAR_TTL, sugerencias)
+        cache.move_to_end(clave)
+        while len(cache) > AUTOCOMPLETAR_CACHE_MAX:
+            cache.popitem(last=False)
+    return sugerencias
 
 
-@app.route('/iniciar-sesion', methods=['POST'])
+# =============================================================================
+# LISTADO PAGINADO Y FACETAS
+# =============================================================================
+
+FILTROS_LISTA = ('raza', 'apariencia', 'color', 'generacion')
+ORDENES_LISTA = {'id': ('i.id',), 'placa': ('i.placa_traba', 'i.id')}
+
+
+def leer_filtros_lista(args):
+    """Filtros de faceta presentes en la query string ({campo: valor})"""
+    filtros = {}
+    for campo in FILTROS_LISTA:
+        valor = args.get(campo, '').strip()
+        if valor:
+            if campo == 'generacion':
+                if not valor.isdigit():
+                    continue
+                valor = int(valor)
+            filtros[campo] = valor
+    return filtros
+
+
+def _condiciones_lista(traba, filtros, excluir=None):
+    """WHERE de la traba con los filtros de faceta (salvo `excluir`)"""
+    partes, params = ['i.traba = ?'], [traba]
+    for campo, valor in filtros.items():
+        if campo != excluir:
+            partes.append(f'i.{campo} = ?')
+            params.append(valor)
+    return ' AND '.join(partes), params
+
+
+def codificar_cursor(clave):
+    """Cursor opaco de paginación a partir de la clave de la última fila"""
+    return base64.urlsafe_b64encode(json.dumps(clave).encode('utf-8')).decode('ascii')
+
+
+def decodificar_cursor(token):
+    """Clave de la última fila vista, o None si el cursor falta o es inválido"""
+    if not token:
+        return None
+    try:
+        clave = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        return clave if isinstance(clave, list) else None
+    except (ValueError, UnicodeError):
+        return None
+
+
+def consultar_pagina_gallos(cursor, traba, filtros, orden='id', descendente=True, limite=LISTA_POR_PAGINA, despues=None):
+    """Ejecuta la consulta de una página por keyset (sin OFFSET).
+
+    Pide limite + 1 filas: si llega la fila extra hay página siguiente. Devuelve
+    el cursor ya ejecutado para leerlo de forma incremental.
+    """
+    columnas_orden = ORDENES_LISTA.get(orden, ORDENES_LISTA['id'])
+    where, params = _condiciones_lista(traba, filtros)
+    if despues is not None and len(despues) == len(columnas_orden):
+        comparador = '<' if descendente else '>'
+        where += f" AND ({', '.join(columnas_orden)}) {comparador} ({', '.join('?' * len(columnas_orden))})"
+        params += despues
+    sentido = 'DESC' if descendente else 'ASC'
+    cursor.execute(f'''
+        SELECT i.id, i.placa_traba, i.placa_regional, i.nombre, i.raza, i.color, i.apariencia, i.n_pelea, i.foto, i.generacion, i.codigo,
+               m.placa_traba as madre_placa, p.placa_traba as padre_placa
+        FROM individuos i
+        LEFT JOIN progenitores pr ON i.id = pr.individuo_id
+        LEFT JOIN individuos m ON pr.madre_id = m.id
+        LEFT JOIN individuos p ON pr.padre_id = p.id
+        WHERE {where}
+        ORDER BY {', '.join(f'{c} {sentido}' for c in columnas_orden)}
+        LIMIT ?
+    ''', (*params, limite + 1))
+    return cursor
+
+
+def cursor_siguiente(fila, orden='id'):
+    """Cursor de la página que sigue a `fila` (la última mostrada)"""
+    return codificar_cursor([fila[c.split('.')[1]] for c in ORDENES_LISTA.get(orden, ORDENES_LISTA['id'])])
+
+
+def contar_facetas(cursor, traba, filtros):
+    """Conteos por faceta en una sola consulta agrupada.
+
+    Cada faceta se cuenta con los demás filtros aplicados (no el suyo propio),
+    para poder cambiar de valor sin perder las opciones. Devuelve
+    ({faceta: [(valor, n), ...]}, total_filtrado).
+    """
+    ramas, params = [], []
+    where, p = _condiciones_lista(traba, filtros)
+    ramas.append(f"SELECT 'total' AS faceta, NULL AS valor, COUNT(*) AS n FROM individuos i WHERE {where}")
+    params += p
+    for campo in FILTROS_LISTA:
+        where, p = _condiciones_lista(traba, filtros, excluir=campo)
+        limite = f'ORDER BY n DESC LIMIT {FACETAS_COLOR_MAX}' if campo == 'color' else ''
+        ramas.append(f"SELECT * FROM (SELECT '{campo}' AS faceta, i.{campo} AS valor, COUNT(*) AS n FROM individuos i WHERE {where} GROUP BY i.{campo} {limite})")
+        params += p
+    cursor.execute(' UNION ALL '.join(ramas), params)
+    
+    facetas, total = {campo: [] for campo in FILTROS_LISTA}, 0
+    for faceta, valor, n in cursor.fetchall():
+        if faceta == 'total':
+            total = n
+        elif valor is not None:
+            facetas[faceta].append((valor, n))
+    for campo in FILTROS_LISTA:
+        facetas[campo].sort(key=lambda x: str(x[0]))
+    return facetas, total
+
+
+# =============================================================================
+# MOTOR DE PEDIGRÍ
+# =============================================================================
+
+CAMPOS_PEDIGRI = ('id', 'placa_traba', 'placa_regional', 'nombre', 'raza', 'color', 'apariencia', 'foto', 'generacion', 'codigo')
+
+
+def _limitar_generaciones(valor, defecto=ARBOL_GEN_DEFECTO):
+    """Normaliza el parámetro ?gen= al rango permitido"""
+    try:
+        return max(1, min(int(valor), ARBOL_GEN_MAX))
+    except (TypeError, ValueError):
+        return defecto
+
+
+def obtener_ancestros(cursor, traba, gallo_id, generaciones=ARBOL_GEN_DEFECTO):
+    """Obtiene el árbol de ancestros (N generaciones, contando al gallo) en una sola consulta recursiva.
+
+    Devuelve un diccionario anidado {campos..., 'padre': {...}, 'madre': {...}} o None
+    si el gallo no pertenece a la traba. Las posiciones siguen la numeración
+    Ahnentafel (raíz = 1, padre = 2n, madre = 2n + 1).
+    """
+    cursor.execute(f'''
+        WITH RECURSIVE ancestros(id, gen, pos) AS (
+            SELECT ?, 0, 1
+            UNION ALL
+            SELECT CASE s.lado WHEN 0 THEN p.padre_id ELSE p.madre_id END, a.gen + 1, a.pos * 2 + s.lado
+            FROM ancestros a
+            JOIN progenitores p ON p.individuo_id = a.id
+            CROSS JOIN (SELECT 0 AS lado UNION ALL SELECT 1) s
+            WHERE a.gen < ?
+              AND (CASE s.lado WHEN 0 THEN p.padre_id ELSE p.madre_id END) IS NOT NULL
+        )
+        SELECT a.gen, a.pos, {', '.join('i.' + c for c in CAMPOS_PEDIGRI)}
+        FROM ancestros a
+        JOIN individuos i ON i.id = a.id
+        WHERE i.traba = ?
+    ''', (gallo_id, generaciones - 1, traba))
+    nodos = {r['pos']: r for r in cursor.fetchall()}
+    
+    def construir(pos):
+        r = nodos.get(pos)
+        if r is None:
+            return None
+        nodo = {c: r[c] for c in CAMPOS_PEDIGRI}
+        nodo['gen'] = r['gen']
+        nodo['padre'] = construir(pos * 2)
+        nodo['madre'] = construir(pos * 2 + 1)
+        return nodo
+    
+    return construir(1)
+
+
+def obtener_descendientes(cursor, traba, gallo_id, generaciones=ARBOL_GEN_DEFECTO):
+    """Obtiene los descendientes (N generaciones, contando al gallo) en una sola consulta recursiva.
+
+    Devuelve una lista plana ordenada por generación; cada elemento indica su
+    madre_id/padre_id para poder reconstruir la rama.
+    """
+    cursor.execute(f'''
+        WITH RECURSIVE descendientes(id, gen) AS (
+            SELECT ?, 0
+            UNION
+            SELECT p.individuo_id, d.gen + 1
+            FROM descendientes d
+            JOIN progenitores p ON p.madre_id = d.id OR p.padre_id = d.id
+            WHERE d.gen < ?
+        )
+        SELECT MIN(d.gen) AS gen, pr.madre_id, pr.padre_id, {', '.join('i.' + c for c in CAMPOS_PEDIGRI)}
+        FROM descendientes d
+        JOIN individuos i ON i.id = d.id
+        LEFT JOIN progenitores pr ON pr.individuo_id = i.id
+        WHERE d.gen > 0 AND i.traba = ?
+        GROUP BY i.id
+        ORDER BY gen, i.id
+    ''', (gallo_id, generaciones - 1, traba))
+    return [dict(r) for r in cursor.fetchall()]
+
+
+# =============================================================================
+# MOTOR DE CONSANGUINIDAD (COI)
+# =============================================================================
+
+def cargar_pedigri(cursor, ids, limite=COI_ANCESTROS_MAX):
+    """Carga {id: (padre_id, madre_id, F)} de los ids indicados y de sus ancestros.
+
+    Una sola consulta recursiva; UNION descarta repetidos, por lo que también
+    termina si el pedigrí contiene ciclos por error de captura. F es la
+    consanguinidad ya memorizada en `individuos` (None si aún no se calculó).
+    En pedigríes muy densos se conservan solo las generaciones completas más
+    cercanas que caben en `limite`; los progenitores que quedan fuera cuentan
+    como desconocidos (ver Parentesco.incompletos).
+    """
+    ids = [i for i in dict.fromkeys(ids) if i is not None]
+    if not ids:
+        return {}
+    cursor.execute(f'''
+        WITH RECURSIVE anc(id) AS (
+            VALUES {', '.join('(?)' for _ in ids)}
+            UNION
+            SELECT CASE s.lado WHEN 0 THEN p.padre_id ELSE p.madre_id END
+            FROM anc
+            JOIN progenitores p ON p.individuo_id = anc.id
+            CROSS JOIN (SELECT 0 AS lado UNION ALL SELECT 1) s
+            WHERE (CASE s.lado WHEN 0 THEN p.padre_id ELSE p.madre_id END) IS NOT NULL
+        )
+        SELECT anc.id, p.padre_id, p.madre_id, i.consanguinidad
+        FROM anc
+        JOIN individuos i ON i.id = anc.id
+        LEFT JOIN progenitores p ON p.individuo_id = anc.id
+    ''', ids)
+    pedigri = {r[0]: (r[1], r[2], r[3]) for r in cursor.fetchall()}
+    if len(pedigri) <= limite:
+        return pedigri
+    nivel = {i for i in ids if i in pedigri}
+    incluidos = set(nivel)
+    while nivel:
+        siguiente = {p for x in nivel for p in pedigri[x][:2] if p in pedigri and p not in incluidos}
+        if len(incluidos) + len(siguiente) > limite:
+            break
+        incluidos |= siguiente
+        nivel = siguiente
+    return {x: pedigri[x] for x in incluidos}
+
+
+class Parentesco:
+    """Parentesco y consanguinidad de Wright (Meuwissen & Luo, 1992) sobre un pedigrí en memoria.
+
+    Con A = T·D·Tᵀ, el parentesco es f(a, b) = ½·Σⱼ T[a,j]·T[b,j]·dⱼ, donde T[x, ·] son
+    las contribuciones génicas de cada ancestro (un recorrido en orden topológico
+    inverso) y dⱼ la varianza mendeliana, que solo depende de la F de los padres
+    de j. Las F de los ancestros se memorizan (y se persisten en `individuos`),
+    así que cada par cuesta O(ancestros) una vez calculado el pedigrí.
+    Muchas F pendientes a la vez (un pedigrí nuevo o invalidado) se calculan
+    en bloque con el método tabular sobre la matriz A de esos ancestros.
+    """
+    
+    def __init__(self, pedigri):
+        self.padres = {x: (v[0], v[1]) for x, v in pedigri.items()}
+        self.F = {x: v[2] for x, v in pedigri.items() if len(v) > 2 and v[2] is not None}
+        self.nuevas = {}  # F calculadas en esta instancia (para persistir)
+        self.incompletos = set()  # Con algún ancestro recortado por cargar_pedigri: su F no se persiste
+        self._orden = {}
+        self._ordenar()
+    
+    def _ordenar(self):
+        """Orden topológico (ancestros primero); anula enlaces que formen ciclos"""
+        estado = {}  # 1 = en proceso, 2 = terminado
+        for raiz in self.padres:
+            pila = [raiz]
+            while pila:
+                x = pila[-1]
+                if estado.get(x) == 2:
+                    pila.pop()
+                    continue
+                estado[x] = 1
+                padre, madre = self.padres.get(x, (None, None))
+                pendientes = [p for p in (padre, madre) if p in self.padres and p not in estado]
+                if pendientes:
+                    pila.extend(pendientes)
+                    continue
+                # Un progenitor aún "en proceso" es un ciclo; uno fuera del pedigrí se trata como desconocido
+                if any(p is not None and (p not in self.padres or p in self.incompletos) for p in (padre, madre)):
+                    self.incompletos.add(x)
+                self.padres[x] = tuple(p if p in self.padres and estado.get(p) == 2 else None for p in (padre, madre))
+                self._orden[x] = len(self._orden)
+                estado[x] = 2
+                pila.pop()
+    
+    def varianza_mendeliana(self, j):
+        """Varianza mendeliana de j (fila de D), según cuántos padres conoce"""
+        conocidos = [p for p in self.padres[j] if p is not None]
+        return 1.0 - 0.25 * len(conocidos) - 0.25 * sum(self.consanguinidad(p) for p in conocidos)
+    
+    def contribuciones(self, x):
+        """Fila T[x, ·]: fracción del genoma de x aportada por cada ancestro (incluido x)"""
+        r = {x: 1.0}
+        heap = [-self._orden[x]]
+        por_orden = {self._orden[x]: x}
+        while heap:
+            j = por_orden[-heapq.heappop(heap)]
+            for p in self.padres[j]:
+                if p is None:
+                    continue
+                if p not in r:
+                    r[p] = 0.0
+                    por_orden[self._orden[p]] = p
+                    heapq.heappush(heap, -self._orden[p])
+                r[p] += 0.5 * r[j]
+        return r
+    
+    def consanguinidad(self, x):
+        """Coeficiente de consanguinidad F(x), memorizado"""
+        if x not in self.padres:
+            return 0.0
+        if x not in self.F:
+            self._completar(self.contribuciones(x))
+        return self.F[x]
+    
+    def _completar(self, ancestros):
+        """Calcula las F que faltan de `ancestros` (cerrado por ancestros), del más antiguo al más reciente"""
+        pendientes = sorted((j for j in ancestros if j not in self.F), key=self._orden.get)
+        if len(pendientes) >= COI_TABULAR_MIN:
+            self._consanguinidades_tabular(sorted(ancestros, key=self._orden.get))
+            return
+        for j in pendientes:
+            padre, madre = self.padres[j]
+            self._memorizar(j, self.kinship(padre, madre))
+    
+    def _memorizar(self, j, f):
+        self.F[j] = f
+        if j not in self.incompletos:
+            self.nuevas[j] = f
+    
+    def _consanguinidades_tabular(self, orden):
+        """F de todos los pendientes de `orden` (ancestros primero) con A completa: O(m²), vectorizado.
+
+        A[k, ·] = ½·(A[padre, ·] + A[madre, ·]) y A[k, k] = 1 + F(k); las F ya
+        memorizadas se respetan en la diagonal.
+        """
+        m = len(orden)
+        idx = {x: k for k, x in enumerate(orden)}
+        A = np.zeros((m, m), dtype=np.float32)
+        for k, x in enumerate(orden):
+            ks, kd = (idx.get(p) for p in self.padres[x])
+            fila = A[k, :k]
+            if ks is not None:
+                fila += 0.5 * A[ks, :k]
+            if kd is not None:
+                fila += 0.5 * A[kd, :k]
+            A[:k, k] = fila
+            if x not in self.F:
+                self._memorizar(x, float(0.5 * A[ks, kd]) if ks is not None and kd is not None else 0.0)
+            A[k, k] = 1.0 + self.F[x]
+    
+    def kinship(self, a, b):
+        """Coeficiente de parentesco f(a, b) = COI de un hijo de a × b"""
+        if a not in self.padres or b not in self.padres:
+            return 0.0
+        ra, rb = self.contribuciones(a), self.contribuciones(b)
+        self._completar(ra.keys() | rb.keys())
+        if len(rb) < len(ra):
+            ra, rb = rb, ra
+        return 0.5 * sum(c * rb[j] * self.varianza_mendeliana(j) for j, c in ra.items() if j in rb)
+
+
+def guardar_consanguinidades(cursor, parentesco):
+    """Persiste en `individuos` las F nuevas calculadas por un Parentesco"""
+    if parentesco.nuevas:
+        cursor.executemany(
+            'UPDATE individuos SET consanguinidad = ? WHERE id = ?',
+            [(f, x) for x, f in parentesco.nuevas.items()]
+        )
+        parentesco.nuevas = {}
+
+
+def invalidar_consanguinidad(cursor, ids):
+    """Olvida la F memorizada de los ids y de todos sus descendientes (tras cambiar progenitores)"""
+    for filtro, params in _filtro_ids(ids, None):
+        cursor.execute(f'''
+            WITH RECURSIVE descendientes(id) AS (
+                SELECT id FROM individuos WHERE id {filtro}
+                UNION
+                SELECT p.individuo_id FROM descendientes d
+                JOIN progenitores p ON p.madre_id = d.id OR p.padre_id = d.id
+            )
+            UPDATE individuos SET consanguinidad = NULL WHERE id IN (SELECT id FROM descendientes)
+        ''', params)
+
+
+def crearia_ciclo(cursor, id_, progenitores):
+    """True si algún id de `progenitores` es `id_` o uno de sus descendientes"""
+    marcas = ','.join('?' * len(progenitores))
+    return cursor.execute(f'''
+        WITH RECURSIVE descendientes(id) AS (
+            SELECT ?
+            UNION
+            SELECT p.individuo_id FROM descendientes d
+            JOIN progenitores p ON p.madre_id = d.id OR p.padre_id = d.id
+        )
+        SELECT 1 FROM descendientes WHERE id IN ({marcas}) LIMIT 1
+    ''', (id_, *progenitores)).fetchone() is not None
+
+
+def calcular_coi(cursor, id1, id2):
+    """COI (0-1) de la descendencia prospectiva del cruce id1 × id2, según `progenitores`"""
+    parentesco = Parentesco(cargar_pedigri(cursor, [id1, id2]))
+    coi = parentesco.kinship(id1, id2)
+    guardar_consanguinidades(cursor, parentesco)
+    return coi
+
+
+# =============================================================================
+# PLANIFICADOR DE CRUCES
+# =============================================================================
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint16)
+ORDENES_PLANIFICADOR = {'coi': 'coi', 'comunes': 'ancestros_comunes', 'fundadores': 'fundadores_comunes', 'placa': 'placa_traba'}
+
+
+def _niveles_topologicos(pad, mad, n):
+    """Agrupa los índices 0..n-1 por profundidad (fundadores = 0) para recorrer T nivel a nivel.
+
+    `pad`/`mad` usan n como centinela de progenitor desconocido. Un solo
+    recorrido de Kahn, O(n) aunque el pedigrí tenga miles de generaciones;
+    los que quedan en un ciclo (error de captura) van al último nivel.
+    """
+    hijos = [[] for _ in range(n)]
+    grado = [0] * n
+    for k, progenitores in enumerate(zip(pad.tolist(), mad.tolist())):
+        for p in progenitores:
+            if p < n:
+                hijos[p].append(k)
+                grado[k] += 1
+    prof = [0] * n
+    cola = [k for k in range(n) if grado[k] == 0]
+    for k in cola:  # la lista crece mientras se recorre
+        for h in hijos[k]:
+            prof[h] = max(prof[h], prof[k] + 1)
+            grado[h] -= 1
+            if grado[h] == 0:
+                cola.append(h)
+    prof = np.array(prof, dtype=np.int64)
+    if len(cola) < n:
+        prof[np.array(grado) > 0] = prof.max() + 1
+    orden = np.argsort(prof, kind='stable')
+    cortes = np.flatnonzero(np.diff(prof[orden])) + 1
+    return np.split(orden, cortes)
+
+
+def planificar_cruces(cursor, traba, gallo_id, raza=None, apariencia=None):
+    """Evalúa a la vez a todas las parejas posibles de un gallo dentro de la traba.
+
+    Para cada candidata calcula el COI de la descendencia (½·A[c, gallo]), el
+    número de ancestros compartidos y de fundadores compartidos. La columna
+    A[·, gallo] = T·D·Tᵀ·e se obtiene con un solo recorrido vectorizado por
+    niveles; los ancestros se marcan con bitsets empaquetados.
+    Devuelve (gallo, candidatas) o (None, []) si el gallo no pertenece a la traba.
+    """
+    cursor.execute('''
+        SELECT i.id, p.padre_id, p.madre_id, i.placa_traba, i.nombre, i.raza, i.apariencia, i.color, i.foto
+        FROM individuos i
+        LEFT JOIN progenitores p ON p.individuo_id = i.id
+        WHERE i.traba = ?
+        ORDER BY i.id
+    ''', (traba,))
+    filas = cursor.fetchall()
+    pos = {r['id']: k for k, r in enumerate(filas)}
+    if gallo_id not in pos:
+        return None, []
+    n = len(filas)
+    pad = np.array([pos.get(r['padre_id'], n) for r in filas] + [n], dtype=np.int64)
+    mad = np.array([pos.get(r['madre_id'], n) for r in filas] + [n], dtype=np.int64)
+    niveles = _niveles_topologicos(pad[:n], mad[:n], n)
+    
+    # v = Tᵀ·e (contribuciones de los ancestros) y w = D·v, con F memorizada
+    parentesco = Parentesco(cargar_pedigri(cursor, [gallo_id]))
+    contribuciones = {j: c for j, c in parentesco.contribuciones(gallo_id).items() if j in pos}
+    w = np.zeros(n + 1)
+    for j, c in contribuciones.items():
+        w[pos[j]] = c * parentesco.varianza_mendeliana(j)
+    guardar_consanguinidades(cursor, parentesco)
+    
+    # Ancestros (y fundadores) del gallo como bits
+    ancestros = [pos[j] for j in contribuciones if j != gallo_id]
+    fundadores = np.array([pad[k] == n and mad[k] == n for k in ancestros], dtype=bool)
+    bits = np.zeros((n + 1, max(1, (len(ancestros) + 7) // 8)), dtype=np.uint8)
+    for b, k in enumerate(ancestros):
+        bits[k, b // 8] |= np.uint8(1 << (7 - b % 8))
+    mascara_fundadores = np.packbits(fundadores) if ancestros else np.zeros(1, dtype=np.uint8)
+    
+    # u = T·w y propagación de bitsets, generación por generación
+    u = np.zeros(n + 1)
+    for nivel in niveles:
+        u[nivel] = w[nivel] + 0.5 * (u[pad[nivel]] + u[mad[nivel]])
+        bits[nivel] |= bits[pad[nivel]] | bits[mad[nivel]]
+    compartidos = bits[pad[:n]] | bits[mad[:n]]
+    comunes = _POPCOUNT[compartidos].sum(axis=1)
+    fundadores_comunes = _POPCOUNT[compartidos & mascara_fundadores].sum(axis=1)
+    coi = 0.5 * u[:n]
+    
+    # Sexo inferido del pedigrí: quien figura como padre es macho, como madre es hembra
+    es_padre = np.zeros(n + 1, dtype=bool)
+    es_madre = np.zeros(n + 1, dtype=bool)
+    es_padre[pad[:n]] = True
+    es_madre[mad[:n]] = True
+    k_gallo = pos[gallo_id]
+    mismo_sexo = es_madre if (es_madre[k_gallo] and not es_padre[k_gallo]) else es_padre
+    
+    candidatas = ~mismo_sexo[:n] | (es_padre[:n] & es_madre[:n])
+    candidatas[k_gallo] = False
+    if raza:
+        candidatas &= np.array([r['raza'] == raza for r in filas], dtype=bool)
+    if apariencia:
+        candidatas &= np.array([r['apariencia'] == apariencia for r in filas], dtype=bool)
+    
+    resultado = [
+        {
+            'id': filas[k]['id'],
+            'placa_traba': filas[k]['placa_traba'],
+            'nombre': filas[k]['nombre'],
+            'raza': filas[k]['raza'],
+            'apariencia': filas[k]['apariencia'],
+            'color': filas[k]['color'],
+            'foto': filas[k]['foto'],
+            'coi': round(float(coi[k]) * 100, 4),
+            'ancestros_comunes': int(comunes[k]),
+            'fundadores_comunes': int(fundadores_comunes[k]),
+        }
+        for k in np.flatnonzero(candidatas)
+    ]
+    gallo = dict(filas[k_gallo])
+    gallo['consanguinidad'] = round(parentesco.consanguinidad(gallo_id) * 100, 4)
+    return gallo, resultado
+
+
+def ordenar_candidatas(candidatas, orden='coi', descendente=False):
+    """Ordena las candidatas del planificador (desempate por placa)"""
+    campo = ORDENES_PLANIFICADOR.get(orden, 'coi')
+    return sorted(candidatas, key=lambda c: (c[campo], c['placa_traba']), reverse=descendente)
+
+
+# =============================================================================
+# RENDERIZADO STREAMING
+# =============================================================================
+
+def iterar_lotes(filas, tamaño=LOTE_STREAM):
+    """Recorre un cursor (o cualquier iterable) en listas de hasta `tamaño` filas"""
+    filas = iter(filas)
+    while True:
+        lote = list(itertools.islice(filas, tamaño))
+        if not lote:
+            return
+        yield lote
+
+
+def respuesta_streaming(generador, mimetype='text/html'):
+    """Respuesta que envía cada fragmento del generador en cuanto está listo.
+
+    stream_with_context mantiene vivo el contexto (y la conexión de get_db)
+    hasta que el generador termina.
+    """
+    return Response(stream_with_context(generador), mimetype=mimetype)
+
+
+def generar_tabla_resultados(titulo, color, filas):
+    """Página de resultados de búsqueda generada fila a fila desde el cursor"""
+    yield f'''
+<!DOCTYPE html>
+<html><head><title>Varios Resultados</title></head>
+<body style="background:#01030a;color:white;padding:20px;font-family:sans-serif;">
+<h2 style="text-align:center;color:{color};">{titulo}</h2>
+<p style="text-align:center;">Haz clic en una fila para ver su árbol genealógico.</p>
+<table style="width:100%;max-width:700px;margin:0 auto;border-collapse:collapse;background:rgba(0,0,0,0.2);border-radius:10px;overflow:hidden;">
+    <thead><tr style="color:#00ffff;background:rgba(0,255,255,0.1);">
+        <th style="padding:10px;">Foto</th><th>Placa</th><th>Nombre</th><th>Color</th><th>Raza</th>
+    </tr></thead>
+    <tbody>'''
+    total = 0
+    for lote in iterar_lotes(filas):
+        total += len(lote)
+        yield "".join(f'''
+            <tr onclick="window.location='/arbol/{r['id']}'" style="cursor:pointer;">
+                <td style="padding:8px;">{f"<img src='{url_foto(r['foto'], 64)}' width='40' style='border-radius:4px;'>" if r["foto"] else "—"}</td>
+                <td style="padding:8px;">{r['placa_traba']}</td>
+                <td style="padding:8px;">{r['nombre'] or "—"}</td>
+                <td style="padding:8px;">{r['color']}</td>
+                <td style="padding:8px;">{r['raza']}</td>
+            </tr>
+        ''' for r in lote)
+    yield f'''</tbody>
+</table>
+<p style="text-align:center;color:#bbb;">{total} resultado(s)</p>
+<div style="text-align:center;margin-top:25px;">
+    <a href="/buscar" style="padding:10px 20px;background:#2ecc71;color:#041428;text-decoration:none;border-radius:6px;">← Nueva búsqueda</a>
+    <a href="/menu" style="padding:10px 20px;background:#7f8c8d;color:white;text-decoration:none;border-radius:6px;margin-left:10px;">🏠 Menú</a>
+</div>
+</body></html>
+'''
+
+
+# =============================================================================
+# COMPRESIÓN DE RESPUESTAS
+# =============================================================================
+
+class _Compresor:
+    """Interfaz común a gzip (zlib) y brotli para comprimir por fragmentos"""
+    
+    def __init__(self, codificacion):
+        self.codificacion = codificacion
+        if codificacion == 'br':
+            self._c = brotli.Compressor(quality=COMPRESION_CALIDAD_BR)
+        else:
+            self._c = zlib.compressobj(COMPRESION_NIVEL_GZIP, zlib.DEFLATED, 31)
+    
+    def comprimir(self, datos):
+        return self._c.process(datos) if self.codificacion == 'br' else self._c.compress(datos)
+    
+    def vaciar(self):
+        """Emite lo pendiente sin cerrar el flujo (para que cada fragmento llegue ya)"""
+        return self._c.flush() if self.codificacion == 'br' else self._c.flush(zlib.Z_SYNC_FLUSH)
+    
+    def terminar(self):
+        return self._c.finish() if self.codificacion == 'br' else self._c.flush()
+
+
+def _codificacion_aceptada():
+    """'br' o 'gzip' según Accept-Encoding (None si el cliente no acepta ninguna)"""
+    aceptadas = request.accept_encodings
+    if BROTLI_AVAILABLE and aceptadas['br']:
+        return 'br'
+    if aceptadas['gzip']:
+        return 'gzip'
+    return None
+
+
+def _comprimir_flujo(fragmentos, compresor):
+    for fragmento in fragmentos:
+        if isinstance(fragmento, str):
+            fragmento = fragmento.encode('utf-8')
+        datos = compresor.comprimir(fragmento) + compresor.vaciar()
+        if datos:
+            yield datos
+    yield compresor.terminar()
+
+
+@app.after_request
+def comprimir_respuesta(resp):
+    """gzip/brotli para HTML, JSON, CSV, SVG... de al menos COMPRESION_MIN_BYTES.
+
+    Las respuestas streaming se comprimen fragmento a fragmento; los archivos
+    (send_file) y las ya codificadas se dejan tal cual.
+    """
+    if resp.mimetype not in COMPRESION_TIPOS or resp.status_code != 200 or resp.direct_passthrough \
+            or 'Content-Encoding' in resp.headers or request.method == 'HEAD':
+        return resp
+    resp.vary.add('Accept-Encoding')
+    codificacion = _codificacion_aceptada()
+    if not codificacion:
+        return resp
+    
+    compresor = _Compresor(codificacion)
+    if resp.is_streamed:
+        resp.response = _comprimir_flujo(resp.response, compresor)
+        resp.headers.pop('Content-Length', None)
+    else:
+        datos = resp.get_data()
+        if len(datos) < COMPRESION_MIN_BYTES:
+            return resp
+        resp.set_data(compresor.comprimir(datos) + compresor.terminar())
+    resp.headers['Content-Encoding'] = codificacion
+    # Misma entidad con otra codificación: el ETag deja de ser fuerte
+    etag, debil = resp.get_etag()
+    if etag and not debil:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+
+# =============================================================================
+# ALMACÉN DE OTP
+# =============================================================================
+# Todos los backends exponen guardar(correo, codigo, traba) y
+# verificar(correo, codigo) -> (resultado, dato), con resultado en
+# 'ok' (dato = traba), 'incorrecto' (dato = intentos restantes), 'agotado'
+# o 'expirado'. Un código correcto solo sirve una vez, aunque lleguen dos
+# peticiones a la vez a workers distintos.
+
+class AlmacenOTPSQLite:
+    """OTP en la tabla `otps` de la base de la app (compartida por todos los workers)"""
+    
+    def __init__(self, conexion=None):
+        self._conexion = conexion or get_db
+    
+    def guardar(self, correo, codigo, traba, ttl=OTP_TTL_SEG):
+        conn = self._conexion()
+        ahora = time.time()
+        # Purga por rango del índice de expiración: solo toca las filas vencidas
+        conn.execute('DELETE FROM otps WHERE expira < ?', (ahora,))
+        conn.execute('''INSERT OR REPLACE INTO otps (correo, codigo, traba, expira, intentos)
+                        VALUES (?, ?, ?, ?, 0)''', (correo, codigo, traba, ahora + ttl))
+        conn.commit()
+    
+    def verificar(self, correo, codigo, max_intentos=OTP_MAX_INTENTOS):
+        conn = self._conexion()
+        ahora = time.time()
+        try:
+            # El DELETE ... RETURNING es el único paso que concede el acceso: atómico y de un solo uso
+            fila = conn.execute('''DELETE FROM otps WHERE correo = ? AND codigo = ? AND expira >= ? AND intentos < ?
+                                   RETURNING traba''', (correo, codigo, ahora, max_intentos)).fetchone()
+            if fila:
+                return 'ok', fila[0]
+            fila = conn.execute('''UPDATE otps SET intentos = intentos + 1
+                                   WHERE correo = ? AND expira >= ? AND intentos < ?
+                                   RETURNING intentos''', (correo, ahora, max_intentos)).fetchone()
+            if fila:
+                restantes = max_intentos - fila[0]
+                if restantes > 0:
+                    return 'incorrecto', restantes
+                conn.execute('DELETE FROM otps WHERE correo = ?', (correo,))
+                return 'agotado', 0
+            fila = conn.execute('DELETE FROM otps WHERE correo = ? RETURNING expira', (correo,)).fetchone()
+            return ('agotado', 0) if fila and fila[0] >= ahora else ('expirado', None)
+        finally:
+            conn.commit()
+
+
+class AlmacenOTPRedis:
+    """OTP en Redis (o compatible): un hash por correo con TTL nativo.
+
+    guardar escribe en una transacción MULTI/EXEC. verificar lee, compara y
+    luego borra o suma el intento dentro de WATCH/MULTI: si la clave cambia o
+    caduca entre la lectura y el EXEC, redis-py repite el intento, así una
+    clave vencida nunca se recrea sin TTL y cada código se consume una vez.
+    """
+    
+    def __init__(self, cliente, prefijo='gallofino:otp:'):
+        self.cliente = cliente
+        self.prefijo = prefijo
+    
+    def guardar(self, correo, codigo, traba, ttl=OTP_TTL_SEG):
+        clave = self.prefijo + correo
+        with self.cliente.pipeline() as tubo:
+            tubo.delete(clave)
+            tubo.hset(clave, mapping={'codigo': codigo, 'traba': traba, 'intentos': 0})
+            tubo.expire(clave, ttl)
+            tubo.execute()
+    
+    def verificar(self, correo, codigo, max_intentos=OTP_MAX_INTENTOS):
+        clave = self.prefijo + correo
+        
+        def intento(tubo):
+            datos = tubo.hgetall(clave)
+            if not datos:
+                return 'expirado', None
+            tubo.multi()
+            if 'codigo' not in datos:  # Hash incompleto: nunca debe quedar sin caducar
+                tubo.delete(clave)
+                return 'expirado', None
+            intentos = int(datos.get('intentos', 0)) + 1
+            if intentos > max_intentos:
+                tubo.delete(clave)
+                return 'agotado', 0
+            if secrets.compare_digest(datos['codigo'], codigo):
+                tubo.delete(clave)
+                return 'ok', datos['traba']
+            restantes = max_intentos - intentos
+            if restantes <= 0:
+                tubo.delete(clave)
+                return 'agotado', 0
+            tubo.hincrby(clave, 'intentos', 1)
+            return 'incorrecto', restantes
+        
+        return self.cliente.transaction(intento, clave, value_from_callable=True)
+
+
+class RedisLocal:
+    """Sustituto en memoria de los comandos de Redis que usa la app (pruebas / un solo proceso)"""
+    
+    def __init__(self):
+        self._datos = {}
+        self._expira = {}
+        self._lock = threading.RLock()
+    
+    def _vigente(self, clave):
+        if clave in self._expira and self._expira[clave] < time.monotonic():
+            self._datos.pop(clave, None)
+            self._expira.pop(clave, None)
+        return self._datos.get(clave)
+    
+    def hset(self, clave, mapping):
+        with self._lock:
+            self._datos.setdefault(clave, {}).update({k: str(v) for k, v in mapping.items()})
+            return len(mapping)
+    
+    def hgetall(self, clave):
+        with self._lock:
+            return dict(self._vigente(clave) or {})
+    
+    def hincrby(self, clave, campo, cantidad=1):
+        with self._lock:
+            datos = self._vigente(clave)
+            if datos is None:
+                datos = self._datos[clave] = {}
+            datos[campo] = str(int(datos.get(campo, 0)) + cantidad)
+            return int(datos[campo])
+    
+    def expire(self, clave, segundos):
+        with self._lock:
+            if self._vigente(clave) is None:
+                return False
+            self._expira[clave] = time.monotonic() + segundos
+            return True
+    
+    def delete(self, *claves):
+        with self._lock:
+            borradas = sum(1 for c in claves if self._vigente(c) is not None)
+            for c in claves:
+                self._datos.pop(c, None)
+                self._expira.pop(c, None)
+            return borradas
+    
+    def pipeline(self):
+        return _TuboLocal(self, en_multi=True)
+    
+    def transaction(self, func, *claves, value_from_callable=False):
+        """WATCH/MULTI/EXEC: con el lock tomado de principio a fin nada puede cambiar las claves vigiladas"""
+        with self._lock:
+            tubo = _TuboLocal(self)
+            valor = func(tubo)
+            resultados = tubo.execute()
+        return valor if value_from_callable else resultados
+
+
+class _TuboLocal:
+    """Pipeline de RedisLocal: ejecuta al momento hasta multi() y luego encola hasta execute()"""
+    
+    def __init__(self, cliente, en_multi=False):
+        self._cliente = cliente
+        self._en_multi = en_multi
+        self._cola = []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self._cola.clear()
+    
+    def multi(self):
+        self._en_multi = True
+    
+    def execute(self):
+        with self._cliente._lock:
+            resultados = [getattr(self._cliente, nombre)(*args, **kwargs) for nombre, args, kwargs in self._cola]
+        self._cola.clear()
+        return resultados
+    
+    def __getattr__(self, nombre):
+        comando = getattr(self._cliente, nombre)
+        if not self._en_multi:
+            return comando
+        
+        def encolar(*args, **kwargs):
+            self._cola.append((nombre, args, kwargs))
+            return self
+        return encolar
+
+
+def crear_almacen_otp():
+    """Backend según OTP_BACKEND; sin el paquete redis se usa SQLite"""
+    if OTP_BACKEND == 'redis':
+        if REDIS_AVAILABLE:
+            return AlmacenOTPRedis(redis.Redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'), decode_responses=True))
+        app.logger.warning("⚠️ OTP_BACKEND=redis pero el paquete redis no está instalado; se usa SQLite")
+    elif OTP_BACKEND == 'memoria':
+        return AlmacenOTPRedis(RedisLocal())
+    return AlmacenOTPSQLite()
+
+
+ALMACEN_OTP = crear_almacen_otp()
+
+
+# =============================================================================
+# LÍMITES DE INICIO DE SESIÓN
+# =============================================================================
+
+def consumir_ficha(clave, limite):
+    """Cubeta de fichas compartida entre workers: (permitido, segundos hasta la próxima ficha).
+
+    Recarga y consumo van en un único UPSERT, así dos workers no pueden
+    gastar la misma ficha. Un intento rechazado también gasta su ficha,
+    pero la cubeta nunca baja de -1: insistir no acumula deuda infinita.
+    """
+    capacidad, tasa = limite
+    conn = get_db()
+    ahora = time.time()
+    if random.random() < 0.01:
+        conn.execute('DELETE FROM limites_acceso WHERE actualizado < ?', (ahora - LIMITES_PURGA_SEG,))
+    fichas = conn.execute('''
+        INSERT INTO limites_acceso (clave, fichas, actualizado) VALUES (:clave, :capacidad - 1, :ahora)
+        ON CONFLICT(clave) DO UPDATE SET
+            fichas = MAX(-1, MIN(:capacidad, fichas + (:ahora - actualizado) * :tasa) - 1),
+            actualizado = :ahora
+        RETURNING fichas
+    ''', {'clave': clave, 'capacidad': capacidad, 'tasa': tasa, 'ahora': ahora}).fetchone()[0]
+    conn.commit()
+    if fichas >= 0:
+        return True, 0
+    return False, int((1 - fichas) / tasa) + 1
+
+
+def respuesta_limitada(espera):
+    app.logger.warning(f"🚦 Límite de intentos alcanzado desde {request.remote_addr}")
+    return ('<script>alert("❌ Demasiados intentos. Espera unos minutos e inténtalo de nuevo."); window.location="/";</script>',
+            429, {'Retry-After': str(espera)})
+
+
+def respuesta_ocupado():
+    app.logger.warning("⏳ Cupo de hashing de contraseñas lleno")
+    return ('<script>alert("⏳ El servidor está ocupado. Inténtalo de nuevo en unos segundos."); window.location="/";</script>',
+            503, {'Retry-After': '1'})
+
+
+_HASH_EJECUTOR = None
+_HASH_EJECUTOR_PID = None
+_HASH_CUPO = None
+
+
+def _ejecutor_hash():
+    """Pool de hilos del worker para hashing; el semáforo acota también la cola"""
+    global _HASH_EJECUTOR, _HASH_EJECUTOR_PID, _HASH_CUPO
+    if _HASH_EJECUTOR_PID != os.getpid():
+        _HASH_EJECUTOR = ThreadPoolExecutor(max_workers=HASH_HILOS, thread_name_prefix='hash')
+        _HASH_CUPO = threading.BoundedSemaphore(HASH_HILOS)
+        _HASH_EJECUTOR_PID = os.getpid()
+    return _HASH_EJECUTOR, _HASH_CUPO
+
+
+def en_cupo_hash(funcion, *args):
+    """Ejecuta un hash de contraseña sin pasar de HASH_HILOS a la vez.
+
+    Si no hay hueco en HASH_ESPERA_SEG lanza TimeoutError en lugar de
+    encolar: bajo un ataque los hilos restantes siguen atendiendo páginas.
+    """
+    ejecutor, cupo = _ejecutor_hash()
+    if not cupo.acquire(timeout=HASH_ESPERA_SEG):
+        raise TimeoutError("Cupo de hashing lleno")
+    try:
+        return ejecutor.submit(funcion, *args).result()
+    finally:
+        cupo.release()
+
+
+def necesita_rehash(contraseña_hash):
+    """True si el hash se generó con parámetros distintos de HASH_METODO"""
+    return contraseña_hash.split('$', 1)[0] != HASH_METODO
+
+
+# =============================================================================
+# RUTAS DE AUTENTICACIÓN
+# =============================================================================
+
+@app.route('/solicitar-otp', methods=['POST'])
+@csrf.exempt  # Exento de CSRF para compatibilidad con formularios simples
+def solicitar_otp():
+    correo = request.form.get('correo', '').strip().lower()
+    if not correo:
+        return '<script>alert("❌ Ingresa tu correo."); window.location="/";</script>'
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT nombre_traba FROM trabas WHERE correo = ?', (correo,))
+    traba_row = cursor.fetchone()
+    
+    if not traba_row:
+        return '<script>alert("❌ Correo no registrado."); window.location="/";</script>'
+    
+    traba = traba_row[0]
+    codigo = str(secrets.randbelow(1000000)).zfill(6)
+    
+    # ✅ OTP con expiración (5 minutos) y límite de intentos
+    ALMACEN_OTP.guardar(correo, codigo, traba)
+    
+    # En producción: enviar email real con sendgrid, smtp, etc.
+    app.logger.info(f"📧 [OTP DEV para {correo}]: {codigo}")
+    
+    return f"""
+    <script>
+        alert("✅ Código enviado a tu correo. (Verifica la consola en desarrollo)");
+        window.location="/verificar-otp?correo={correo}";
+    </script>
+    """
+
+
+@app.route('/verificar-otp')
+def pagina_verificar_otp():
+    correo = request.args.get('correo', '').strip()
+    if not correo:
+        return redirect(url_for('bienvenida'))
+    return f"""
+<!DOCTYPE html>
+<html><head><title>Verificar OTP</title>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+</head>
+<body style="background:#01030a;color:white;text-align:center;padding:50px;font-family:sans-serif;">
+    <h2>🔐 Ingresar Código</h2>
+    <p>Código enviado a: <strong>{correo}</strong></p>
+    <p style="color:#f39c12;font-size:0.9em;">⏱️ Válido por 5 minutos • Máximo 3 intentos</p>
+    <form method="POST" action="/verificar-otp">
+        <input type="hidden" name="correo" value="{correo}">
+        <input type="text" name="codigo" required placeholder="Código de 6 dígitos" 
+               maxlength="6" pattern="[0-9]{{6}}" 
+               style="padding:10px;font-size:18px;text-align:center;letter-spacing:5px;width:200px;">
+        <br><br>
+        <button type="submit" style="padding:10px 20px;background:#2ecc71;color:#041428;border:none;border-radius:5px;font-weight:bold;">✅ Verificar</button>
+    </form>
+    <p><a href="/" style="color:#00ffff;text-decoration:none;">← Regresar</a></p>
+</body></html>
+"""
+
+
+@app.route('/verificar-otp', methods=['POST'])
+@csrf.exempt
+def verificar_otp():
+    correo = request.form.get('correo', '').strip()
+    codigo = request.form.get('codigo', '').strip()
+    
+    if not correo or not codigo:
+        return redirect(url_for('bienvenida'))
+    
+    resultado, dato = ALMACEN_OTP.verificar(correo, codigo)
+    
+    if resultado == 'ok':
+        session['traba'] = dato.strip()
+        session.permanent = True
+        app.logger.info(f"✅ Login exitoso para traba: {dato}")
+        return redirect(url_for('menu_principal'))
+    if resultado == 'expirado':
+        return '<script>alert("❌ Código expirado o inválido. Solicita uno nuevo."); window.location="/";</script>'
+    if resultado == 'agotado':
+        return '<script>alert("❌ Demasiados intentos. Solicita un nuevo código."); window.location="/";</script>'
+    return f'<script>alert("❌ Código incorrecto. Te quedan {dato} intento(s)."); window.history.back();</script>'
+
+
+@app.route('/registrar-traba', methods=['POST'])
+@csrf.exempt
+def registrar_traba():
+    nombre = request.form.get('nombre', '').strip()
+    apellido = request.form.get('apellido', '').strip()
+    traba = request.form.get('traba', '').strip()
+    correo = request.form.get('correo', '').strip().lower()
+    contraseña = request.form.get('contraseña', '')
+    
+    if not all([nombre, apellido, traba, correo, contraseña]):
+        return '<script>alert("❌ Todos los campos son obligatorios."); window.location="/";</script>'
+    
+    if len(contraseña) < 6:
+        return '<script>alert("❌ La contraseña debe tener al menos 6 caracteres."); window.location="/";</script>'
+    
+    permitido, espera = consumir_ficha(f"registro:{request.remote_addr}", REGISTRO_FICHAS_IP)
+    if not permitido:
+        return respuesta_limitada(espera)
+    
+    try:
+        contraseña_hash = en_cupo_hash(generate_password_hash, contraseña, HASH_METODO)
+    except TimeoutError:
+        return respuesta_ocupado()
+    nombre_completo = f"{nombre} {apellido}".strip()
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            INSERT INTO trabas (nombre_traba, nombre_completo, correo, contraseña_hash)
+            VALUES (?, ?, ?, ?)
+        ''', (traba, nombre_completo, correo, contraseña_hash))
+        conn.commit()
+        app.logger.info(f"✅ Nueva traba registrada: {traba} ({correo})")
+        return '<script>alert("✅ Registro exitoso. Ahora puedes iniciar sesión."); window.location="/";</script>'
+    except sqlite3.IntegrityError as e:
+        if "correo" in str(e).lower():
+            msg = "❌ El correo ya está registrado."
+        elif "nombre_traba" in str(e).lower() or "unique" in str(e).lower():
+            msg = "❌ El nombre de la traba ya existe."
+        else:
+            msg = "❌ Error en el registro. Intenta nuevamente."
+        app.logger.warning(f"⚠️ Error al registrar traba: {e}")
+        return f'<script>alert("{msg}"); window.location="/";</script>'
+
+
+@app.route('/iniciar-sesion', methods=['POST'])
 @csrf.exempt
 def iniciar_sesion():
     correo = request.form.get('correo', '').strip().lower()
@@ -451,16 +2025,38 @@ def iniciar_sesion():
     if not correo or not contraseña:
         return '<script>alert("❌ Correo y contraseña son obligatorios."); window.location="/";</script>'
     
-    conn = sqlite3.connect(DB)
+    # Primero la IP (frena barridos de muchos correos), luego el correo (frena adivinar una contraseña)
+    for clave, limite in ((f"login:ip:{request.remote_addr}", LOGIN_FICHAS_IP),
+                          (f"login:correo:{correo}", LOGIN_FICHAS_CORREO)):
+        permitido, espera = consumir_ficha(clave, limite)
+        if not permitido:
+            return respuesta_limitada(espera)
+    
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT nombre_traba, contraseña_hash FROM trabas WHERE correo = ?', (correo,))
     traba_row = cursor.fetchone()
-    conn.close()
     
-    if not traba_row or not check_password_hash(traba_row[1], contraseña):
+    try:
+        valida = bool(traba_row) and en_cupo_hash(check_password_hash, traba_row[1], contraseña)
+    except TimeoutError:
+        return respuesta_ocupado()
+    
+    if not valida:
         app.logger.warning(f"⚠️ Intento de login fallido para: {correo}")
         return '<script>alert("❌ Correo o contraseña incorrectos."); window.location="/";</script>'
     
+    # Rehash transparente: la contraseña en claro solo está disponible aquí
+    if necesita_rehash(traba_row[1]):
+        try:
+            nuevo_hash = en_cupo_hash(generate_password_hash, contraseña, HASH_METODO)
+            cursor.execute('UPDATE trabas SET contraseña_hash = ? WHERE correo = ? AND contraseña_hash = ?',
+                           (nuevo_hash, correo, traba_row[1]))
+            conn.commit()
+            app.logger.info(f"🔁 Hash de contraseña actualizado a {HASH_METODO} para: {correo}")
+        except TimeoutError:
+            pass  # Se reintenta en el próximo inicio de sesión
+    
     session['traba'] = traba_row[0].strip()
     session.permanent = True
     app.logger.info(f"✅ Login exitoso para: {correo}")
@@ -486,206 +2082,13 @@ def bienvenida():
         return redirect(url_for('menu_principal'))
     
     fecha_actual = datetime.now().strftime('%Y-%m-%d')
-    return f"""
-<!DOCTYPE html>
-<html lang="es">
-<head>
-<meta charset="UTF-8">
-<meta name="viewport" content="width=device-width, initial-scale=1.0">
-<title>GalloFino - Inicio</title>
-<style>
-@import url('https://fonts.googleapis.com/css2?family=Poppins:wght@300;500;700&display=swap');
-*{{margin:0; padding:0; box-sizing:border-box; font-family:'Poppins', sans-serif;}}
-body{{background:#01030a; color:white; font-size:17px;}}
-.container{{width:90%; max-width:500px; margin:50px auto; background:rgba(255,255,255,0.05); border-radius:20px; padding:30px; backdrop-filter:blur(8px); box-shadow:0 0 25px rgba(0,255,255,0.3);}}
-.logo{{width:80px; height:auto; filter:drop-shadow(0 0 6px #00ffff); float:right;}}
-h1{{font-size:2rem; color:#00ffff; text-shadow:0 0 12px #00ffff; margin-bottom:10px;}}
-.subtitle{{font-size:0.9rem; color:#bbb;}}
-.form-container input, .form-container button{{width:100%; padding:14px; margin:8px 0 15px; border-radius:10px; border:none; outline:none; font-size:17px;}}
-.form-container input{{background:rgba(255,255,255,0.08); color:white;}}
-.form-container button{{background:linear-gradient(135deg,#3498db,#2ecc71); color:#041428; font-weight:bold; cursor:pointer; transition:0.3s;}}
-.form-container button:hover{{transform:translateY(-3px); box-shadow:0 4px 15px rgba(0,255,255,0.4);}}
-canvas{{position:fixed; top:0; left:0; width:100%; height:100%; z-index:-1;}}
-.tabs{{display:flex; justify-content:space-around; margin-bottom:20px;}}
-.tab{{padding:8px 16px; cursor:pointer; background:rgba(0,255,255,0.1); border-radius:8px;}}
-.tab.active{{background:#00ffff; color:#041428; font-weight:bold;}}
-#registro-form, #login-form{{display:none;}}
-#registro-form.active{{display:block;}}
-#login-form.active{{display:block;}}
-</style>
-</head>
-<body>
-<canvas id="bg"></canvas>
-<div class="container">
-<img src="/logo" alt="Logo" class="logo">
-<h1>🐓 GalloFino</h1>
-<p class="subtitle">Sistema Profesional de Gestión Genética • Año 2026</p>
-<div class="tabs">
-  <div class="tab active" onclick="mostrar('registro')">✅ Registrarme</div>
-  <div class="tab" onclick="mostrar('login')">🔐 Iniciar Sesión</div>
-</div>
-<div id="registro-form" class="form-container active">
-<form method="POST" action="/registrar-traba">
-<input type="text" name="nombre" required placeholder="Nombre">
-<input type="text" name="apellido" required placeholder="Apellido">
-<input type="text" name="traba" required placeholder="Nombre de la Traba">
-<input type="email" name="correo" required placeholder="Correo Electrónico">
-<input type="password" name="contraseña" required placeholder="Contraseña (mín. 6 caracteres)" minlength="6">
-<input type="hidden" name="fecha" value="{fecha_actual}">
-<button type="submit">✅ Registrarme</button>
-</form>
-</div>
-<div id="login-form" class="form-container">
-<form method="POST" action="/iniciar-sesion">
-<input type="email" name="correo" required placeholder="Correo Electrónico">
-<input type="password" name="contraseña" required placeholder="Contraseña">
-<button type="submit">🔐 Iniciar Sesión</button>
-</form>
-</div>
-</div>
-<script>
-function mostrar(seccion) {{
-  document.querySelectorAll('.tab').forEach(t => t.classList.remove('active'));
-  document.querySelectorAll('.form-container').forEach(f => f.classList.remove('active'));
-  if (seccion === 'registro') {{
-    document.querySelectorAll('.tab')[0].classList.add('active');
-    document.getElementById('registro-form').classList.add('active');
-  }} else {{
-    document.querySelectorAll('.tab')[1].classList.add('active');
-    document.getElementById('login-form').classList.add('active');
-  }}
-}}
-// Animación de partículas de fondo
-const canvas = document.getElementById("bg");
-const ctx = canvas.getContext("2d");
-canvas.width = window.innerWidth;
-canvas.height = window.innerHeight;
-let particles = [];
-class Particle {{
-  constructor() {{
-    this.x = Math.random() * canvas.width;
-    this.y = Math.random() * canvas.height;
-    this.size = Math.random() * 2 + 1;
-    this.speedX = Math.random() - 0.5;
-    this.speedY = Math.random() - 0.5;
-  }}
-  update() {{
-    this.x += this.speedX; this.y += this.speedY;
-    if (this.x < 0) this.x = canvas.width;
-    if (this.x > canvas.width) this.x = 0;
-    if (this.y < 0) this.y = canvas.height;
-    if (this.y > canvas.height) this.y = 0;
-  }}
-  draw() {{
-    ctx.fillStyle = "rgba(0,255,255,0.7)";
-    ctx.beginPath(); ctx.arc(this.x, this.y, this.size, 0, Math.PI*2); ctx.fill();
-  }}
-}}
-function init() {{ for(let i=0;i<100;i++) particles.push(new Particle()); }}
-function animate() {{
-  ctx.clearRect(0,0,canvas.width,canvas.height);
-  particles.forEach(p=>{{p.update();p.draw();}});
-  requestAnimationFrame(animate);
-}}
-window.addEventListener("resize", ()=>{{canvas.width=window.innerWidth; canvas.height=window.innerHeight; init();}});
-init(); animate();
-
-// Indicador de carga en formularios
-document.querySelectorAll('form').forEach(form => {{
-    form.addEventListener('submit', function() {{
-        const btn = this.querySelector('button[type="submit"]');
-        if (btn) {{ btn.disabled = true; btn.textContent = '⏳ Procesando...'; }}
-    }});
-}});
-</script>
-</body>
-</html>
-"""
+    return render_template('bienvenida.html', fecha_actual=fecha_actual)
 
 
 @app.route('/menu')
 @proteger_ruta
 def menu_principal():
-    traba = session['traba']
-    return f"""
-<!DOCTYPE html>
-<html lang="es">
-<head>
-<meta charset="UTF-8">
-<meta name="viewport" content="width=device-width, initial-scale=1.0">
-<title>GalloFino - Menú</title>
-<style>
-@import url('https://fonts.googleapis.com/css2?family=Poppins:wght@300;500;700&display=swap');
-*{{margin:0; padding:0; box-sizing:border-box; font-family:'Poppins', sans-serif;}}
-body{{background:#01030a; color:white; font-size:17px; overflow-x:hidden;}}
-.container{{width:95%; max-width:900px; margin:40px auto; background:rgba(0,0,0,0.4); border-radius:20px; padding:25px; backdrop-filter:blur(10px); box-shadow:0 0 30px rgba(0,255,255,0.4); position:relative; z-index:2;}}
-.header-modern{{display:flex; justify-content:space-between; align-items:center; margin-bottom:30px; flex-wrap:wrap; gap:15px;}}
-.header-modern h1{{font-size:1.8rem; color:#00ffff; text-shadow:0 0 10px #00ffff;}}
-.subtitle{{font-size:0.85rem; color:#bbb;}}
-.logo{{width:80px; height:auto; filter:drop-shadow(0 0 6px #00ffff);}}
-#scene3d{{position:fixed; top:0; left:0; width:100%; height:100%; z-index:0; background:radial-gradient(ellipse at center,#000410 0%,#01030a 100%);}}
-#scene3d .layer{{position:absolute; top:0; left:0; width:200%; height:200%; background-repeat:no-repeat; background-size:400px; opacity:0.15; will-change:transform;}}
-#scene3d .layer-1{{background:radial-gradient(circle,#00ffff 2px,transparent 2px); animation:float 25s infinite linear;}}
-#scene3d .layer-2{{background:radial-gradient(circle,#ff7a18 1.5px,transparent 1.5px); animation:float 35s infinite linear reverse; opacity:0.1;}}
-#scene3d .layer-3{{background:radial-gradient(circle,#f6c84c 1px,transparent 1px); animation:float 20s infinite linear; opacity:0.07;}}
-@keyframes float{{0%{{transform:translate(0,0) rotate(0deg);}}100%{{transform:translate(-25%,-25%) rotate(360deg);}}}}
-.content-wrapper{{position:relative; z-index:3;}}
-.card{{background:rgba(255,255,255,0.06); border-radius:20px; padding:25px; backdrop-filter:blur(10px); box-shadow:0 0 30px rgba(0,255,255,0.4);}}
-.menu-grid{{display:grid; grid-template-columns:repeat(auto-fit,minmax(200px,1fr)); gap:15px; margin:20px 0;}}
-.menu-btn{{display:block; width:100%; padding:16px; text-align:center; border-radius:10px; background:linear-gradient(135deg,#f6c84c,#ff7a18); color:#041428; font-weight:bold; text-decoration:none; transition:0.3s; font-size:17px;}}
-.menu-btn:hover{{transform:translateY(-3px); box-shadow:0 6px 20px rgba(0,255,255,0.5);}}
-</style>
-</head>
-<body>
-<div id="scene3d">
-    <div class="layer layer-1"></div>
-    <div class="layer layer-2"></div>
-    <div class="layer layer-3"></div>
-</div>
-<div class="content-wrapper">
-    <div class="container">
-        <div class="header-modern">
-            <div><h1>🐓 Traba: {traba}</h1><p class="subtitle">Sistema moderno • Año 2026</p></div>
-            <img src="/logo" alt="Logo" class="logo">
-        </div>
-        <div class="card">
-            <div class="menu-grid">
-                <a href="/formulario-gallo" class="menu-btn">🐓 Registrar Gallo</a>
-                <a href="/cruce-inbreeding" class="menu-btn">🔁 Cruce Inbreeding</a>
-                <a href="/lista" class="menu-btn">📋 Mis Gallos</a>
-                <a href="/buscar" class="menu-btn">🔍 Buscar</a>
-                <a href="/exportar" class="menu-btn">📤 Exportar</a>
-                <a href="javascript:void(0);" class="menu-btn" onclick="crearBackup()">💾 Respaldo</a>
-                <a href="/cerrar-sesion" class="menu-btn" style="background:linear-gradient(135deg,#7f8c8d,#95a5a6);">🚪 Cerrar Sesión</a>
-            </div>
-        </div>
-    </div>
-</div>
-<div id="mensaje-backup" style="text-align:center; margin-top:15px; color:#27ae60; font-weight:bold;"></div>
-<script>
-function crearBackup() {{
-    const btn = event.target;
-    btn.disabled = true; btn.textContent = '⏳ Creando...';
-    fetch("/backup", {{method: "POST"}})
-        .then(r => r.json())
-        .then(d => {{
-            if (d.error) {{
-                document.getElementById("mensaje-backup").innerHTML = `<span style="color:#e74c3c;">❌ ${{d.error}}</span>`;
-            }} else {{
-                document.getElementById("mensaje-backup").innerHTML = `<span style="color:#27ae60;">${{d.mensaje}}</span>`;
-                window.location.href = "/download/" + d.archivo;
-            }}
-            btn.disabled = false; btn.textContent = '💾 Respaldo';
-        }})
-        .catch(e => {{
-            document.getElementById("mensaje-backup").innerHTML = `<span style="color:#e74c3c;">❌ Error de red</span>`;
-            btn.disabled = false; btn.textContent = '💾 Respaldo';
-        }});
-}}
-</script>
-</body>
-</html>
-"""
+    return render_template('menu.html', traba=session['traba'])
 
 
 # =============================================================================
@@ -695,75 +2098,7 @@ function crearBackup() {{
 @app.route('/formulario-gallo')
 @proteger_ruta
 def formulario_gallo():
-    traba = session['traba']
-    razas_html = ''.join([f'<option value="{r}">{r}</option>' for r in RAZAS])
-    ap_html = ''.join([
-        f'<label style="display:inline-block; margin-right:15px;"><input type="radio" name="gallo_apariencia" value="{a}" required> {a}</label>'
-        for a in APARIENCIAS
-    ])
-    return f"""
-<!DOCTYPE html>
-<html lang="es">
-<head>
-<meta charset="UTF-8">
-<meta name="viewport" content="width=device-width, initial-scale=1.0">
-<title>Registrar Gallo</title>
-<style>
-@import url('https://fonts.googleapis.com/css2?family=Poppins:wght@300;500;700&display=swap');
-*{{margin:0; padding:0; box-sizing:border-box; font-family:'Poppins', sans-serif;}}
-body{{background:#01030a; color:white; overflow-x:hidden; font-size:17px;}}
-.container{{width:95%; max-width:800px; margin:30px auto; padding:20px;}}
-.header-modern{{display:flex; justify-content:space-between; align-items:center; margin-bottom:25px; flex-wrap:wrap; gap:15px;}}
-.header-modern h1{{font-size:1.8rem; color:#00ffff; text-shadow:0 0 10px #00ffff;}}
-.subtitle{{font-size:0.85rem; color:#bbb;}}
-.logo{{width:80px; height:auto; filter:drop-shadow(0 0 6px #00ffff);}}
-.form-container{{background:rgba(255,255,255,0.06); border-radius:20px; padding:25px; backdrop-filter:blur(10px); box-shadow:0 0 30px rgba(0,255,255,0.4);}}
-label{{display:block; margin:12px 0 6px; font-weight:500;}}
-input, select{{width:100%; padding:10px; margin:5px 0; background:rgba(0,0,0,0.3); color:white; border:none; border-radius:6px; font-size:16px;}}
-.btn-ghost{{background:rgba(0,0,0,0.3); border:1px solid rgba(0,255,255,0.2); color:white; padding:10px; border-radius:8px; width:100%; margin:6px 0; font-size:16px;}}
-button{{width:100%; padding:16px; border:none; border-radius:10px; background:linear-gradient(135deg,#00ffff,#008cff); color:#041428; font-size:1.2rem; font-weight:bold; cursor:pointer; transition:0.3s; margin-top:15px;}}
-button:hover{{transform:translateY(-3px); box-shadow:0 6px 20px rgba(0,255,255,0.5);}}
-button:disabled{{opacity:0.6; cursor:not-allowed; transform:none;}}
-.back-btn{{display:inline-block; margin-top:20px; padding:10px 20px; background:#2c3e50; color:white; text-decoration:none; border-radius:6px; text-align:center;}}
-</style>
-</head>
-<body>
-<div class="container">
-<div class="header-modern">
-<div><h1>🐓 Traba: {traba}</h1><p class="subtitle">Sistema moderno • Año 2026</p></div>
-<img src="/logo" alt="Logo" class="logo">
-</div>
-<form method="POST" action="/registrar-gallo" enctype="multipart/form-data" class="form-container">
-    <h3 style="text-align:center; color:#2980b9; margin-bottom:20px;">A. Registrar Gallo Principal</h3>
-    <label>Placa de Traba *</label>
-    <input type="text" name="gallo_placa_traba" required class="btn-ghost">
-    <label>Placa Regional (opcional)</label>
-    <input type="text" name="gallo_placa_regional" class="btn-ghost">
-    <label>N° Pelea (opcional)</label>
-    <input type="text" name="gallo_n_pelea" class="btn-ghost">
-    <label>Nombre del ejemplar (opcional)</label>
-    <input type="text" name="gallo_nombre" class="btn-ghost">
-    <label>Raza *</label>
-    <select name="gallo_raza" required class="btn-ghost">{razas_html}</select>
-    <label>Color *</label>
-    <input type="text" name="gallo_color" required class="btn-ghost">
-    <label>Apariencia *</label>
-    <div style="margin:5px 0; font-size:16px;">{ap_html}</div>
-    <label>Foto (opcional - PNG, JPG, JPEG, GIF)</label>
-    <input type="file" name="gallo_foto" accept="image/*" class="btn-ghost">
-    <button type="submit">✅ Registrar Gallo</button>
-    <a href="/menu" class="back-btn">🏠 Regresar al Menú</a>
-</form>
-</div>
-<script>
-document.querySelector('form').addEventListener('submit', function() {{
-    const btn = this.querySelector('button[type="submit"]');
-    if (btn) {{ btn.disabled = true; btn.textContent = '⏳ Registrando...'; }}
-}});
-</script>
-</body>
-</html>
-"""
+    return render_template('formulario_gallo.html', traba=session['traba'])
 
 
 @app.route('/registrar-gallo', methods=['POST'])
@@ -771,10 +2106,9 @@ document.querySelector('form').addEventListener('submit', function() {{
 @csrf.exempt
 def registrar_gallo():
     traba = session['traba']
-    conn = sqlite3.connect(DB)
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
+    foto = None
     
     try:
         placa = request.form.get('gallo_placa_traba', '').strip()
@@ -797,20 +2131,17 @@ def registrar_gallo():
             raise ValueError("Raza, color y apariencia son obligatorios.")
         
         # Procesar foto
-        foto = None
         if 'gallo_foto' in request.files:
             file = request.files['gallo_foto']
             if file and file.filename != '' and allowed_file(file.filename):
                 if is_valid_image(file.stream):
                     safe_placa = secure_filename(placa)
                     fname = f"{safe_placa}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{secure_filename(file.filename)}"
-                    ruta_destino = os.path.join(app.config['UPLOAD_FOLDER'], fname)
-                    file.save(ruta_destino)
-                    foto = fname
+                    foto = guardar_subida(file, fname)
                 else:
                     app.logger.warning(f"⚠️ Archivo de imagen inválido: {file.filename}")
         
-        codigo = generar_codigo_unico(cursor)
+        codigo = reservar_codigos(cursor)[0]
         
         cursor.execute('''
             INSERT INTO individuos 
@@ -819,6 +2150,9 @@ def registrar_gallo():
         ''', (traba, placa, placa_regional, nombre, raza, color, apariencia, n_pelea, None, foto, 1, codigo))
         
         conn.commit()
+        if foto:
+            encolar_foto(foto)
+        invalidar_autocompletar(traba)
         app.logger.info(f"✅ Gallo registrado: {placa} (Traba: {traba})")
         
         return f'''
@@ -837,6 +2171,8 @@ def registrar_gallo():
         '''
         
     except ValueError as e:
+        if foto:
+            descartar_subida(foto)
         app.logger.warning(f"⚠️ Error de validación: {e}")
         return f'''
         <!DOCTYPE html>
@@ -850,6 +2186,8 @@ def registrar_gallo():
         '''
     except Exception as e:
         conn.rollback()
+        if foto:
+            descartar_subida(foto)
         app.logger.error(f"❌ Error crítico al registrar gallo: {e}", exc_info=True)
         return f'''
         <!DOCTYPE html>
@@ -861,8 +2199,6 @@ def registrar_gallo():
         </div>
         </body></html>
         '''
-    finally:
-        conn.close()
 
 
 # =============================================================================
@@ -888,11 +2224,36 @@ a { display:inline-block; margin-top:20px; color:#00ffff; text-decoration:none;
 <body>
 <h2 style="color:#00ffff;">🔍 Buscar Gallo</h2>
 <form method="POST">
-    <input type="text" name="termino" placeholder="Placa, nombre o color" required minlength="2">
+    <input type="text" name="termino" placeholder="Placa, nombre, color, raza o código" required minlength="2" list="sugerencias" autocomplete="off">
+    <datalist id="sugerencias"></datalist>
     <br>
     <button type="submit">🔎 Buscar</button>
 </form>
 <a href="/menu">🏠 Menú</a>
+<script>
+const input = document.querySelector('input[name="termino"]');
+const lista = document.getElementById('sugerencias');
+let temporizador = null;
+input.addEventListener('input', () => {
+    clearTimeout(temporizador);
+    const q = input.value.trim();
+    if (q.length < 2) return;
+    temporizador = setTimeout(() => {
+        fetch('/api/autocompletar?q=' + encodeURIComponent(q))
+            .then(r => r.json())
+            .then(datos => {
+                lista.innerHTML = '';
+                datos.forEach(s => {
+                    const opt = document.createElement('option');
+                    opt.value = s.placa;
+                    opt.label = s.nombre || s.placa;
+                    lista.appendChild(opt);
+                });
+            })
+            .catch(() => {});
+    }, 150);
+});
+</script>
 </body></html>
 '''
     
@@ -901,8 +2262,7 @@ a { display:inline-block; margin-top:20px; color:#00ffff; text-decoration:none;
         return '<script>alert("❌ Ingresa al menos 2 caracteres para buscar."); window.location="/buscar";</script>'
     
     traba = session['traba']
-    conn = sqlite3.connect(DB)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     # 1. Buscar coincidencia exacta por placa_traba
@@ -919,81 +2279,18 @@ a { display:inline-block; margin-top:20px; color:#00ffff; text-decoration:none;
     if len(por_placa) == 1:
         gallo_principal = por_placa[0]
     elif len(por_placa) > 1:
-        filas = "".join(f'''
-            <tr onclick="window.location='/arbol/{r['id']}'" style="cursor:pointer;">
-                <td style="padding:8px;">{"<img src='/uploads/%s' width='40' style='border-radius:4px;'>" % r["foto"] if r["foto"] else "—"}</td>
-                <td style="padding:8px;">{r['placa_traba']}</td>
-                <td style="padding:8px;">{r['nombre'] or "—"}</td>
-                <td style="padding:8px;">{r['color']}</td>
-                <td style="padding:8px;">{r['raza']}</td>
-            </tr>
-        ''' for r in por_placa)
-        conn.close()
-        return f'''
-<!DOCTYPE html>
-<html><head><title>Varios Resultados</title></head>
-<body style="background:#01030a;color:white;padding:20px;font-family:sans-serif;">
-<h2 style="text-align:center;color:#ff9900;">⚠️ {len(por_placa)} gallos con placa: "{termino}"</h2>
-<p style="text-align:center;">Haz clic en una fila para ver su árbol genealógico.</p>
-<table style="width:100%;max-width:700px;margin:0 auto;border-collapse:collapse;background:rgba(0,0,0,0.2);border-radius:10px;overflow:hidden;">
-    <thead><tr style="color:#00ffff;background:rgba(0,255,255,0.1);">
-        <th style="padding:10px;">Foto</th><th>Placa</th><th>Nombre</th><th>Color</th><th>Raza</th>
-    </tr></thead>
-    <tbody>{filas}</tbody>
-</table>
-<div style="text-align:center;margin-top:25px;">
-    <a href="/buscar" style="padding:10px 20px;background:#2ecc71;color:#041428;text-decoration:none;border-radius:6px;">← Nueva búsqueda</a>
-    <a href="/menu" style="padding:10px 20px;background:#7f8c8d;color:white;text-decoration:none;border-radius:6px;margin-left:10px;">🏠 Menú</a>
-</div>
-</body></html>
-'''
-    else:
-        # Buscar por nombre o color (LIKE)
-        cursor.execute('''
-            SELECT i.id, i.placa_traba, i.placa_regional, i.nombre, i.raza, i.color, i.apariencia, i.n_pelea, i.foto,
-                   pr.madre_id, pr.padre_id
-            FROM individuos i
-            LEFT JOIN progenitores pr ON i.id = pr.individuo_id
-            WHERE (i.nombre LIKE ? OR i.color LIKE ?) AND i.traba = ?
-            ORDER BY i.placa_traba
-        ''', (f'%{termino}%', f'%{termino}%', traba))
-        
-        resultados = cursor.fetchall()
-        
-        if not resultados:
-            conn.close()
-            return '<script>alert("❌ No se encontró ningún gallo con esos criterios."); window.location="/buscar";</script>'
-        elif len(resultados) == 1:
-            gallo_principal = resultados[0]
-        else:
-            filas = "".join(f'''
-                <tr onclick="window.location='/arbol/{r['id']}'" style="cursor:pointer;">
-                    <td style="padding:8px;">{"<img src='/uploads/%s' width='40' style='border-radius:4px;'>" % r["foto"] if r["foto"] else "—"}</td>
-                    <td style="padding:8px;">{r['placa_traba']}</td>
-                    <td style="padding:8px;">{r['nombre'] or "—"}</td>
-                    <td style="padding:8px;">{r['color']}</td>
-                    <td style="padding:8px;">{r['raza']}</td>
-                </tr>
-            ''' for r in resultados)
-            conn.close()
-            return f'''
-<!DOCTYPE html>
-<html><head><title>Varios Resultados</title></head>
-<body style="background:#01030a;color:white;padding:20px;font-family:sans-serif;">
-<h2 style="text-align:center;color:#00ffff;">🔍 {len(resultados)} gallos encontrados</h2>
-<p style="text-align:center;">Haz clic en una fila para ver su árbol genealógico.</p>
-<table style="width:100%;max-width:700px;margin:0 auto;border-collapse:collapse;background:rgba(0,0,0,0.2);border-radius:10px;overflow:hidden;">
-    <thead><tr style="color:#00ffff;background:rgba(0,255,255,0.1);">
-        <th style="padding:10px;">Foto</th><th>Placa</th><th>Nombre</th><th>Color</th><th>Raza</th>
-    </tr></thead>
-    <tbody>{filas}</tbody>
-</table>
-<div style="text-align:center;margin-top:25px;">
-    <a href="/buscar" style="padding:10px 20px;background:#2ecc71;color:#041428;text-decoration:none;border-radius:6px;">← Nueva búsqueda</a>
-    <a href="/menu" style="padding:10px 20px;background:#7f8c8d;color:white;text-decoration:none;border-radius:6px;margin-left:10px;">🏠 Menú</a>
-</div>
-</body></html>
-'''
+        return respuesta_streaming(generar_tabla_resultados(f'⚠️ {len(por_placa)} gallos con placa: "{termino}"', '#ff9900', por_placa))
+    else:
+        # Búsqueda por relevancia (FTS5) en placa, regional, nombre, color, raza y código
+        resultados = buscar_individuos(cursor, traba, termino)
+        primeras = resultados.fetchmany(2)
+        
+        if not primeras:
+            return '<script>alert("❌ No se encontró ningún gallo con esos criterios."); window.location="/buscar";</script>'
+        elif len(primeras) == 1:
+            gallo_principal = primeras[0]
+        else:
+            return respuesta_streaming(generar_tabla_resultados('🔍 Gallos encontrados', '#00ffff', itertools.chain(primeras, resultados)))
     
     # === Mostrar detalle de un solo gallo ===
     madre = padre = None
@@ -1017,7 +2314,7 @@ a { display:inline-block; margin-top:20px; color:#00ffff; text-decoration:none;
                 <h3 style="color:#00ffff;">{emoji} {titulo}</h3>
                 <p style="color:#bbb;">— No registrado —</p></div>'''
         nombre = g['nombre'] or g['placa_traba']
-        foto_html = f'<img src="/uploads/{g["foto"]}" width="120" style="border-radius:10px;margin-bottom:15px;">' if g['foto'] else '<div style="width:120px;height:120px;background:rgba(0,0,0,0.3);border-radius:10px;margin:0 auto 15px;display:flex;align-items:center;justify-content:center;color:#aaa;">Sin Foto</div>'
+        foto_html = f'<a href="{url_foto(g["foto"], 800)}"><img src="{url_foto(g["foto"], 160)}" width="120" style="border-radius:10px;margin-bottom:15px;"></a>' if g['foto'] else '<div style="width:120px;height:120px;background:rgba(0,0,0,0.3);border-radius:10px;margin:0 auto 15px;display:flex;align-items:center;justify-content:center;color:#aaa;">Sin Foto</div>'
         return f'''
         <div style="background:rgba(0,0,0,0.2);padding:20px;margin:20px 0;border-radius:15px;text-align:center;">
             <h3 style="color:#00ffff;margin-bottom:15px;">{emoji} {titulo}</h3>
@@ -1033,13 +2330,13 @@ a { display:inline-block; margin-top:20px; color:#00ffff; text-decoration:none;
     
     def tarjeta_hijo(h):
         nombre = h['nombre'] or h['placa_traba']
-        foto_html = f'<img src="/uploads/{h["foto"]}" width="80" style="border-radius:8px;margin-bottom:10px;">' if h["foto"] else '<div style="width:80px;height:80px;background:rgba(0,0,0,0.3);border-radius:8px;display:flex;align-items:center;justify-content:center;color:#aaa;font-size:0.8em;">Sin foto</div>'
+        foto_html = f'<img src="{url_foto(h["foto"], 160)}" width="80" style="border-radius:8px;margin-bottom:10px;">' if h["foto"] else '<div style="width:80px;height:80px;background:rgba(0,0,0,0.3);border-radius:8px;display:flex;align-items:center;justify-content:center;color:#aaa;font-size:0.8em;">Sin foto</div>'
         return f'''<div style="background:rgba(0,0,0,0.2);padding:15px;margin:10px 0;border-radius:8px;text-align:center;">
             {foto_html}<p style="margin:5px 0;"><strong>{nombre}</strong></p>
             <p style="font-size:0.9em;">Placa: {h['placa_traba']}</p>
             <p style="font-size:0.8em;color:#bdc3c7;">Raza: {h['raza']}</p></div>'''
     
-    caracteristica = generar_caracteristica(gallo_principal['id'], traba)
+    caracteristica = calcular_caracteristicas(cursor, traba, [gallo_principal['id']]).get(gallo_principal['id'], "—")
     
     resultado_html = tarjeta_gallo(gallo_principal, "Gallo Encontrado", "✅")
     resultado_html += f'<div style="background:rgba(0,0,0,0.2);padding:15px;margin:15px 0;border-radius:10px;text-align:center;"><strong>Característica clave:</strong><br><span style="color:#00ffff;">{caracteristica}</span></div>'
@@ -1057,7 +2354,6 @@ a { display:inline-block; margin-top:20px; color:#00ffff; text-decoration:none;
         <a href="/menu" style="padding:12px 20px;background:#7f8c8d;color:white;text-decoration:none;border-radius:8px;">🏠 Menú</a>
     </div>'''
     
-    conn.close()
     
     return f'''
 <!DOCTYPE html>
@@ -1070,33 +2366,40 @@ a { display:inline-block; margin-top:20px; color:#00ffff; text-decoration:none;
 '''
 
 
+@app.route('/api/autocompletar')
+@proteger_ruta
+def api_autocompletar():
+    """Sugerencias de gallos por placa/nombre para formularios (typeahead)"""
+    termino = request.args.get('q', '').strip()
+    if not termino:
+        return jsonify([])
+    try:
+        limite = max(1, min(int(request.args.get('n', AUTOCOMPLETAR_LIMITE)), 20))
+    except ValueError:
+        limite = AUTOCOMPLETAR_LIMITE
+    return jsonify(autocompletar(get_db().cursor(), session['traba'], termino, limite))
+
+
 @app.route('/lista')
 @proteger_ruta
 def lista_gallos():
     traba = session['traba']
-    conn = sqlite3.connect(DB)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    cursor = get_db().cursor()
     
-    cursor.execute('''
-        SELECT i.id, i.placa_traba, i.placa_regional, i.nombre, i.raza, i.color, i.apariencia, i.n_pelea, i.foto, i.generacion, i.codigo,
-               m.placa_traba as madre_placa, p.placa_traba as padre_placa
-        FROM individuos i
-        LEFT JOIN progenitores pr ON i.id = pr.individuo_id
-        LEFT JOIN individuos m ON pr.madre_id = m.id
-        LEFT JOIN individuos p ON pr.padre_id = p.id
-        WHERE i.traba = ? 
-        ORDER BY i.id DESC
-    ''', (traba,))
+    filtros = leer_filtros_lista(request.args)
+    orden = request.args.get('orden', 'id') if request.args.get('orden') in ORDENES_LISTA else 'id'
+    descendente = request.args.get('dir', 'desc') != 'asc'
+    try:
+        por_pagina = max(1, min(int(request.args.get('n', LISTA_POR_PAGINA)), LISTA_POR_PAGINA_MAX))
+    except ValueError:
+        por_pagina = LISTA_POR_PAGINA
+    despues = decodificar_cursor(request.args.get('despues'))
     
-    gallos = cursor.fetchall()
-    conn.close()
+    facetas, total = contar_facetas(cursor, traba, filtros)
     
-    filas_html = ""
-    for g in gallos:
-        foto_html = f'<img src="/uploads/{g["foto"]}" width="50" style="border-radius:4px;">' if g["foto"] else "—"
-        car = generar_caracteristica(g['id'], traba)
-        filas_html += f'''
+    def fila_html(g, car):
+        foto_html = f'<img src="{url_foto(g["foto"], 64)}" width="50" style="border-radius:4px;">' if g["foto"] else "—"
+        return f'''
         <tr>
             <td style="padding:8px;text-align:center;">{foto_html}</td>
             <td style="padding:8px;">{g['placa_traba']}</td>
@@ -1110,6 +2413,7 @@ def lista_gallos():
             <td style="padding:8px;">{g['padre_placa'] or "—"}</td>
             <td style="padding:8px;">{g['codigo'] or "—"}</td>
             <td style="padding:8px;">{g['generacion'] or 1}</td>
+            <td style="padding:8px;font-size:0.9em;">{car}</td>
             <td style="padding:8px;text-align:center;">
                 <a href="/editar-gallo/{g['id']}" style="padding:6px 12px;background:#f39c12;color:black;text-decoration:none;border-radius:4px;margin-right:6px;">✏️</a>
                 <a href="/arbol/{g['id']}" style="padding:6px 12px;background:#00ffff;color:#041428;text-decoration:none;border-radius:4px;margin-right:6px;">🌳</a>
@@ -1117,7 +2421,17 @@ def lista_gallos():
             </td>
         </tr>'''
     
-    return f'''
+    # Controles de filtro con sus conteos
+    def opciones(campo):
+        return ''.join(
+            f'<option value="{valor}" {"selected" if filtros.get(campo) == valor else ""}>{valor} ({n})</option>'
+            for valor, n in facetas[campo]
+        )
+    
+    params_base = {**filtros, 'orden': orden, 'dir': 'desc' if descendente else 'asc', 'n': por_pagina}
+    
+    def generar():
+        yield f'''
 <!DOCTYPE html>
 <html><head><title>Mis Gallos</title>
 <meta name="viewport" content="width=device-width, initial-scale=1">
@@ -1130,23 +2444,59 @@ th{{background:rgba(0,255,255,0.1);color:#00ffff;}}
 tr:hover{{background:rgba(0,255,255,0.05);}}
 a{{text-decoration:none;}}
 .back-btn{{display:inline-block;margin:20px 0;padding:10px 20px;background:#2c3e50;color:white;text-decoration:none;border-radius:6px;}}
+.filtros{{display:flex;gap:10px;flex-wrap:wrap;align-items:center;margin-bottom:15px;}}
+.filtros select,.filtros button{{padding:8px;background:rgba(0,0,0,0.3);color:white;border:1px solid #00ffff;border-radius:6px;}}
 @media(max-width:768px){{table{{font-size:14px;}}td,th{{padding:6px;}}}}
 </style>
 </head>
 <body>
 <h2>📋 Mis Gallos - Traba: {traba}</h2>
 <a href="/menu" class="back-btn">🏠 Menú</a>
+<form method="GET" class="filtros">
+    <select name="raza"><option value="">Raza: todas</option>{opciones('raza')}</select>
+    <select name="apariencia"><option value="">Apariencia: todas</option>{opciones('apariencia')}</select>
+    <select name="color"><option value="">Color: todos</option>{opciones('color')}</select>
+    <select name="generacion"><option value="">Generación: todas</option>{opciones('generacion')}</select>
+    <select name="orden"><option value="id">Orden: registro</option><option value="placa" {"selected" if orden == "placa" else ""}>Orden: placa</option></select>
+    <select name="dir"><option value="desc">Descendente</option><option value="asc" {"selected" if not descendente else ""}>Ascendente</option></select>
+    <select name="n">{''.join(f'<option value="{n}" {"selected" if n == por_pagina else ""}>{n} por página</option>' for n in (25, 50, 100, 200))}</select>
+    <button type="submit">🔎 Filtrar</button>
+    <span style="color:#bbb;">{total} gallo(s)</span>
+</form>
 <div style="overflow-x:auto;">
 <table>
 <thead><tr>
 <th>Foto</th><th>Placa</th><th>Placa_reg</th><th>Nombre</th><th>Raza</th><th>Color</th>
-<th>Apariencia</th><th>N°Pelea</th><th>Madre</th><th>Padre</th><th>Código</th><th>Gen</th><th>Acciones</th>
+<th>Apariencia</th><th>N°Pelea</th><th>Madre</th><th>Padre</th><th>Código</th><th>Gen</th><th>Característica</th><th>Acciones</th>
 </tr></thead>
-<tbody>{filas_html}</tbody>
+<tbody>'''
+        
+        # Filas leídas del cursor por lotes; las características se calculan por lote con otro cursor
+        filas = consultar_pagina_gallos(cursor, traba, filtros, orden, descendente, por_pagina, despues)
+        lectura = get_db().cursor()
+        mostradas, ultima, siguiente = 0, None, None
+        for lote in iterar_lotes(filas):
+            if mostradas + len(lote) > por_pagina:
+                lote = lote[:por_pagina - mostradas]
+                siguiente = cursor_siguiente(lote[-1] if lote else ultima, orden)
+            if lote:
+                caracteristicas = calcular_caracteristicas(lectura, traba, [g['id'] for g in lote])
+                yield ''.join(fila_html(g, caracteristicas.get(g['id'], "—")) for g in lote)
+                mostradas += len(lote)
+                ultima = lote[-1]
+            if siguiente:
+                break
+        
+        enlace_primera = f'<a href="/lista?{urlencode(params_base)}" class="back-btn">⏮️ Primera página</a>' if despues else ''
+        enlace_siguiente = f'<a href="/lista?{urlencode({**params_base, "despues": siguiente})}" class="back-btn">Siguiente ▶️</a>' if siguiente else ''
+        yield f'''</tbody>
 </table>
 </div>
+<div style="text-align:center;">{enlace_primera} {enlace_siguiente}</div>
 </body></html>
 '''
+    
+    return respuesta_streaming(generar())
 
 
 # =============================================================================
@@ -1156,135 +2506,7 @@ a{{text-decoration:none;}}
 @app.route('/cruce-inbreeding')
 @proteger_ruta
 def cruce_inbreeding():
-    traba = session['traba']
-    razas_html = ''.join([f'<option value="{r}">{r}</option>' for r in RAZAS])
-    apariencias_html = ''.join([f'<option value="{a}">{a}</option>' for a in APARIENCIAS])
-    
-    return f'''
-<!DOCTYPE html>
-<html lang="es">
-<head>
-<meta charset="UTF-8">
-<meta name="viewport" content="width=device-width, initial-scale=1.0">
-<title>Cruce Inbreeding</title>
-<style>
-@import url('https://fonts.googleapis.com/css2?family=Poppins:wght@300;500;700&display=swap');
-*{{margin:0;padding:0;box-sizing:border-box;font-family:'Poppins',sans-serif;}}
-body{{background:#01030a;color:white;font-size:16px;padding:20px;}}
-.container{{max-width:700px;margin:0 auto;background:rgba(255,255,255,0.05);border-radius:12px;padding:20px;}}
-h2{{color:#00ffff;text-align:center;margin:0 0 20px;}}
-.section{{margin:20px 0;padding:15px;background:rgba(0,0,0,0.2);border-radius:8px;}}
-h3{{color:#00ffff;margin-bottom:12px;font-size:1.1em;}}
-.field{{margin:8px 0;}}
-label{{display:block;margin-bottom:4px;font-weight:500;}}
-input,select,textarea{{width:100%;padding:8px;background:rgba(0,0,0,0.3);color:white;border:1px solid #00ffff;border-radius:4px;}}
-.btn-submit{{width:100%;padding:12px;background:linear-gradient(135deg,#e74c3c,#e67e22);color:#041428;border:none;border-radius:6px;font-weight:bold;margin-top:15px;cursor:pointer;}}
-.btn-submit:disabled{{opacity:0.6;cursor:not-allowed;}}
-.btn-menu{{display:inline-block;margin-top:20px;padding:10px 20px;background:#7f8c8d;color:white;text-decoration:none;border-radius:6px;font-size:16px;}}
-#descripcion-cruce{{background:rgba(0,255,255,0.1);padding:15px;border-radius:8px;margin:15px 0;border-left:5px solid #00ffff;min-height:50px;}}
-</style>
-</head>
-<body>
-<div class="container">
-<img src="/logo" alt="Logo" style="width:50px;float:right;filter:drop-shadow(0 0 4px #00ffff);">
-<h2>🔁 Registro de Cruce Inbreeding</h2>
-
-<form method="POST" action="/registrar-cruce" enctype="multipart/form-data">
-
-<label for="tipo">Tipo de Cruce *</label>
-<select name="tipo" id="tipo" required>
-<option value="">-- Selecciona --</option>
-<option value="Padre-Hija" data-ej1="Padre" data-ej2="Hija" data-estrategia="vertical">Padre - Hija</option>
-<option value="Madre-Hijo" data-ej1="Madre" data-ej2="Hijo" data-estrategia="vertical">Madre - Hijo</option>
-<option value="Abuelo-Nieta" data-ej1="Abuelo" data-ej2="Nieta" data-estrategia="vertical">Abuelo - Nieta</option>
-<option value="Hermanos" data-ej1="Hermano A" data-ej2="Hermano B" data-estrategia="horizontal">Hermanos (Completos)</option>
-<option value="MediosHermanos" data-ej1="Ejemplar 1" data-ej2="Ejemplar 2" data-estrategia="line">Medios Hermanos</option>
-<option value="Tio-Sobrina" data-ej1="Tío" data-ej2="Sobrina" data-estrategia="line">Tío - Sobrina / Primo</option>
-</select>
-
-<div id="descripcion-cruce"><p>Selecciona un tipo de cruce para ver la estrategia asociada.</p></div>
-
-<div class="section">
-<h3 id="titulo1">🐔 Ejemplar 1</h3>
-<div class="field"><label>Número de Placa *</label><input type="text" name="placa1" required></div>
-<div class="field"><label>Placa Regional</label><input type="text" name="regional1"></div>
-<div class="field"><label>N° Pelea</label><input type="text" name="pelea1"></div>
-<div class="field"><label>Nombre</label><input type="text" name="nombre1"></div>
-<div class="field"><label>Raza *</label><select name="raza1" required>{razas_html}</select></div>
-<div class="field"><label>Color *</label><input type="text" name="color1" required></div>
-<div class="field"><label>Apariencia *</label><select name="apariencia1" required>{apariencias_html}</select></div>
-<div class="field"><label>Foto (opcional)</label><input type="file" name="foto1" accept="image/*"></div>
-</div>
-
-<div class="section">
-<h3 id="titulo2">🐔 Ejemplar 2</h3>
-<div class="field"><label>Número de Placa *</label><input type="text" name="placa2" required></div>
-<div class="field"><label>Placa Regional</label><input type="text" name="regional2"></div>
-<div class="field"><label>N° Pelea</label><input type="text" name="pelea2"></div>
-<div class="field"><label>Nombre</label><input type="text" name="nombre2"></div>
-<div class="field"><label>Raza *</label><select name="raza2" required>{razas_html}</select></div>
-<div class="field"><label>Color *</label><input type="text" name="color2" required></div>
-<div class="field"><label>Apariencia *</label><select name="apariencia2" required>{apariencias_html}</select></div>
-<div class="field"><label>Foto (opcional)</label><input type="file" name="foto2" accept="image/*"></div>
-</div>
-
-<button type="submit" class="btn-submit">✅ Registrar Cruce</button>
-</form>
-<a href="/menu" class="btn-menu">🏠 Menú</a>
-</div>
-
-<script>
-document.addEventListener('DOMContentLoaded', function() {{
-    const selectTipo = document.getElementById('tipo');
-    const descripcionDiv = document.getElementById('descripcion-cruce');
-    const titulo1 = document.getElementById('titulo1');
-    const titulo2 = document.getElementById('titulo2');
-    
-    const descripciones = {{
-        'vertical': {{
-            titulo: '1. Inbreeding Vertical',
-            texto: 'Cruzar al mejor gallo con su mejor descendiente (hija, nieta). Fundamental para fijar características del macho fundador. Requiere selección rigurosa.'
-        }},
-        'horizontal': {{
-            titulo: '2. Inbreeding Horizontal',
-            texto: 'Cruzar hermanos completos entre sí. Método intensivo para rápida concentración de genes deseables. Aumenta riesgo de fijar defectos.'
-        }},
-        'line': {{
-            titulo: '3. Line Breeding',
-            texto: 'Forma moderada de inbreeding. Cruces entre parientes lejanos (medios hermanos, tíos/sobrinas). Fortalece virtudes con menor riesgo.'
-        }}
-    }};
-    
-    function actualizarCampos() {{
-        const opt = selectTipo.options[selectTipo.selectedIndex];
-        const estrategia = opt.getAttribute('data-estrategia');
-        const ej1 = opt.getAttribute('data-ej1') || 'Ejemplar 1';
-        const ej2 = opt.getAttribute('data-ej2') || 'Ejemplar 2';
-        
-        titulo1.innerHTML = '🐔 Ejemplar 1 (' + ej1 + ')';
-        titulo2.innerHTML = '🐔 Ejemplar 2 (' + ej2 + ')';
-        
-        if (estrategia && descripciones[estrategia]) {{
-            const info = descripciones[estrategia];
-            descripcionDiv.innerHTML = '<h3>' + info.titulo + '</h3><p>' + info.texto + '</p>';
-        }} else {{
-            descripcionDiv.innerHTML = '<p>Selecciona un tipo de cruce para ver la estrategia asociada.</p>';
-        }}
-    }}
-    
-    selectTipo.addEventListener('change', actualizarCampos);
-    actualizarCampos();
-    
-    // Indicador de carga
-    document.querySelector('form').addEventListener('submit', function() {{
-        const btn = this.querySelector('.btn-submit');
-        if (btn) {{ btn.disabled = true; btn.textContent = '⏳ Registrando...'; }}
-    }});
-}});
-</script>
-</body>
-</html>
-'''
+    return render_template('cruce_inbreeding.html')
 
 
 @app.route('/registrar-cruce', methods=['POST'])
@@ -1292,16 +2514,27 @@ document.addEventListener('DOMContentLoaded', function() {{
 @csrf.exempt
 def registrar_cruce():
     traba = session['traba']
-    conn = sqlite3.connect(DB)
-    conn.execute("PRAGMA foreign_keys = ON")
+    conn = get_db()
     cursor = conn.cursor()
+    fotos = []  # subidas de ejemplares nuevos, se encolan tras el commit
     
     try:
         tipo = request.form.get('tipo', '').strip()
         if not tipo:
             raise ValueError("Selecciona un tipo de cruce.")
         
+        codigos = []  # se reservan los dos a la vez si hace falta registrar algún ejemplar
+        
         def guardar_ejemplar(prefijo):
+            # Ejemplar existente elegido con el autocompletado
+            existente = request.form.get(f'id{prefijo}', '').strip()
+            if existente:
+                cursor.execute('SELECT id FROM individuos WHERE id = ? AND traba = ?', (existente, traba))
+                fila = cursor.fetchone()
+                if not fila:
+                    raise ValueError(f"El ejemplar {prefijo} seleccionado no existe en tu traba.")
+                return fila[0]
+            
             placa = request.form.get(f'placa{prefijo}', '').strip()
             if not placa:
                 raise ValueError(f"La placa del ejemplar {prefijo} es obligatoria.")
@@ -1330,10 +2563,12 @@ def registrar_cruce():
                 if file and file.filename != '' and allowed_file(file.filename):
                     if is_valid_image(file.stream):
                         fname = f"{secure_filename(placa)}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{secure_filename(file.filename)}"
-                        file.save(os.path.join(app.config['UPLOAD_FOLDER'], fname))
-                        foto = fname
+                        foto = guardar_subida(file, fname)
+                        fotos.append(foto)
             
-            codigo = generar_codigo_unico(cursor)
+            if not codigos:
+                codigos.extend(reservar_codigos(cursor, 2))
+            codigo = codigos.pop()
             cursor.execute('''
                 INSERT INTO individuos 
                 (traba, placa_traba, placa_regional, nombre, raza, color, apariencia, n_pelea, foto, generacion, codigo)
@@ -1357,12 +2592,8 @@ def registrar_cruce():
         if cursor.fetchone():
             raise ValueError("⚠️ Este cruce ya está registrado.")
         
-        # Porcentajes de consanguinidad
-        porcentajes = {
-            "Padre-Hija": 50.0, "Madre-Hijo": 50.0, "Hermanos": 50.0,
-            "Abuelo-Nieta": 25.0, "MediosHermanos": 25.0, "Tio-Sobrina": 25.0
-        }
-        porcentaje = porcentajes.get(tipo, 0.0)
+        # ✅ Consanguinidad real de la descendencia, calculada del pedigrí registrado
+        porcentaje = round(calcular_coi(cursor, id1, id2) * 100, 4)
         
         cursor.execute('''
             INSERT INTO cruces 
@@ -1371,17 +2602,21 @@ def registrar_cruce():
         ''', (
             traba, tipo, id1, id2, 1, porcentaje,
             datetime.now().strftime('%Y-%m-%d'),
-            f"Cruce registrado desde formulario"
+            f"Cruce registrado desde formulario (COI calculado del pedigrí: {porcentaje}%)"
         ))
         
         conn.commit()
-        app.logger.info(f"✅ Cruce registrado: {tipo} (IDs: {id1}, {id2})")
+        for foto in fotos:
+            encolar_foto(foto)
+        invalidar_autocompletar(traba)
+        app.logger.info(f"✅ Cruce registrado: {tipo} (IDs: {id1}, {id2}, COI: {porcentaje}%)")
         
         return f'''
         <!DOCTYPE html>
         <html><body style="background:#01030a;color:white;text-align:center;padding:50px;font-family:sans-serif;">
         <div style="background:rgba(0,255,255,0.1);padding:30px;border-radius:10px;max-width:500px;margin:0 auto;">
             <h2 style="color:#00ffff;">✅ Cruce registrado exitosamente!</h2>
+            <p style="margin:15px 0;">Consanguinidad de la descendencia (COI): <strong>{porcentaje}%</strong></p>
             <div style="margin-top:25px;">
                 <a href="/lista-cruces" style="display:inline-block;padding:12px 24px;background:#00ffff;color:#041428;text-decoration:none;border-radius:6px;margin:5px;">📋 Ver Cruces</a>
                 <a href="/menu" style="display:inline-block;padding:12px 24px;background:#2ecc71;color:#041428;text-decoration:none;border-radius:6px;margin:5px;">🏠 Menú</a>
@@ -1391,6 +2626,8 @@ def registrar_cruce():
         '''
         
     except ValueError as e:
+        for foto in fotos:
+            descartar_subida(foto)
         app.logger.warning(f"⚠️ Error de validación en cruce: {e}")
         return f'''
         <!DOCTYPE html>
@@ -1404,6 +2641,8 @@ def registrar_cruce():
         '''
     except Exception as e:
         conn.rollback()
+        for foto in fotos:
+            descartar_subida(foto)
         app.logger.error(f"❌ Error crítico en registrar_cruce: {e}", exc_info=True)
         return f'''
         <!DOCTYPE html>
@@ -1415,49 +2654,401 @@ def registrar_cruce():
         </div>
         </body></html>
         '''
-    finally:
-        conn.close()
 
 
 # =============================================================================
 # RUTAS DE RESPALDO Y DESCARGA
 # =============================================================================
 
+# Formatos ya comprimidos: se guardan tal cual (ZIP_STORED) en vez de desinflarlos otra vez
+EXTENSIONES_COMPRIMIDAS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+
+
+def snapshot_db(ruta):
+    """Copia consistente de la base al archivo `ruta` con la API de backup de SQLite.
+
+    Copia BACKUP_PAGINAS páginas por paso: en modo WAL los escritores siguen
+    trabajando y SQLite reinicia la copia si cambian páginas ya copiadas.
+    La copia va a disco, no a memoria: el tamaño de la base no pesa en la RAM.
+    """
+    origen = abrir_conexion()
+    destino = sqlite3.connect(ruta)
+    try:
+        origen.backup(destino, pages=BACKUP_PAGINAS)
+    finally:
+        destino.close()
+        origen.close()
+
+
+# Almacén incremental: cada foto se guarda una sola vez por su SHA-256 y la
+# base como copia completa comprimida (también por hash, así una base sin
+# cambios no ocupa espacio nuevo). Un manifiesto JSON describe cada snapshot.
+_ID_SNAPSHOT = re.compile(r'^\d{8}_\d{6}_[0-9a-f]{6}$')
+
+
+def archivos_uploads():
+    """Fotos de uploads/ a respaldar; las miniaturas y subidas pendientes no se copian"""
+    for root, dirs, files in os.walk(UPLOAD_FOLDER):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) not in (CARPETA_MINIATURAS, CARPETA_PENDIENTES)]
+        for file in files:
+            yield os.path.join(root, file)
+
+
+def _ruta_blob(hash_):
+    return os.path.join(ALMACEN_BACKUP, 'blobs', hash_[:2], hash_)
+
+
+def _ruta_manifiesto(snapshot_id):
+    return os.path.join(ALMACEN_BACKUP, 'manifiestos', f'{snapshot_id}.json')
+
+
+_ALMACEN_LOCK = threading.Lock()
+
+
+@contextmanager
+def bloqueo_almacen(al_esperar=None):
+    """Exclusión global del almacén: hilos, workers de gunicorn y `flask respaldar`.
+
+    Escribir un snapshot y podar blobs ocurren siempre dentro, así la poda
+    nunca ve un blob ya escrito cuyo manifiesto todavía no existe.
+    `al_esperar` se llama cada segundo mientras otro tiene el bloqueo.
+    """
+    while not _ALMACEN_LOCK.acquire(timeout=1):
+        if al_esperar:
+            al_esperar()
+    try:
+        os.makedirs(ALMACEN_BACKUP, exist_ok=True)
+        with open(os.path.join(ALMACEN_BACKUP, '.bloqueo'), 'a') as f:
+            if FCNTL_AVAILABLE:
+                while True:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if al_esperar:
+                            al_esperar()
+                        time.sleep(1)
+            try:
+                yield
+            finally:
+                if FCNTL_AVAILABLE:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+    finally:
+        _ALMACEN_LOCK.release()
+
+
+def _guardar_blob(trozos, comprimir=False, avance=None):
+    """Guarda un contenido por su hash y devuelve (hash, tamaño sin comprimir); llamar con bloqueo_almacen"""
+    os.makedirs(os.path.join(ALMACEN_BACKUP, 'tmp'), exist_ok=True)
+    temporal = os.path.join(ALMACEN_BACKUP, 'tmp', secrets.token_hex(8))
+    sha, tamaño = hashlib.sha256(), 0
+    compresor = zlib.compressobj(6, zlib.DEFLATED, 31) if comprimir else None
+    try:
+        with open(temporal, 'wb') as f:
+            for trozo in trozos:
+                sha.update(trozo)
+                tamaño += len(trozo)
+                f.write(compresor.compress(trozo) if compresor else trozo)
+                if avance:
+                    avance(len(trozo))
+            if compresor:
+                f.write(compresor.flush())
+        hash_ = sha.hexdigest()
+        destino = _ruta_blob(hash_)
+        if os.path.exists(destino):
+            os.remove(temporal)
+        else:
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            os.replace(temporal, destino)
+        return hash_, tamaño
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+
+
+def _leer_archivo(ruta, comprimido=False):
+    """Lee un archivo (o blob gzip) en trozos de BACKUP_BLOQUE bytes"""
+    descompresor = zlib.decompressobj(31) if comprimido else None
+    with open(ruta, 'rb') as f:
+        while trozo := f.read(BACKUP_BLOQUE):
+            yield descompresor.decompress(trozo) if descompresor else trozo
+    if descompresor:
+        yield descompresor.flush()
+
+
+def listar_snapshots():
+    """Manifiestos del almacén, del más reciente al más antiguo"""
+    carpeta = os.path.join(ALMACEN_BACKUP, 'manifiestos')
+    if not os.path.isdir(carpeta):
+        return []
+    manifiestos = []
+    for nombre in os.listdir(carpeta):
+        if nombre.endswith('.json'):
+            with open(os.path.join(carpeta, nombre), encoding='utf-8') as f:
+                manifiestos.append(json.load(f))
+    return sorted(manifiestos, key=lambda m: m['fecha'], reverse=True)
+
+
+def crear_snapshot(avance=None):
+    """Toma un snapshot incremental y devuelve su id.
+
+    Las fotos con el mismo tamaño y mtime que en el snapshot anterior reutilizan
+    su hash sin volver a leerse. Mientras otro snapshot o una poda tienen el
+    almacén, espera informando avance(0) para no parecer un trabajo muerto.
+    """
+    with bloqueo_almacen(al_esperar=(lambda: avance(0)) if avance else None):
+        return _crear_snapshot(avance)
+
+
+def _crear_snapshot(avance):
+    anteriores = listar_snapshots()
+    previas = anteriores[0]['uploads'] if anteriores else {}
+    ahora = datetime.now()
+    snapshot_id = f"{ahora.strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(3)}"
+    
+    os.makedirs(os.path.join(ALMACEN_BACKUP, 'tmp'), exist_ok=True)
+    copia = os.path.join(ALMACEN_BACKUP, 'tmp', f'{snapshot_id}.db')
+    try:
+        snapshot_db(copia)
+        db_hash, db_tamaño = _guardar_blob(_leer_archivo(copia), comprimir=True, avance=avance)
+    finally:
+        if os.path.exists(copia):
+            os.remove(copia)
+    
+    uploads = {}
+    for ruta in archivos_uploads():
+        rel = os.path.relpath(ruta, UPLOAD_FOLDER).replace(os.sep, '/')
+        st = os.stat(ruta)
+        previa = previas.get(rel)
+        if previa and previa[1:] == [st.st_size, st.st_mtime_ns] and os.path.exists(_ruta_blob(previa[0])):
+            uploads[rel] = previa
+            if avance:
+                avance(st.st_size)
+        else:
+            hash_, tamaño = _guardar_blob(_leer_archivo(ruta), avance=avance)
+            uploads[rel] = [hash_, tamaño, st.st_mtime_ns]
+    
+    manifiesto = {
+        'id': snapshot_id,
+        'fecha': ahora.isoformat(),
+        'db': {'hash': db_hash, 'tamaño': db_tamaño, 'gzip': True},
+        'uploads': uploads,
+    }
+    ruta = _ruta_manifiesto(snapshot_id)
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    with open(ruta + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifiesto, f)
+    os.replace(ruta + '.tmp', ruta)
+    return snapshot_id
+
+
+def aplicar_retencion(diarios=BACKUP_DIARIOS, semanales=BACKUP_SEMANALES):
+    """Conserva el último snapshot de cada uno de los N últimos días y M últimas
+    semanas, borra el resto y luego los blobs que ya nadie referencia.
+
+    Corre con bloqueo_almacen: ningún snapshot se está escribiendo a la vez.
+    Devuelve (snapshots, blobs) borrados.
+    """
+    with bloqueo_almacen():
+        return _aplicar_retencion(diarios, semanales)
+
+
+def _aplicar_retencion(diarios, semanales):
+    manifiestos = listar_snapshots()
+    dias, semanas, conservar = set(), set(), set()
+    for m in manifiestos:
+        fecha = datetime.fromisoformat(m['fecha'])
+        dia, semana = fecha.date(), fecha.isocalendar()[:2]
+        if dia not in dias and len(dias) < diarios:
+            dias.add(dia)
+            conservar.add(m['id'])
+        if semana not in semanas and len(semanas) < semanales:
+            semanas.add(semana)
+            conservar.add(m['id'])
+    if manifiestos:
+        conservar.add(manifiestos[0]['id'])
+    
+    borrados = 0
+    referenciados = set()
+    for m in manifiestos:
+        if m['id'] in conservar:
+            referenciados.add(m['db']['hash'])
+            referenciados.update(h for h, _, _ in m['uploads'].values())
+        else:
+            os.remove(_ruta_manifiesto(m['id']))
+            borrados += 1
+    
+    blobs_borrados = 0
+    for root, dirs, files in os.walk(os.path.join(ALMACEN_BACKUP, 'blobs')):
+        for file in files:
+            if file not in referenciados:
+                os.remove(os.path.join(root, file))
+                blobs_borrados += 1
+    return borrados, blobs_borrados
+
+
+def restaurar_snapshot(snapshot_id, destino):
+    """Reconstruye gallos.db y uploads/ de un snapshot en la carpeta `destino`"""
+    with bloqueo_almacen():  # Que una poda no borre blobs a mitad de la restauración
+        return _restaurar_snapshot(snapshot_id, destino)
+
+
+def _restaurar_snapshot(snapshot_id, destino):
+    with open(_ruta_manifiesto(snapshot_id), encoding='utf-8') as f:
+        manifiesto = json.load(f)
+    os.makedirs(os.path.join(destino, 'uploads'), exist_ok=True)
+    with open(os.path.join(destino, 'gallos.db'), 'wb') as f:
+        for trozo in _leer_archivo(_ruta_blob(manifiesto['db']['hash']), manifiesto['db']['gzip']):
+            f.write(trozo)
+    for rel, (hash_, _, mtime_ns) in manifiesto['uploads'].items():
+        ruta = os.path.join(destino, 'uploads', *rel.split('/'))
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        shutil.copyfile(_ruta_blob(hash_), ruta)  # Copia: editar la foto restaurada no toca el blob
+    return manifiesto
+
+
+class _SalidaZip(io.RawIOBase):
+    """Destino no buscable para zipfile: acumula lo escrito hasta vaciarlo"""
+    
+    def __init__(self):
+        self.trozos = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, datos):
+        self.trozos.append(bytes(datos))
+        return len(datos)
+    
+    def vaciar(self):
+        datos = b''.join(self.trozos)
+        self.trozos.clear()
+        return datos
+
+
+def generar_zip_snapshot(manifiesto):
+    """ZIP de un snapshot (gallos.db + uploads/) generado al vuelo desde los blobs"""
+    salida = _SalidaZip()
+    with zipfile.ZipFile(salida, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        with zipf.open('gallos.db', 'w', force_zip64=True) as destino:
+            for trozo in _leer_archivo(_ruta_blob(manifiesto['db']['hash']), manifiesto['db']['gzip']):
+                destino.write(trozo)
+                yield salida.vaciar()
+        for rel, (hash_, tamaño, mtime_ns) in manifiesto['uploads'].items():
+            info = zipfile.ZipInfo(f'uploads/{rel}', datetime.fromtimestamp(mtime_ns / 1e9).timetuple()[:6])
+            comprimido = os.path.splitext(rel)[1].lower() in EXTENSIONES_COMPRIMIDAS
+            info.compress_type = zipfile.ZIP_STORED if comprimido else zipfile.ZIP_DEFLATED
+            with zipf.open(info, 'w', force_zip64=tamaño > zipfile.ZIP64_LIMIT) as destino:
+                for trozo in _leer_archivo(_ruta_blob(hash_)):
+                    destino.write(trozo)
+            yield salida.vaciar()
+    yield salida.vaciar()
+
+
+# Respaldos en segundo plano: el estado vive en `trabajos_backup` para que
+# cualquier worker de gunicorn pueda responder a /backup/estado/<job>
+_BACKUP_EJECUTOR = None
+_BACKUP_EJECUTOR_PID = None
+
+
+def _ejecutor_backups():
+    """Pool de hilos del worker actual (los hilos no sobreviven a un fork)"""
+    global _BACKUP_EJECUTOR, _BACKUP_EJECUTOR_PID
+    if _BACKUP_EJECUTOR_PID != os.getpid():
+        _BACKUP_EJECUTOR = ThreadPoolExecutor(max_workers=BACKUP_HILOS, thread_name_prefix='backup')
+        _BACKUP_EJECUTOR_PID = os.getpid()
+    return _BACKUP_EJECUTOR
+
+
+def tamaño_backup():
+    """Bytes a procesar: la base (páginas en uso) más las fotos"""
+    total = os.path.getsize(DB) if os.path.exists(DB) else 0
+    return total + sum(os.path.getsize(ruta) for ruta in archivos_uploads())
+
+
+def ejecutar_backup(job):
+    """Cuerpo del trabajo: toma el snapshot, aplica la retención e informa el progreso"""
+    conn = abrir_conexion()
+    progreso = {'bytes': 0, 'reporte': 0.0}
+    
+    def avance(n):
+        progreso['bytes'] += n
+        if time.monotonic() - progreso['reporte'] >= BACKUP_REPORTE_SEG:
+            progreso['reporte'] = time.monotonic()
+            conn.execute('UPDATE trabajos_backup SET procesados = ?, actualizado = ? WHERE id = ?',
+                         (progreso['bytes'], datetime.now(), job))
+            conn.commit()
+    
+    try:
+        conn.execute('UPDATE trabajos_backup SET total = ?, actualizado = ? WHERE id = ?', (tamaño_backup(), datetime.now(), job))
+        conn.commit()
+        snapshot_id = crear_snapshot(avance)
+        conn.execute('''UPDATE trabajos_backup SET estado = 'completado', procesados = MAX(total, ?), archivo = ?, actualizado = ?
+                        WHERE id = ?''', (progreso['bytes'], snapshot_id, datetime.now(), job))
+        conn.commit()
+        app.logger.info(f"✅ Snapshot creado: {snapshot_id}")
+        snapshots, blobs = aplicar_retencion()
+        if snapshots or blobs:
+            app.logger.info(f"🧹 Retención: {snapshots} snapshots y {blobs} blobs eliminados")
+    except Exception as e:
+        app.logger.error(f"❌ Error creando backup: {e}", exc_info=True)
+        conn.rollback()
+        conn.execute("UPDATE trabajos_backup SET estado = 'error', error = ?, actualizado = ? WHERE id = ?",
+                     (str(e), datetime.now(), job))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def estado_backup(fila):
+    """JSON público de un trabajo de respaldo"""
+    return {
+        "job": fila['id'],
+        "estado": fila['estado'],
+        "procesados": fila['procesados'],
+        "total": fila['total'],
+        "porcentaje": round(100 * fila['procesados'] / fila['total'], 1) if fila['total'] else 0,
+        "archivo": fila['archivo'],
+        "error": fila['error'],
+    }
+
+
 @app.route('/backup', methods=['POST'])
 @proteger_ruta
 @csrf.exempt
 def crear_backup_manual():
+    """Encola un respaldo y devuelve su id; solo uno activo por traba"""
+    traba = session['traba']
+    conn = get_db()
+    ahora = datetime.now()
+    # Un trabajo sin progreso reciente murió con su worker: no debe bloquear la traba
+    conn.execute('''UPDATE trabajos_backup SET estado = 'error', error = 'Respaldo interrumpido'
+                    WHERE traba = ? AND estado = 'en_curso' AND actualizado < ?''',
+                 (traba, ahora - timedelta(seconds=BACKUP_CADUCA_SEG)))
+    
+    job = secrets.token_hex(8)
     try:
-        timestamp = datetime.now()
-        fecha_archivo = timestamp.strftime("%Y%m%d_%H%M%S")
-        temp_dir = f"temp_backup_{fecha_archivo}"
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        if os.path.exists(DB):
-            shutil.copy2(DB, os.path.join(temp_dir, "gallos.db"))
-        if os.path.exists(UPLOAD_FOLDER) and os.listdir(UPLOAD_FOLDER):
-            shutil.copytree(UPLOAD_FOLDER, os.path.join(temp_dir, "uploads"), dirs_exist_ok=True)
-        
-        zip_filename = f"gallofino_backup_{fecha_archivo}.zip"
-        os.makedirs(BACKUP_FOLDER, exist_ok=True)
-        zip_path = os.path.join(BACKUP_FOLDER, zip_filename)
-        
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(temp_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, temp_dir)
-                    zipf.write(file_path, arcname)
-        
-        shutil.rmtree(temp_dir)
-        app.logger.info(f"✅ Backup creado: {zip_filename}")
-        return jsonify({"mensaje": "✅ Copia de seguridad creada.", "archivo": zip_filename})
-        
-    except Exception as e:
-        app.logger.error(f"❌ Error creando backup: {e}", exc_info=True)
-        if 'temp_dir' in locals() and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir, ignore_errors=True)
-        return jsonify({"error": f"Error: {str(e)}"}), 500
+        conn.execute('''INSERT INTO trabajos_backup (id, traba, creado, actualizado) VALUES (?, ?, ?, ?)''',
+                     (job, traba, ahora, ahora))
+        conn.commit()
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        activo = conn.execute("SELECT * FROM trabajos_backup WHERE traba = ? AND estado = 'en_curso'", (traba,)).fetchone()
+        return jsonify({**(estado_backup(activo) if activo else {}), "error": "Ya hay un respaldo en curso."}), 409
+    
+    _ejecutor_backups().submit(ejecutar_backup, job)
+    app.logger.info(f"💾 Backup encolado: {job} (Traba: {traba})")
+    return jsonify({"mensaje": "⏳ Copia de seguridad en curso.", "job": job}), 202
+
+
+@app.route('/backup/estado/<job>')
+@proteger_ruta
+def estado_backup_manual(job):
+    fila = get_db().execute('SELECT * FROM trabajos_backup WHERE id = ? AND traba = ?', (job, session['traba'])).fetchone()
+    if not fila:
+        return jsonify({"error": "Respaldo no encontrado"}), 404
+    return jsonify(estado_backup(fila))
 
 
 @app.route('/download/<filename>')
@@ -1468,6 +3059,19 @@ def descargar_backup(filename):
         app.logger.warning(f"⚠️ Intento de acceso inválido: {filename}")
         return "Archivo no válido", 400
     
+    # Snapshots del almacén incremental: el ZIP se arma al vuelo
+    if _ID_SNAPSHOT.match(filename):
+        if not os.path.exists(_ruta_manifiesto(filename)):
+            return "Archivo no encontrado", 404
+        with open(_ruta_manifiesto(filename), encoding='utf-8') as f:
+            manifiesto = json.load(f)
+        app.logger.info(f"📥 Descarga de snapshot: {filename}")
+        return Response(
+            generar_zip_snapshot(manifiesto),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename=gallofino_backup_{filename}.zip'}
+        )
+    
     backups_dir = os.path.abspath(BACKUP_FOLDER)
     ruta_solicitada = os.path.abspath(os.path.join(backups_dir, filename))
     
@@ -1482,126 +3086,619 @@ def descargar_backup(filename):
     return send_from_directory(BACKUP_FOLDER, filename, as_attachment=True)
 
 
+# =============================================================================
+# PLANTILLAS Y RECURSOS ESTÁTICOS
+# =============================================================================
+# Las páginas principales se renderizan con las plantillas Jinja de templates/
+# (base.html es el layout común), compiladas una sola vez al arrancar. Su CSS
+# y JS están en static/css y static/js y se sirven desde memoria, ya
+# comprimidos, en /recursos/<versión>/<ruta>: la versión es el hash del
+# contenido, así el navegador los guarda como inmutables.
+
+CARPETAS_RECURSOS = ('css', 'js')
+
+
+def cargar_recursos():
+    """Lee y precomprime los CSS/JS de static/: {ruta: {version, tipo, variantes}}"""
+    recursos = {}
+    for carpeta in CARPETAS_RECURSOS:
+        directorio = os.path.join(app.root_path, 'static', carpeta)
+        for nombre in sorted(os.listdir(directorio)):
+            with open(os.path.join(directorio, nombre), 'rb') as f:
+                datos = f.read()
+            variantes = {None: datos}
+            for codificacion in (('br', 'gzip') if BROTLI_AVAILABLE else ('gzip',)):
+                compresor = _Compresor(codificacion)
+                comprimido = compresor.comprimir(datos) + compresor.terminar()
+                if len(comprimido) < len(datos):
+                    variantes[codificacion] = comprimido
+            recursos[f"{carpeta}/{nombre}"] = {
+                'version': hashlib.sha256(datos).hexdigest()[:12],
+                'tipo': mimetypes.guess_type(nombre)[0] or 'application/octet-stream',
+                'variantes': variantes,
+            }
+    return recursos
+
+
+RECURSOS = cargar_recursos()
+
+
+def recurso(ruta):
+    """URL versionada de un CSS/JS de static/ (para las plantillas)"""
+    return f"/recursos/{RECURSOS[ruta]['version']}/{ruta}"
+
+
+# Fragmentos invariantes: se arman una vez aquí y no en cada petición
+OPCIONES_RAZAS = Markup(''.join(f'<option value="{escape(r)}">{escape(r)}</option>' for r in RAZAS))
+OPCIONES_APARIENCIAS = Markup(''.join(f'<option value="{escape(a)}">{escape(a)}</option>' for a in APARIENCIAS))
+RADIOS_APARIENCIAS = Markup(''.join(
+    f'<label style="display:inline-block; margin-right:15px;"><input type="radio" name="gallo_apariencia" value="{escape(a)}" required> {escape(a)}</label>'
+    for a in APARIENCIAS
+))
+
+app.jinja_env.globals.update(
+    recurso=recurso,
+    OPCIONES_RAZAS=OPCIONES_RAZAS,
+    OPCIONES_APARIENCIAS=OPCIONES_APARIENCIAS,
+    RADIOS_APARIENCIAS=RADIOS_APARIENCIAS,
+)
+# Compilar todas las plantillas al importar: ninguna petición paga el parseo
+for _plantilla in app.jinja_env.list_templates():
+    app.jinja_env.get_template(_plantilla)
+
+
+@app.route('/recursos/<version>/<path:ruta>')
+def servir_recurso(version, ruta):
+    info = RECURSOS.get(ruta)
+    if info is None:
+        return "Archivo no encontrado", 404
+    if version != info['version']:
+        # HTML antiguo en caché pidiendo una versión anterior
+        return redirect(recurso(ruta))
+    codificacion = _codificacion_aceptada()
+    if codificacion not in info['variantes']:
+        codificacion = None
+    resp = Response(info['variantes'][codificacion], mimetype=info['tipo'])
+    if codificacion:
+        resp.headers['Content-Encoding'] = codificacion
+    resp.vary.add('Accept-Encoding')
+    resp.set_etag(f"{info['version']}-{codificacion or 'identity'}")
+    resp.cache_control.public = True
+    resp.cache_control.max_age = CACHE_INMUTABLE_SEG
+    resp.cache_control.immutable = True
+    return resp.make_conditional(request)
+
+
 # =============================================================================
 # RUTAS AUXILIARES
 # =============================================================================
 
+SVG_PROCESANDO = '<svg xmlns="http://www.w3.org/2000/svg" width="80" height="80"><rect width="80" height="80" rx="8" fill="#1c2833"/><text x="40" y="46" text-anchor="middle" fill="#00ffff" font-size="12" font-family="sans-serif">Procesando</text></svg>'
+
+
+def servir_archivo(carpeta, nombre, max_age, inmutable=False, privado=True):
+    """Sirve un archivo con ETag fuerte, Last-Modified, 304 y Cache-Control.
+
+    Un solo os.stat por petición (None si no existe). Con SERVIDOR_ARCHIVOS se
+    delega el envío al proxy: 'x-sendfile' (Apache/lighttpd, vía Flask) o
+    'x-accel' (nginx, location interna X_ACCEL_PREFIJO que apunta a la raíz de la app).
+    """
+    ruta = os.path.join(carpeta, nombre)
+    try:
+        st = os.stat(ruta)
+    except OSError:
+        return None
+    etag = hashlib.sha1(f"{ruta}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()[:20]
+    if SERVIDOR_ARCHIVOS == 'x-accel':
+        resp = Response(mimetype=mimetypes.guess_type(nombre)[0] or 'application/octet-stream')
+        resp.headers['X-Accel-Redirect'] = X_ACCEL_PREFIJO + ruta.replace(os.sep, '/')
+        resp.set_etag(etag)
+        resp.last_modified = st.st_mtime
+        resp = resp.make_conditional(request)
+    else:
+        resp = send_from_directory(carpeta, nombre, etag=etag, max_age=max_age)
+    resp.cache_control.max_age = max_age
+    resp.cache_control.public = None if privado else True
+    resp.cache_control.private = True if privado else None
+    resp.cache_control.immutable = inmutable or None
+    return resp
+
+
+def _servir_foto(filename, inmutable=True):
+    if '..' in filename:
+        return "Archivo no encontrado", 404
+    # Los nombres de las fotos llevan fecha y hora: su contenido no cambia nunca
+    resp = servir_archivo(app.config['UPLOAD_FOLDER'], filename, CACHE_INMUTABLE_SEG if inmutable else CACHE_CORTO_SEG, inmutable)
+    if resp is not None:
+        return resp
+    if os.path.exists(os.path.join(CARPETA_PENDIENTES, filename)):
+        # Aún en el pool de imágenes: marcador que no se guarda en caché
+        return Response(SVG_PROCESANDO, mimetype='image/svg+xml', headers={'Cache-Control': 'no-store'})
+    return "Archivo no encontrado", 404
+
+
 @app.route('/uploads/<filename>')
 @proteger_ruta
 def uploaded_file(filename):
-    # ✅ Validar que el archivo existe y está en la carpeta correcta
-    ruta = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    if not os.path.exists(ruta) or '..' in filename:
+    return _servir_foto(filename)
+
+
+@app.route('/uploads/<int:lado>/<filename>')
+@proteger_ruta
+def miniatura(lado, filename):
+    """Miniatura de una foto; si aún no existe se sirve el original con caché corta"""
+    if lado not in TAMAÑOS_MINIATURA or '..' in filename:
         return "Archivo no encontrado", 404
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    ruta = ruta_miniatura(filename, lado)
+    resp = servir_archivo(os.path.dirname(ruta), os.path.basename(ruta), CACHE_INMUTABLE_SEG, inmutable=True)
+    return resp if resp is not None else _servir_foto(filename, inmutable=False)
+
+
+SVG_LOGO = '<svg xmlns="http://www.w3.org/2000/svg" width="80" height="80"><circle cx="40" cy="40" r="35" fill="#00ffff"/><text x="40" y="45" text-anchor="middle" fill="#041428" font-size="20" font-family="sans-serif">GF</text></svg>'
 
 
 @app.route('/logo')
 def logo():
     """Sirve el logo o un fallback SVG seguro"""
-    try:
-        if os.path.exists("static/OIP.png"):
-            return send_from_directory("static", "OIP.png")
-    except:
-        pass
+    resp = servir_archivo("static", "OIP.png", CACHE_LOGO_SEG, privado=False)
+    if resp is not None:
+        return resp
     
     # SVG compatible: string normal + encode (NO bytes con emoji)
-    svg = '<svg xmlns="http://www.w3.org/2000/svg" width="80" height="80"><circle cx="40" cy="40" r="35" fill="#00ffff"/><text x="40" y="45" text-anchor="middle" fill="#041428" font-size="20" font-family="sans-serif">GF</text></svg>'
-    from flask import Response
-    return Response(svg.encode('utf-8'), mimetype='image/svg+xml')
+    resp = Response(SVG_LOGO.encode('utf-8'), mimetype='image/svg+xml')
+    resp.set_etag(hashlib.sha1(SVG_LOGO.encode('utf-8')).hexdigest()[:20])
+    resp.cache_control.public = True
+    resp.cache_control.max_age = CACHE_LOGO_SEG
+    return resp.make_conditional(request)
+
+
+# =============================================================================
+# EXPORTACIÓN CSV POR STREAMING
+# =============================================================================
+
+# tabla -> (encabezados, consulta filtrada por traba)
+TABLAS_EXPORTACION = {
+    'individuos': (
+        ['ID', 'Placa', 'Placa_Regional', 'Nombre', 'Raza', 'Color', 'Apariencia', 'N_Pelea', 'Nacimiento', 'Foto', 'Generacion', 'Codigo', 'Placa_Madre', 'Placa_Padre'],
+        '''SELECT i.id, i.placa_traba, i.placa_regional, i.nombre, i.raza, i.color, i.apariencia, i.n_pelea, i.nacimiento, i.foto, i.generacion, i.codigo,
+                  m.placa_traba, p.placa_traba
+           FROM individuos i
+           LEFT JOIN progenitores pr ON i.id = pr.individuo_id
+           LEFT JOIN individuos m ON pr.madre_id = m.id
+           LEFT JOIN individuos p ON pr.padre_id = p.id
+           WHERE i.traba = ?
+           ORDER BY i.id'''
+    ),
+    'progenitores': (
+        ['Individuo_ID', 'Placa', 'Madre_ID', 'Placa_Madre', 'Padre_ID', 'Placa_Padre'],
+        '''SELECT pr.individuo_id, i.placa_traba, pr.madre_id, m.placa_traba, pr.padre_id, p.placa_traba
+           FROM progenitores pr
+           JOIN individuos i ON pr.individuo_id = i.id
+           LEFT JOIN individuos m ON pr.madre_id = m.id
+           LEFT JOIN individuos p ON pr.padre_id = p.id
+           WHERE i.traba = ?
+           ORDER BY pr.individuo_id'''
+    ),
+    'cruces': (
+        ['ID', 'Tipo', 'Individuo1_ID', 'Placa_1', 'Individuo2_ID', 'Placa_2', 'Generacion', 'Porcentaje', 'Fecha', 'Notas', 'Foto'],
+        '''SELECT c.id, c.tipo, c.individuo1_id, i1.placa_traba, c.individuo2_id, i2.placa_traba, c.generacion, c.porcentaje, c.fecha, c.notas, c.foto
+           FROM cruces c
+           LEFT JOIN individuos i1 ON c.individuo1_id = i1.id
+           LEFT JOIN individuos i2 ON c.individuo2_id = i2.id
+           WHERE c.traba = ?
+           ORDER BY c.id'''
+    ),
+}
+
+
+def generar_csv(cursor, traba, tablas):
+    """Genera el CSV por bloques de LOTE_EXPORTACION filas leídas con fetchmany.
+
+    Con varias tablas cada sección empieza con una fila "[tabla]" y se separa
+    de la anterior con una línea en blanco.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    
+    def vaciar():
+        texto = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return texto
+    
+    for n, tabla in enumerate(tablas):
+        encabezados, consulta = TABLAS_EXPORTACION[tabla]
+        if len(tablas) > 1:
+            if n:
+                writer.writerow([])
+            writer.writerow([f'[{tabla}]'])
+        writer.writerow(encabezados)
+        cursor.execute(consulta, (traba,))
+        while True:
+            filas = cursor.fetchmany(LOTE_EXPORTACION)
+            if not filas:
+                break
+            writer.writerows(filas)
+            yield vaciar()
+    yield vaciar()
+
+
+def comprimir_gzip(fragmentos):
+    """Comprime al vuelo un flujo de texto en formato gzip"""
+    compresor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for fragmento in fragmentos:
+        datos = compresor.compress(fragmento.encode('utf-8'))
+        if datos:
+            yield datos
+    yield compresor.flush()
 
 
 @app.route('/exportar')
 @proteger_ruta
 def exportar():
-    """Exportar datos a CSV"""
+    """Exportar datos a CSV en streaming.
+
+    ?tabla=individuos|progenitores|cruces|todo (por defecto individuos) y
+    ?gzip=1 para descargar el archivo comprimido.
+    """
     traba = session['traba']
-    conn = sqlite3.connect(DB)
-    conn.row_factory = sqlite3.Row
+    tabla = request.args.get('tabla', 'individuos')
+    if tabla == 'todo':
+        tablas = list(TABLAS_EXPORTACION)
+    elif tabla in TABLAS_EXPORTACION:
+        tablas = [tabla]
+    else:
+        return jsonify({'error': 'Tabla no válida'}), 400
+    
+    cursor = get_db().cursor()
+    nombre = f'{"gallos" if tabla == "individuos" else tabla}_{traba}_{datetime.now().strftime("%Y%m%d")}.csv'
+    contenido = generar_csv(cursor, traba, tablas)
+    mimetype = 'text/csv'
+    if request.args.get('gzip') == '1':
+        contenido = comprimir_gzip(contenido)
+        nombre += '.gz'
+        mimetype = 'application/gzip'
+    
+    return Response(
+        stream_with_context(contenido),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={nombre}'}
+    )
+
+
+# =============================================================================
+# IMPORTACIÓN MASIVA (CSV / EXCEL)
+# =============================================================================
+
+# Encabezados aceptados (en minúsculas, sin espacios) -> campo interno.
+# Coinciden con los de /exportar, así un CSV exportado se puede volver a importar.
+COLUMNAS_IMPORTACION = {
+    'placa': 'placa', 'placa_traba': 'placa',
+    'placa_regional': 'placa_regional',
+    'nombre': 'nombre',
+    'raza': 'raza',
+    'color': 'color',
+    'apariencia': 'apariencia',
+    'n_pelea': 'n_pelea',
+    'nacimiento': 'nacimiento',
+    'generacion': 'generacion',
+    'placa_madre': 'madre', 'madre': 'madre',
+    'placa_padre': 'padre', 'padre': 'padre',
+}
+
+
+def _normalizar_encabezados(encabezados):
+    """Mapea los encabezados del archivo a campos internos (None si se ignora)"""
+    return [COLUMNAS_IMPORTACION.get(str(e or '').strip().lower().replace(' ', '_')) for e in encabezados]
+
+
+def _valor_celda(valor):
+    """Texto limpio de una celda CSV/Excel ('' si está vacía)"""
+    if valor is None:
+        return ''
+    if isinstance(valor, datetime):
+        return valor.date().isoformat()
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return str(valor).strip()
+
+
+def leer_filas_importacion(archivo, nombre):
+    """Genera bloques de LOTE_IMPORTACION filas [(n_fila, {campo: valor})] sin cargar el archivo entero"""
+    if nombre.lower().endswith('.xlsx'):
+        libro = load_workbook(archivo, read_only=True, data_only=True)
+        try:
+            filas = libro.active.iter_rows(values_only=True)
+            campos = _normalizar_encabezados(next(filas, ()))
+            numeradas = enumerate(filas, start=2)
+            for lote in iterar_lotes(numeradas, LOTE_IMPORTACION):
+                yield [(n, {c: _valor_celda(v) for c, v in zip(campos, fila) if c}) for n, fila in lote]
+        finally:
+            libro.close()
+    else:
+        lector = pd.read_csv(archivo, dtype=str, keep_default_na=False, encoding='utf-8-sig',
+                             chunksize=LOTE_IMPORTACION)
+        fila_inicial = 2
+        for bloque in lector:
+            campos = _normalizar_encabezados(bloque.columns)
+            yield [(fila_inicial + k, {c: _valor_celda(v) for c, v in zip(campos, fila) if c})
+                   for k, fila in enumerate(bloque.itertuples(index=False, name=None))]
+            fila_inicial += len(bloque)
+
+
+def validar_fila_importacion(datos, placas):
+    """Devuelve (registro, error) de una fila ya leída; `placas` son las placas existentes"""
+    placa = datos.get('placa', '')
+    if not placa:
+        return None, "La placa es obligatoria."
+    if placa in placas:
+        return None, f"Ya existe un gallo con placa '{placa}' en tu traba."
+    raza = next((r for r in RAZAS if r.lower() == datos.get('raza', '').lower()), None)
+    if not raza:
+        return None, f"Raza no válida: '{datos.get('raza', '')}'."
+    apariencia = next((a for a in APARIENCIAS if a.lower() == datos.get('apariencia', '').lower()), None)
+    if not apariencia:
+        return None, f"Apariencia no válida: '{datos.get('apariencia', '')}'."
+    color = datos.get('color', '')
+    if not color:
+        return None, "El color es obligatorio."
+    try:
+        generacion = int(datos.get('generacion') or 1)
+    except ValueError:
+        return None, f"Generación no válida: '{datos['generacion']}'."
+    madre, padre = datos.get('madre') or None, datos.get('padre') or None
+    if placa in (madre, padre):
+        return None, "Un gallo no puede ser su propio progenitor."
+    if madre and madre == padre:
+        return None, "La madre y el padre no pueden ser el mismo gallo."
+    registro = (placa, datos.get('placa_regional') or None, datos.get('nombre') or None, raza, color,
+                apariencia, datos.get('n_pelea') or None, datos.get('nacimiento') or None, generacion)
+    return registro, None
+
+
+def importar_individuos(conn, traba, bloques):
+    """Valida e inserta los bloques de filas, una transacción por bloque.
+
+    Los progenitores se resuelven por placa contra la traba; los que aún no
+    existen (aparecen más adelante en el archivo) se enlazan al terminar.
+    Un vínculo que cerraría un ciclo en el pedigrí no se guarda.
+    Devuelve (insertados, enlazados, errores[(n_fila, placa, mensaje)]).
+    """
     cursor = conn.cursor()
+    placas = dict(cursor.execute('SELECT placa_traba, id FROM individuos WHERE traba = ?', (traba,)).fetchall())
+    insertados, enlazados, errores, pendientes = 0, 0, [], []
+    con_hijos = set()  # ids usados como progenitor en esta importación
+    
+    def enlazar(vinculos):
+        """Inserta los vínculos resolubles; devuelve (enlazados, aún sin resolver, con ciclo)"""
+        filas, faltan, ciclos, enlazados = [], [], [], 0
+        for n, placa, madre, padre in vinculos:
+            if (madre and madre not in placas) or (padre and padre not in placas):
+                faltan.append((n, placa, madre, padre))
+                continue
+            id_, padres = placas[placa], [placas[p] for p in (madre, padre) if p]
+            # Los gallos importados solo tienen hijos por vínculos de esta misma
+            # importación: sin ellos no hay ciclo posible y no se consulta la base
+            if id_ in con_hijos:
+                cursor.executemany('INSERT INTO progenitores (individuo_id, madre_id, padre_id) VALUES (?, ?, ?)', filas)
+                enlazados += len(filas)
+                filas = []
+                if crearia_ciclo(cursor, id_, padres):
+                    ciclos.append((n, placa, "Registrado sin progenitores: el pedigrí quedaría en ciclo (es ancestro de su progenitor)."))
+                    continue
+            con_hijos.update(padres)
+            filas.append((id_, placas.get(madre), placas.get(padre)))
+        cursor.executemany('INSERT INTO progenitores (individuo_id, madre_id, padre_id) VALUES (?, ?, ?)', filas)
+        return enlazados + len(filas), faltan, ciclos
+    
+    for bloque in bloques:
+        registros, vinculos, nuevas = [], [], set()
+        for n, datos in bloque:
+            registro, error = validar_fila_importacion(datos, placas)
+            if error:
+                errores.append((n, datos.get('placa', ''), error))
+                continue
+            placas[registro[0]] = None  # reservada; el id se carga tras el INSERT
+            nuevas.add(registro[0])
+            registros.append(registro)
+            if datos.get('madre') or datos.get('padre'):
+                vinculos.append((n, registro[0], datos.get('madre') or None, datos.get('padre') or None))
+        if not registros:
+            continue
+        
+        try:
+            codigos = reservar_codigos(cursor, len(registros))
+            cursor.executemany('''
+                INSERT INTO individuos
+                (traba, placa_traba, placa_regional, nombre, raza, color, apariencia, n_pelea, nacimiento, generacion, codigo)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [(traba, *r, c) for r, c in zip(registros, codigos)])
+            placas_bloque = [r[0] for r in registros]
+            for i in range(0, len(placas_bloque), LOTE_SQL):
+                parte = placas_bloque[i:i + LOTE_SQL]
+                cursor.execute(f"SELECT placa_traba, id FROM individuos WHERE traba = ? AND placa_traba IN ({','.join('?' * len(parte))})", (traba, *parte))
+                placas.update(cursor.fetchall())
+            n_enlazados, faltan, ciclos = enlazar(vinculos)
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            for placa in nuevas:
+                placas.pop(placa, None)
+            app.logger.error(f"❌ Error al importar bloque: {e}")
+            errores.extend((n, datos.get('placa', ''), f"Error de base de datos: {e}") for n, datos in bloque
+                           if datos.get('placa') in nuevas)
+            continue
+        insertados += len(registros)
+        enlazados += n_enlazados
+        pendientes.extend(faltan)
+        errores.extend(ciclos)
     
-    cursor.execute('SELECT * FROM individuos WHERE traba = ?', (traba,))
-    gallos = cursor.fetchall()
+    if pendientes:
+        try:
+            n_enlazados, faltan, ciclos = enlazar(pendientes)
+            conn.commit()
+            errores.extend(ciclos)
+        except sqlite3.Error as e:
+            conn.rollback()
+            app.logger.error(f"❌ Error al enlazar progenitores pendientes: {e}")
+            errores.extend((n, placa, f"Registrado sin progenitores: error de base de datos: {e}")
+                           for n, placa, madre, padre in pendientes)
+            n_enlazados, faltan = 0, []
+        enlazados += n_enlazados
+        for n, placa, madre, padre in faltan:
+            ausente = madre if madre and madre not in placas else padre
+            errores.append((n, placa, f"Registrado sin progenitores: no existe la placa '{ausente}'."))
     
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['ID', 'Placa', 'Placa_Regional', 'Nombre', 'Raza', 'Color', 'Apariencia', 'N_Pelea', 'Nacimiento', 'Foto', 'Generacion', 'Codigo'])
+    return insertados, enlazados, sorted(errores)
+
+
+@app.route('/importar', methods=['GET', 'POST'])
+@proteger_ruta
+@csrf.exempt
+def importar():
+    """Importación masiva de gallos desde CSV o Excel"""
+    traba = session['traba']
+    if request.method == 'GET':
+        return f'''
+<!DOCTYPE html>
+<html><head><title>Importar Gallos</title>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<style>
+body {{ background:#01030a; color:white; font-family:sans-serif; padding:30px; text-align:center; }}
+input[type="file"] {{ margin:15px 0; padding:12px; background:rgba(0,0,0,0.3); color:white; border-radius:6px; }}
+button {{ padding:12px 25px; background:#00ffff; color:#041428; border:none; border-radius:6px; font-weight:bold; }}
+code {{ color:#00ffff; }}
+a {{ display:inline-block; margin-top:20px; color:#00ffff; text-decoration:none; }}
+</style>
+</head>
+<body>
+<h2 style="color:#00ffff;">📥 Importar Gallos</h2>
+<p>Archivo CSV o Excel (.xlsx) con encabezados:</p>
+<p><code>Placa, Placa_Regional, Nombre, Raza, Color, Apariencia, N_Pelea, Nacimiento, Generacion, Placa_Madre, Placa_Padre</code></p>
+<p style="color:#bbb;">Razas: {', '.join(RAZAS)}<br>Apariencias: {', '.join(APARIENCIAS)}</p>
+<form method="POST" enctype="multipart/form-data">
+    <input type="file" name="archivo" accept=".csv,.xlsx" required><br>
+    <button type="submit">📥 Importar</button>
+</form>
+<a href="/menu">🏠 Menú</a>
+</body></html>
+'''
     
-    for g in gallos:
-        writer.writerow([g['id'], g['placa_traba'], g['placa_regional'], g['nombre'], g['raza'], g['color'], g['apariencia'], g['n_pelea'], g['nacimiento'], g['foto'], g['generacion'], g['codigo']])
+    archivo = request.files.get('archivo')
+    if not archivo or not archivo.filename.lower().endswith(('.csv', '.xlsx')):
+        return '<script>alert("❌ Sube un archivo .csv o .xlsx"); window.location="/importar";</script>'
     
-    conn.close()
+    conn = get_db()
+    inicio = time.perf_counter()
+    try:
+        insertados, enlazados, errores = importar_individuos(conn, traba, leer_filas_importacion(archivo.stream, archivo.filename))
+    except Exception as e:
+        conn.rollback()
+        app.logger.error(f"❌ Error al leer el archivo de importación: {e}", exc_info=True)
+        return '<script>alert("❌ No se pudo leer el archivo. Verifica el formato."); window.location="/importar";</script>'
+    if insertados:
+        invalidar_autocompletar(traba)
+    app.logger.info(f"📥 Importación: {insertados} gallos, {enlazados} con progenitores, {len(errores)} errores en {time.perf_counter() - inicio:.1f}s (Traba: {traba})")
     
-    output.seek(0)
-    return Response(
-        output.getvalue(),
-        mimetype='text/csv',
-        headers={'Content-Disposition': f'attachment; filename=gallos_{traba}_{datetime.now().strftime("%Y%m%d")}.csv'}
+    filas_error = ''.join(
+        f'<tr><td style="padding:6px;">{n}</td><td style="padding:6px;">{placa or "—"}</td><td style="padding:6px;">{mensaje}</td></tr>'
+        for n, placa, mensaje in errores[:IMPORTAR_ERRORES_MAX]
     )
+    omitidos = f'<p style="color:#bbb;">… y {len(errores) - IMPORTAR_ERRORES_MAX} errores más.</p>' if len(errores) > IMPORTAR_ERRORES_MAX else ''
+    reporte = f'''
+<h3 style="color:#ff6b6b;">⚠️ {len(errores)} fila(s) con errores</h3>
+<table style="margin:0 auto;border-collapse:collapse;background:rgba(0,0,0,0.2);text-align:left;">
+<thead><tr style="color:#00ffff;"><th style="padding:6px;">Fila</th><th style="padding:6px;">Placa</th><th style="padding:6px;">Error</th></tr></thead>
+<tbody>{filas_error}</tbody>
+</table>{omitidos}''' if errores else ''
+    return f'''
+<!DOCTYPE html>
+<html><body style="background:#01030a;color:white;text-align:center;padding:30px;font-family:sans-serif;">
+<div style="background:rgba(0,255,255,0.1);padding:30px;border-radius:10px;max-width:800px;margin:0 auto;">
+    <h2 style="color:#00ffff;">📥 Importación terminada</h2>
+    <p>Gallos registrados: <strong>{insertados}</strong></p>
+    <p>Con progenitores enlazados: <strong>{enlazados}</strong></p>
+    {reporte}
+    <div style="margin-top:25px;">
+        <a href="/importar" style="display:inline-block;padding:12px 24px;background:#2ecc71;color:#041428;text-decoration:none;border-radius:6px;margin:5px;">📥 Importar otro</a>
+        <a href="/lista" style="display:inline-block;padding:12px 24px;background:#00ffff;color:#041428;text-decoration:none;border-radius:6px;margin:5px;">📋 Mis Gallos</a>
+    </div>
+</div>
+</body></html>
+'''
 
 
 # =============================================================================
 # RUTAS DE ÁRBOL GENEALÓGICO Y EDICIÓN
 # =============================================================================
 
+NOMBRES_GENERACION = {1: "Padres", 2: "Abuelos", 3: "Bisabuelos", 4: "Tatarabuelos"}
+
+
+def _etiqueta_ancestro(gen, es_madre, linea):
+    """Etiqueta de una posición del árbol: Madre, Abuelo P., Bisabuela M., Ancestro G5 P., ..."""
+    if gen == 1:
+        return "Madre" if es_madre else "Padre"
+    base = {2: ("Abuela", "Abuelo"), 3: ("Bisabuela", "Bisabuelo")}.get(gen, (f"Ancestra G{gen}", f"Ancestro G{gen}"))
+    return f"{base[0] if es_madre else base[1]} {linea}."
+
+
 @app.route('/arbol/<int:id>')
 @proteger_ruta
 def arbol_gallo(id):
     traba = session['traba']
-    conn = sqlite3.connect(DB)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    generaciones = _limitar_generaciones(request.args.get('gen'))
+    cursor = get_db().cursor()
     
-    cursor.execute('SELECT * FROM individuos WHERE traba = ? AND id = ?', (traba, id))
-    gallo = cursor.fetchone()
-    if not gallo:
-        conn.close()
+    arbol = obtener_ancestros(cursor, traba, id, generaciones)
+    if not arbol:
         return '<script>alert("❌ Gallo no encontrado."); window.location="/lista";</script>'
     
-    # Obtener padres
-    cursor.execute('SELECT madre_id, padre_id FROM progenitores WHERE individuo_id = ?', (id,))
-    prog = cursor.fetchone()
-    madre_id = prog['madre_id'] if prog else None
-    padre_id = prog['padre_id'] if prog else None
-    
-    madre = cursor.execute('SELECT * FROM individuos WHERE id = ?', (madre_id,)).fetchone() if madre_id else None
-    padre = cursor.execute('SELECT * FROM individuos WHERE id = ?', (padre_id,)).fetchone() if padre_id else None
-    
-    # Abuelos (simplificado)
-    def obtener_abuelos(individuo):
-        if not individuo:
-            return None, None
-        cursor.execute('SELECT madre_id, padre_id FROM progenitores WHERE individuo_id = ?', (individuo['id'],))
-        row = cursor.fetchone()
-        if not row:
-            return None, None
-        abuela = cursor.execute('SELECT * FROM individuos WHERE id = ?', (row['madre_id'],)).fetchone() if row['madre_id'] else None
-        abuelo = cursor.execute('SELECT * FROM individuos WHERE id = ?', (row['padre_id'],)).fetchone() if row['padre_id'] else None
-        return abuela, abuelo
-    
-    ab_materna, ab_materno = obtener_abuelos(madre)
-    ab_paterna, ab_paterno = obtener_abuelos(padre)
-    
-    # Hijos
-    cursor.execute('''
-        SELECT i.id, i.placa_traba, i.nombre, i.raza, i.color, i.foto
-        FROM individuos i
-        JOIN progenitores p ON i.id = p.individuo_id
-        WHERE p.madre_id = ? OR p.padre_id = ?
-    ''', (id, id))
-    hijos = cursor.fetchall()
+    descendientes = obtener_descendientes(cursor, traba, id, generaciones)
+    caracteristica = calcular_caracteristicas(cursor, traba, [id]).get(id, "—")
     
     def tarjeta(g, titulo):
         if not g:
             return f'<div style="background:rgba(0,0,0,0.2);padding:15px;border-radius:8px;"><p style="color:#7f8c8d;">{titulo}: Desconocido</p></div>'
         nombre = g['nombre'] or g['placa_traba']
-        foto = f'<img src="/uploads/{g["foto"]}" width="80" style="border-radius:8px;margin-bottom:10px;">' if g['foto'] else '<div style="width:80px;height:80px;background:rgba(0,0,0,0.3);border-radius:8px;margin:0 auto 10px;"></div>'
+        foto = f'<img src="{url_foto(g["foto"], 160)}" width="80" style="border-radius:8px;margin-bottom:10px;">' if g['foto'] else '<div style="width:80px;height:80px;background:rgba(0,0,0,0.3);border-radius:8px;margin:0 auto 10px;"></div>'
         return f'''<div style="background:rgba(0,0,0,0.2);padding:15px;border-radius:8px;text-align:center;">
-            {foto}<p style="margin:5px 0;"><strong>{nombre}</strong></p>
+            {foto}<p style="margin:5px 0;"><strong><a href="/arbol/{g['id']}?gen={generaciones}" style="color:white;text-decoration:none;">{nombre}</a></strong></p>
             <p style="font-size:0.9em;">Placa: {g['placa_traba']}</p>
-            <p style="font-size:0.8em;color:#bdc3c7;">{g['raza']}</p></div>'''
+            <p style="font-size:0.8em;color:#bdc3c7;">{titulo} • {g['raza']}</p></div>'''
     
-    conn.close()
+    # Ancestros por generación (madre primero), hasta que una fila quede vacía
+    filas_ancestros = ""
+    nivel = [(arbol, None)]
+    for gen in range(1, generaciones):
+        nivel = [
+            (nodo and nodo[rol], linea or ("M" if rol == 'madre' else "P"))
+            for nodo, linea in nivel
+            for rol in ('madre', 'padre')
+        ]
+        if not any(nodo for nodo, _ in nivel):
+            break
+        tarjetas = ''.join(
+            tarjeta(nodo, _etiqueta_ancestro(gen, i % 2 == 0, linea))
+            for i, (nodo, linea) in enumerate(nivel)
+        )
+        titulo = NOMBRES_GENERACION.get(gen, f"Generación {gen + 1}")
+        filas_ancestros += f'<div class="gen"><h3 style="width:100%;color:#00ffff;">{titulo}</h3>{tarjetas}</div>'
+    
+    # Descendientes agrupados por generación
+    hijos = [d for d in descendientes if d['gen'] == 1]
+    filas_descendientes = f'''<div class="gen"><h3 style="width:100%;color:#2ecc71;">Hijos ({len(hijos)})</h3>{''.join(tarjeta(h, "Hijo") for h in hijos) or '<p style="color:#7f8c8d;">— Sin hijos registrados —</p>'}</div>'''
+    for gen in range(2, generaciones):
+        grupo = [d for d in descendientes if d['gen'] == gen]
+        if not grupo:
+            break
+        titulo = "Nietos" if gen == 2 else f"Descendientes G{gen}"
+        filas_descendientes += f'''<div class="gen"><h3 style="width:100%;color:#2ecc71;">{titulo} ({len(grupo)})</h3>{''.join(tarjeta(d, titulo) for d in grupo)}</div>'''
+    
+    selector_gen = ' '.join(
+        f'<a href="/arbol/{id}?gen={n}" class="btn" style="padding:6px 12px;{"" if n == generaciones else "background:#2c3e50;color:white;"}">{n}</a>'
+        for n in range(2, ARBOL_GEN_MAX + 1)
+    )
     
     return f'''
 <!DOCTYPE html>
@@ -1616,15 +3713,18 @@ body{{background:#01030a;color:white;padding:20px;font-family:sans-serif;text-al
 </style>
 </head>
 <body>
-<h2 style="color:#00ffff;">🌳 Árbol: {gallo['placa_traba']}</h2>
+<h2 style="color:#00ffff;">🌳 Árbol: {arbol['placa_traba']}</h2>
+<p style="margin-bottom:20px;">Generaciones: {selector_gen}</p>
 <div class="tree">
-    <div><h3>Generación 1</h3>{tarjeta(gallo, "Principal")}</div>
-    <div class="gen"><h3 style="width:100%;color:#00ffff;">Padres</h3>{tarjeta(madre, "Madre")}{tarjeta(padre, "Padre")}</div>
-    <div class="gen"><h3 style="width:100%;color:#00ffff;">Abuelos</h3>{tarjeta(ab_materna, "Abuela M.")}{tarjeta(ab_materno, "Abuelo M.")}{tarjeta(ab_paterna, "Abuela P.")}{tarjeta(ab_paterno, "Abuelo P.")}</div>
-    <div class="gen"><h3 style="width:100%;color:#2ecc71;">Hijos ({len(hijos)})</h3>{''.join(tarjeta(h, h['nombre'] or h['placa_traba']) for h in hijos) or '<p style="color:#7f8c8d;">— Sin hijos registrados —</p>'}</div>
+    <div><h3>Generación 1</h3>{tarjeta(arbol, "Principal")}</div>
+    <div class="card" style="max-width:600px;"><strong>Característica clave:</strong><br><span style="color:#00ffff;">{caracteristica}</span></div>
+    {filas_ancestros}
+    {filas_descendientes}
 </div>
 <div style="margin-top:30px;">
-    <a href="/agregar-descendiente/{gallo['id']}" class="btn">➕ Agregar Progenitor</a>
+    <a href="/agregar-descendiente/{arbol['id']}" class="btn">➕ Agregar Progenitor</a>
+    <a href="/planificador/{arbol['id']}" class="btn" style="background:#9b59b6;color:white;">🧬 Planificar Cruce</a>
+    <a href="/api/arbol/{arbol['id']}?gen={generaciones}" class="btn" style="background:#f39c12;">🧾 JSON</a>
     <a href="/lista" class="btn" style="background:#2ecc71;">📋 Mis Gallos</a>
     <a href="/menu" class="btn" style="background:#7f8c8d;color:white;">🏠 Menú</a>
 </div>
@@ -1632,22 +3732,148 @@ body{{background:#01030a;color:white;padding:20px;font-family:sans-serif;text-al
 '''
 
 
+@app.route('/api/arbol/<int:id>')
+@proteger_ruta
+def api_arbol(id):
+    """Árbol genealógico en JSON (ancestros anidados + descendientes por generación)"""
+    traba = session['traba']
+    generaciones = _limitar_generaciones(request.args.get('gen'))
+    cursor = get_db().cursor()
+    
+    arbol = obtener_ancestros(cursor, traba, id, generaciones)
+    if not arbol:
+        return jsonify({"error": "Gallo no encontrado"}), 404
+    
+    return jsonify({
+        "generaciones": generaciones,
+        "gallo": arbol,
+        "descendientes": obtener_descendientes(cursor, traba, id, generaciones),
+        "caracteristica": calcular_caracteristicas(cursor, traba, [id]).get(id, "—"),
+    })
+
+
+def _parametros_planificador():
+    """Lee filtros y orden del planificador desde la query string"""
+    raza = request.args.get('raza', '').strip() or None
+    apariencia = request.args.get('apariencia', '').strip() or None
+    orden = request.args.get('orden', 'coi')
+    descendente = request.args.get('dir') == 'desc'
+    try:
+        limite = max(1, int(request.args.get('limite', PLANIFICADOR_LIMITE)))
+    except ValueError:
+        limite = PLANIFICADOR_LIMITE
+    return raza, apariencia, orden, descendente, limite
+
+
+@app.route('/planificador/<int:id>')
+@proteger_ruta
+def planificador(id):
+    traba = session['traba']
+    raza, apariencia, orden, descendente, limite = _parametros_planificador()
+    conn = get_db()
+    
+    gallo, candidatas = planificar_cruces(conn.cursor(), traba, id, raza, apariencia)
+    conn.commit()  # Persistir F recién calculadas
+    if not gallo:
+        return '<script>alert("❌ Gallo no encontrado."); window.location="/lista";</script>'
+    
+    total = len(candidatas)
+    candidatas = ordenar_candidatas(candidatas, orden, descendente)[:limite]
+    
+    filas_html = ''.join(f'''
+        <tr>
+            <td style="padding:8px;text-align:center;">{f'<img src="{url_foto(c["foto"], 64)}" width="40" style="border-radius:4px;">' if c["foto"] else "—"}</td>
+            <td style="padding:8px;"><a href="/arbol/{c['id']}" style="color:#00ffff;">{c['placa_traba']}</a></td>
+            <td style="padding:8px;">{c['nombre'] or "—"}</td>
+            <td style="padding:8px;">{c['raza'] or "—"}</td>
+            <td style="padding:8px;">{c['apariencia']}</td>
+            <td style="padding:8px;font-weight:bold;color:{"#2ecc71" if c['coi'] < 6.25 else "#f39c12" if c['coi'] < 12.5 else "#e74c3c"};">{c['coi']:.2f}%</td>
+            <td style="padding:8px;">{c['ancestros_comunes']}</td>
+            <td style="padding:8px;">{c['fundadores_comunes']}</td>
+        </tr>''' for c in candidatas)
+    
+    razas_html = ''.join(f'<option value="{r}" {"selected" if r == raza else ""}>{r}</option>' for r in RAZAS)
+    ap_html = ''.join(f'<option value="{a}" {"selected" if a == apariencia else ""}>{a}</option>' for a in APARIENCIAS)
+    ordenes_html = ''.join(
+        f'<option value="{v}" {"selected" if v == orden else ""}>{t}</option>'
+        for v, t in (('coi', 'COI'), ('comunes', 'Ancestros comunes'), ('fundadores', 'Fundadores comunes'), ('placa', 'Placa'))
+    )
+    
+    return f'''
+<!DOCTYPE html>
+<html><head><title>Planificador de Cruces</title>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<style>
+body{{background:#01030a;color:white;font-family:sans-serif;padding:20px;}}
+h2{{text-align:center;color:#00ffff;margin-bottom:10px;}}
+table{{width:100%;border-collapse:collapse;background:rgba(0,0,0,0.2);border-radius:10px;overflow:hidden;}}
+th,td{{padding:10px;text-align:left;border-bottom:1px solid rgba(0,255,255,0.2);}}
+th{{background:rgba(0,255,255,0.1);color:#00ffff;}}
+tr:hover{{background:rgba(0,255,255,0.05);}}
+form{{display:flex;gap:10px;flex-wrap:wrap;justify-content:center;margin:15px 0;}}
+select,button{{padding:8px;background:rgba(0,0,0,0.3);color:white;border:1px solid #00ffff;border-radius:6px;}}
+.back-btn{{display:inline-block;margin:20px 5px;padding:10px 20px;background:#2c3e50;color:white;text-decoration:none;border-radius:6px;}}
+</style>
+</head>
+<body>
+<h2>🧬 Planificador de Cruces: {gallo['placa_traba']}</h2>
+<p style="text-align:center;color:#bbb;">{gallo['nombre'] or ""} • F propia: {gallo['consanguinidad']:.2f}% • {total} candidata(s)</p>
+<form method="GET">
+    <select name="raza"><option value="">Todas las razas</option>{razas_html}</select>
+    <select name="apariencia"><option value="">Todas las apariencias</option>{ap_html}</select>
+    <select name="orden">{ordenes_html}</select>
+    <select name="dir"><option value="asc">Ascendente</option><option value="desc" {"selected" if descendente else ""}>Descendente</option></select>
+    <button type="submit">🔎 Aplicar</button>
+</form>
+<div style="overflow-x:auto;">
+<table>
+<thead><tr><th>Foto</th><th>Placa</th><th>Nombre</th><th>Raza</th><th>Apariencia</th><th>COI cría</th><th>Ancestros comunes</th><th>Fundadores comunes</th></tr></thead>
+<tbody>{filas_html or '<tr><td colspan="8" style="text-align:center;color:#7f8c8d;">— Sin candidatas —</td></tr>'}</tbody>
+</table>
+</div>
+<div style="text-align:center;">
+    <a href="/arbol/{id}" class="back-btn">🌳 Árbol</a>
+    <a href="/menu" class="back-btn">🏠 Menú</a>
+</div>
+</body></html>
+'''
+
+
+@app.route('/api/planificador/<int:id>')
+@proteger_ruta
+def api_planificador(id):
+    """Candidatas para cruzar con el gallo, ordenadas por COI de la descendencia, en JSON"""
+    traba = session['traba']
+    raza, apariencia, orden, descendente, limite = _parametros_planificador()
+    conn = get_db()
+    
+    gallo, candidatas = planificar_cruces(conn.cursor(), traba, id, raza, apariencia)
+    conn.commit()
+    if not gallo:
+        return jsonify({"error": "Gallo no encontrado"}), 404
+    
+    return jsonify({
+        "gallo": gallo,
+        "total": len(candidatas),
+        "candidatas": ordenar_candidatas(candidatas, orden, descendente)[:limite],
+    })
+
+
 @app.route('/editar-gallo/<int:id>', methods=['GET', 'POST'])
 @proteger_ruta
 @csrf.exempt
 def editar_gallo(id):
     traba = session['traba']
-    conn = sqlite3.connect(DB)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('SELECT * FROM individuos WHERE id = ? AND traba = ?', (id, traba))
     gallo = cursor.fetchone()
     if not gallo:
-        conn.close()
         return '<script>alert("❌ Gallo no encontrado."); window.location="/lista";</script>'
     
     if request.method == 'POST':
+        foto = None
         try:
             placa = request.form.get('placa_traba', '').strip()
             if not placa:
@@ -1678,16 +3904,17 @@ def editar_gallo(id):
                 file = request.files['foto']
                 if file and file.filename != '' and allowed_file(file.filename):
                     if is_valid_image(file.stream):
-                        # Eliminar foto anterior si existe
-                        if gallo['foto']:
-                            ruta_ant = os.path.join(app.config['UPLOAD_FOLDER'], gallo['foto'])
-                            if os.path.exists(ruta_ant):
-                                os.remove(ruta_ant)
                         fname = f"{secure_filename(placa)}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{secure_filename(file.filename)}"
-                        file.save(os.path.join(app.config['UPLOAD_FOLDER'], fname))
-                        cursor.execute('UPDATE individuos SET foto = ? WHERE id = ?', (fname, id))
+                        foto = guardar_subida(file, fname)
+                        cursor.execute('UPDATE individuos SET foto = ? WHERE id = ?', (foto, id))
             
             conn.commit()
+            if foto:
+                # La anterior se borra tras el commit; si aún se procesaba, el pool descarta su resultado
+                if gallo['foto'] and gallo['foto'] != foto:
+                    eliminar_foto(gallo['foto'])
+                encolar_foto(foto)
+            invalidar_autocompletar(traba)
             app.logger.info(f"✅ Gallo actualizado: {placa}")
             return f'<script>alert("✅ Gallo actualizado."); window.location="/arbol/{id}";</script>'
             
@@ -1696,17 +3923,16 @@ def editar_gallo(id):
             return f'<script>alert("❌ {str(e)}"); window.history.back();</script>'
         except Exception as e:
             conn.rollback()
+            if foto:
+                descartar_subida(foto)
             app.logger.error(f"❌ Error actualizando gallo: {e}", exc_info=True)
             return f'<script>alert("❌ Error del sistema."); window.history.back();</script>'
-        finally:
-            conn.close()
     
     # GET: mostrar formulario
     razas_html = ''.join([f'<option value="{r}" {"selected" if r == gallo["raza"] else ""}>{r}</option>' for r in RAZAS])
     ap_html = ''.join([f'<label><input type="radio" name="apariencia" value="{a}" {"checked" if a == gallo["apariencia"] else ""}> {a}</label> ' for a in APARIENCIAS])
-    foto_html = f'<img src="/uploads/{gallo["foto"]}" width="100" style="border-radius:8px;">' if gallo["foto"] else '<p style="color:#aaa;">Sin foto</p>'
+    foto_html = f'<img src="{url_foto(gallo["foto"], 160)}" width="100" style="border-radius:8px;">' if gallo["foto"] else '<p style="color:#aaa;">Sin foto</p>'
     
-    conn.close()
     return f'''
 <!DOCTYPE html>
 <html><head><title>Editar Gallo</title>
@@ -1744,18 +3970,27 @@ input,select{{width:100%;padding:10px;background:rgba(0,0,0,0.4);color:white;bor
 '''
 
 
+def eliminar_individuo(cursor, traba, id_):
+    """Borra un gallo y su fila de progenitores (los triggers dejan la lápida para /api/sync)"""
+    # Los descendientes pierden un progenitor: su F memorizada deja de valer
+    invalidar_consanguinidad(cursor, [id_])
+    
+    # Eliminar relaciones y gallo (CASCADE por FK)
+    cursor.execute('DELETE FROM progenitores WHERE individuo_id = ?', (id_,))
+    cursor.execute('DELETE FROM individuos WHERE id = ? AND traba = ?', (id_, traba))
+
+
 @app.route('/eliminar-gallo/<int:id>', methods=['GET', 'POST'])
 @proteger_ruta
 @csrf.exempt
 def eliminar_gallo(id):
     traba = session['traba']
-    conn = sqlite3.connect(DB)
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('SELECT placa_traba, foto FROM individuos WHERE id = ? AND traba = ?', (id, traba))
     resultado = cursor.fetchone()
     if not resultado:
-        conn.close()
         return '<script>alert("❌ Gallo no encontrado."); window.location="/lista";</script>'
     
     placa_correcta, foto_nombre = resultado
@@ -1770,21 +4005,18 @@ def eliminar_gallo(id):
                     if os.path.exists(ruta_foto):
                         os.remove(ruta_foto)
                         app.logger.info(f"🗑️ Foto eliminada: {foto_nombre}")
+                    eliminar_miniaturas(foto_nombre)
                 
-                # Eliminar relaciones y gallo (CASCADE por FK)
-                cursor.execute('DELETE FROM progenitores WHERE individuo_id = ?', (id,))
-                cursor.execute('DELETE FROM individuos WHERE id = ? AND traba = ?', (id, traba))
+                eliminar_individuo(cursor, traba, id)
                 conn.commit()
+                invalidar_autocompletar(traba)
                 app.logger.info(f"✅ Gallo eliminado: {placa_correcta}")
                 return f'<script>alert("✅ Gallo eliminado."); window.location="/lista";</script>'
             except Exception as e:
                 conn.rollback()
                 app.logger.error(f"❌ Error eliminando gallo: {e}", exc_info=True)
                 return f'<script>alert("❌ Error al eliminar."); window.history.back();</script>'
-            finally:
-                conn.close()
         else:
-            conn.close()
             return f'''
             <!DOCTYPE html><html><body style="background:#01030a;color:white;text-align:center;padding:40px;font-family:sans-serif;">
             <div style="background:rgba(231,76,60,0.2);padding:25px;border-radius:10px;max-width:500px;margin:0 auto;">
@@ -1797,7 +4029,6 @@ def eliminar_gallo(id):
             </div></body></html>
             '''
     
-    conn.close()
     return f'''
     <!DOCTYPE html><html><body style="background:#01030a;color:white;text-align:center;padding:40px;font-family:sans-serif;">
         <div style="background:rgba(231,76,60,0.2);padding:25px;border-radius:10px;max-width:500px;margin:0 auto;">
@@ -1813,6 +4044,781 @@ def eliminar_gallo(id):
     '''
 
 
+# =============================================================================
+# API REST v1 (JSON)
+# =============================================================================
+# Misma sesión que las páginas HTML. Las lecturas admiten ?campos= (alias
+# ?fields=) para pedir solo algunas columnas, paginación por keyset con
+# ?n= y ?despues=<cursor> (el cursor llega en "siguiente") y ETag/304.
+# Las escrituras exigen JSON: un formulario de otro sitio no puede
+# enviarlo sin preflight CORS, por eso van exentas de CSRF.
+
+CAMPOS_API_INDIVIDUOS = {
+    'id': 'i.id', 'placa_traba': 'i.placa_traba', 'placa_regional': 'i.placa_regional',
+    'nombre': 'i.nombre', 'raza': 'i.raza', 'color': 'i.color', 'apariencia': 'i.apariencia',
+    'n_pelea': 'i.n_pelea', 'nacimiento': 'i.nacimiento', 'foto': 'i.foto',
+    'generacion': 'i.generacion', 'codigo': 'i.codigo', 'consanguinidad': 'i.consanguinidad',
+    'madre_id': 'pr.madre_id', 'padre_id': 'pr.padre_id',
+}
+CAMPOS_API_CRUCES = ('id', 'tipo', 'individuo1_id', 'individuo2_id', 'generacion', 'porcentaje', 'fecha', 'notas', 'foto')
+CAMPOS_EDITABLES_API = ('placa_traba', 'placa_regional', 'nombre', 'raza', 'color', 'apariencia',
+                        'n_pelea', 'nacimiento', 'generacion', 'madre_id', 'padre_id')
+
+
+def proteger_api(f):
+    """Como proteger_ruta, pero sin sesión responde 401 en JSON en lugar de redirigir"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if 'traba' not in session:
+            return jsonify({"error": "No autenticado"}), 401
+        try:
+            return f(*args, **kwargs)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    return wrapper
+
+
+def respuesta_api(datos, status=200):
+    """JSON con ETag fuerte (las lecturas responden 304 si no cambió)"""
+    resp = jsonify(datos)
+    resp.status_code = status
+    if request.method == 'GET' and status == 200:
+        resp.add_etag()
+        resp.cache_control.private = True
+        resp.cache_control.no_cache = True
+        resp = resp.make_conditional(request)
+    return resp
+
+
+def _campos_api(disponibles):
+    """Columnas pedidas en ?campos= / ?fields= (todas si falta); `id` siempre va incluido"""
+    texto = request.args.get('campos') or request.args.get('fields')
+    if not texto:
+        return list(disponibles)
+    campos = [c.strip() for c in texto.split(',') if c.strip()]
+    desconocidos = [c for c in campos if c not in disponibles]
+    if desconocidos:
+        raise ValueError(f"Campos no válidos: {', '.join(desconocidos)}")
+    return ['id'] + [c for c in dict.fromkeys(campos) if c != 'id']
+
+
+def _pagina_api():
+    """(n, id de la última fila vista) desde ?n= y ?despues="""
+    try:
+        n = max(1, min(int(request.args.get('n', API_POR_PAGINA)), API_POR_PAGINA_MAX))
+    except ValueError:
+        n = API_POR_PAGINA
+    despues = decodificar_cursor(request.args.get('despues'))
+    return n, (despues[0] if despues and es_entero_json(despues[0]) else None)
+
+
+def es_entero_json(valor):
+    """Entero de JSON (en Python True/False también son int)"""
+    return isinstance(valor, int) and not isinstance(valor, bool)
+
+
+def _ids_api(texto):
+    """Lista de ids de ?ids=1,2,3 (como mucho LOTE_SQL)"""
+    try:
+        ids = [int(x) for x in texto.split(',') if x.strip()]
+    except ValueError:
+        raise ValueError("ids debe ser una lista de enteros separada por comas.")
+    if len(ids) > LOTE_SQL:
+        raise ValueError(f"Como mucho {LOTE_SQL} ids por petición.")
+    return ids
+
+
+def consultar_individuos_api(cursor, traba, campos, filtros=None, ids=None, hijos_de=None, despues=None, limite=None):
+    """Filas de individuos con solo las columnas pedidas, en orden de id (keyset)"""
+    where, params = _condiciones_lista(traba, filtros or {})
+    if ids is not None:
+        where += f" AND i.id IN ({','.join('?' * len(ids))})"
+        params += ids
+    if hijos_de is not None:
+        where += ' AND i.id IN (SELECT individuo_id FROM progenitores WHERE madre_id = ? OR padre_id = ?)'
+        params += [hijos_de, hijos_de]
+    if despues is not None:
+        where += ' AND i.id > ?'
+        params.append(despues)
+    union = 'LEFT JOIN progenitores pr ON pr.individuo_id = i.id' if {'madre_id', 'padre_id'} & set(campos) else ''
+    sql = f"SELECT {', '.join(f'{CAMPOS_API_INDIVIDUOS[c]} AS {c}' for c in campos)} FROM individuos i {union} WHERE {where} ORDER BY i.id"
+    if limite is not None:
+        sql += ' LIMIT ?'
+        params.append(limite)
+    cursor.execute(sql, params)
+    return [dict(r) for r in cursor.fetchall()]
+
+
+def _pagina_json(filas, n):
+    """{"datos", "siguiente"}: pide n + 1 filas para saber si hay más"""
+    siguiente = codificar_cursor([filas[n - 1]['id']]) if len(filas) > n else None
+    return {"datos": filas[:n], "siguiente": siguiente}
+
+
+def _lote_json():
+    """Elementos del cuerpo JSON (lista u objeto suelto) de una escritura masiva"""
+    if not request.is_json:
+        raise ValueError("El cuerpo debe ser JSON (Content-Type: application/json).")
+    cuerpo = request.get_json(silent=True)
+    elementos = [cuerpo] if isinstance(cuerpo, dict) else cuerpo
+    if not isinstance(elementos, list) or not all(isinstance(e, dict) for e in elementos):
+        raise ValueError("Se espera un objeto o una lista de objetos.")
+    if len(elementos) > API_LOTE_MAX:
+        raise ValueError(f"Como mucho {API_LOTE_MAX} elementos por petición.")
+    return elementos
+
+
+def _ids_por_placa(cursor, traba, placas):
+    """{placa: id} de las placas indicadas que existen en la traba"""
+    placas, encontrados = list(dict.fromkeys(placas)), {}
+    for i in range(0, len(placas), LOTE_SQL):
+        parte = placas[i:i + LOTE_SQL]
+        cursor.execute(f"SELECT placa_traba, id FROM individuos WHERE traba = ? AND placa_traba IN ({','.join('?' * len(parte))})", (traba, *parte))
+        encontrados.update(cursor.fetchall())
+    return encontrados
+
+
+def _ids_de_traba(cursor, traba, ids):
+    """Subconjunto de `ids` que pertenece a la traba"""
+    propios = set()
+    for filtro, params in _filtro_ids(ids, traba):
+        cursor.execute(f'SELECT id FROM individuos WHERE traba = ? AND id {filtro}', (traba, *params))
+        propios.update(r[0] for r in cursor.fetchall())
+    return propios
+
+
+def error_compuestos(datos):
+    """Mensaje de error si algún valor JSON es un objeto o una lista (None si todos son escalares)"""
+    compuestos = [k for k, v in datos.items() if isinstance(v, (dict, list))]
+    return f"Se espera texto o número en: {', '.join(compuestos)}." if compuestos else None
+
+
+def placas_en_ciclo(filas):
+    """Placas de un lote que serían ancestro de sí mismas por madre/padre del propio lote.
+
+    Los gallos ya registrados no tienen progenitores en el lote, así que un
+    ciclo solo puede formarse entre elementos del lote.
+    """
+    padres = {}
+    for _, datos in filas:
+        if datos.get('placa'):
+            padres.setdefault(datos['placa'], [p for p in (datos.get('madre'), datos.get('padre')) if p])
+    en_ciclo = set()
+    for placa, directos in padres.items():
+        pila, vistos = list(directos), set()
+        while pila:
+            actual = pila.pop()
+            if actual == placa:
+                en_ciclo.add(placa)
+                break
+            if actual in padres and actual not in vistos:
+                vistos.add(actual)
+                pila.extend(padres[actual])
+    return en_ciclo
+
+
+def validar_edicion_api(cursor, elemento, propios):
+    """Devuelve ({columna: valor}, error) de un elemento de PATCH /api/v1/individuos"""
+    id_ = elemento.get('id')
+    if not es_entero_json(id_) or id_ not in propios:
+        return None, "Gallo no encontrado."
+    cambios = {k: v for k, v in elemento.items() if k != 'id'}
+    desconocidos = [k for k in cambios if k not in CAMPOS_EDITABLES_API]
+    if desconocidos:
+        return None, f"Campos no editables: {', '.join(desconocidos)}."
+    error = error_compuestos(cambios)
+    if error:
+        return None, error
+    for campo in ('placa_traba', 'color'):
+        if campo in cambios and not str(cambios[campo] or '').strip():
+            return None, f"El campo {campo} es obligatorio."
+    if 'raza' in cambios:
+        cambios['raza'] = next((r for r in RAZAS if r.lower() == str(cambios['raza'] or '').lower()), None)
+        if not cambios['raza']:
+            return None, f"Raza no válida: '{elemento['raza']}'."
+    if 'apariencia' in cambios:
+        cambios['apariencia'] = next((a for a in APARIENCIAS if a.lower() == str(cambios['apariencia'] or '').lower()), None)
+        if not cambios['apariencia']:
+            return None, f"Apariencia no válida: '{elemento['apariencia']}'."
+    if 'generacion' in cambios and not es_entero_json(cambios['generacion']):
+        return None, "La generación debe ser un entero."
+    for campo in ('madre_id', 'padre_id'):
+        if cambios.get(campo) is not None and (not es_entero_json(cambios[campo]) or cambios[campo] not in propios
+                                               or cambios[campo] == id_):
+            return None, f"{campo} no válido."
+    if cambios.get('madre_id') is not None and cambios.get('madre_id') == cambios.get('padre_id'):
+        return None, "La madre y el padre no pueden ser el mismo gallo."
+    padres = [cambios[c] for c in ('madre_id', 'padre_id') if cambios.get(c) is not None]
+    if padres and crearia_ciclo(cursor, id_, padres):
+        return None, "Un progenitor no puede ser descendiente del propio gallo."
+    for campo in ('placa_traba', 'placa_regional', 'nombre', 'color', 'n_pelea', 'nacimiento'):
+        if campo in cambios:
+            cambios[campo] = str(cambios[campo]).strip() if cambios[campo] is not None else None
+            cambios[campo] = cambios[campo] or None
+    return cambios, None
+
+
+def aplicar_edicion(cursor, traba, id_, cambios):
+    """Aplica cambios ya validados (validar_edicion_api) a un gallo; True si cambiaron sus progenitores"""
+    columnas = {k: v for k, v in cambios.items() if k not in ('madre_id', 'padre_id')}
+    if columnas:
+        cursor.execute(f"UPDATE individuos SET {', '.join(f'{c} = ?' for c in columnas)} WHERE id = ? AND traba = ?",
+                       (*columnas.values(), id_, traba))
+    if 'madre_id' not in cambios and 'padre_id' not in cambios:
+        return False
+    actual = cursor.execute('SELECT madre_id, padre_id FROM progenitores WHERE individuo_id = ?', (id_,)).fetchone()
+    madre = cambios['madre_id'] if 'madre_id' in cambios else (actual[0] if actual else None)
+    padre = cambios['padre_id'] if 'padre_id' in cambios else (actual[1] if actual else None)
+    cursor.execute('''
+        INSERT INTO progenitores (individuo_id, madre_id, padre_id) VALUES (?, ?, ?)
+        ON CONFLICT(individuo_id) DO UPDATE SET madre_id = excluded.madre_id, padre_id = excluded.padre_id
+    ''', (id_, madre, padre))
+    return True
+
+
+@app.route('/api/v1/individuos')
+@proteger_api
+def api_individuos():
+    """Lista por keyset (con los filtros de /lista) o lote por ?ids="""
+    cursor = get_db().cursor()
+    campos = _campos_api(CAMPOS_API_INDIVIDUOS)
+    if request.args.get('ids'):
+        ids = _ids_api(request.args['ids'])
+        return respuesta_api({"datos": consultar_individuos_api(cursor, session['traba'], campos, ids=ids) if ids else []})
+    n, despues = _pagina_api()
+    filas = consultar_individuos_api(cursor, session['traba'], campos, leer_filtros_lista(request.args),
+                                     despues=despues, limite=n + 1)
+    return respuesta_api(_pagina_json(filas, n))
+
+
+@app.route('/api/v1/individuos/<int:id>')
+@proteger_api
+def api_individuo(id):
+    filas = consultar_individuos_api(get_db().cursor(), session['traba'], _campos_api(CAMPOS_API_INDIVIDUOS), ids=[id])
+    if not filas:
+        return jsonify({"error": "Gallo no encontrado"}), 404
+    return respuesta_api(filas[0])
+
+
+@app.route('/api/v1/individuos/<int:id>/pedigri')
+@proteger_api
+def api_pedigri(id):
+    """Ancestros anidados (padre/madre) hasta ?gen= generaciones"""
+    campos = _campos_api(CAMPOS_PEDIGRI)
+    arbol = obtener_ancestros(get_db().cursor(), session['traba'], id, _limitar_generaciones(request.args.get('gen')))
+    if not arbol:
+        return jsonify({"error": "Gallo no encontrado"}), 404
+    
+    def recortar(nodo):
+        if nodo is None:
+            return None
+        return {**{c: nodo[c] for c in campos}, 'gen': nodo['gen'],
+                'padre': recortar(nodo['padre']), 'madre': recortar(nodo['madre'])}
+    
+    return respuesta_api(recortar(arbol))
+
+
+@app.route('/api/v1/individuos/<int:id>/hijos')
+@proteger_api
+def api_hijos(id):
+    cursor = get_db().cursor()
+    if not _ids_de_traba(cursor, session['traba'], [id]):
+        return jsonify({"error": "Gallo no encontrado"}), 404
+    n, despues = _pagina_api()
+    filas = consultar_individuos_api(cursor, session['traba'], _campos_api(CAMPOS_API_INDIVIDUOS),
+                                     hijos_de=id, despues=despues, limite=n + 1)
+    return respuesta_api(_pagina_json(filas, n))
+
+
+@app.route('/api/v1/individuos', methods=['POST'])
+@proteger_api
+@csrf.exempt
+def api_crear_individuos():
+    """Alta masiva con las mismas reglas que /importar (progenitores por placa)"""
+    traba = session['traba']
+    elementos = _lote_json()
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    filas, rechazos = [], []
+    for n, elemento in enumerate(elementos):
+        error = error_compuestos(elemento)
+        if error:
+            rechazos.append((n, str(elemento.get('placa') or ''), error))
+            continue
+        datos = {}
+        for clave, valor in elemento.items():
+            if clave in COLUMNAS_IMPORTACION:
+                datos[COLUMNAS_IMPORTACION[clave]] = _valor_celda(valor)
+        filas.append((n, datos))
+    # Un ciclo en el propio lote se rechaza entero antes de insertar nada de él
+    en_ciclo = placas_en_ciclo(filas)
+    rechazos.extend((n, d['placa'], "El pedigrí del lote forma un ciclo: este gallo sería su propio ancestro.")
+                    for n, d in filas if d.get('placa') in en_ciclo)
+    filas = [(n, d) for n, d in filas if d.get('placa') not in en_ciclo]
+    placas = [d['placa'] for _, d in filas if d.get('placa')]
+    previas = _ids_por_placa(cursor, traba, placas)
+    bloques = (filas[i:i + LOTE_IMPORTACION] for i in range(0, len(filas), LOTE_IMPORTACION))
+    insertados, _, errores = importar_individuos(conn, traba, bloques)
+    errores = sorted(errores + rechazos)
+    if insertados:
+        invalidar_autocompletar(traba)
+    
+    nuevas = _ids_por_placa(cursor, traba, [p for p in placas if p not in previas])
+    return respuesta_api({
+        "creados": [{"id": nuevas[p], "placa_traba": p} for p in dict.fromkeys(placas) if p in nuevas],
+        "errores": [{"indice": n, "placa": placa, "error": error} for n, placa, error in errores],
+    }, 201 if insertados else 422)
+
+
+@app.route('/api/v1/individuos', methods=['PATCH'])
+@proteger_api
+@csrf.exempt
+def api_editar_individuos():
+    """Edición masiva: [{"id": 1, "nombre": "...", "madre_id": 7}, ...]; cada elemento se aplica o falla por separado"""
+    traba = session['traba']
+    elementos = _lote_json()
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    referencias = [v for e in elementos for k, v in e.items() if k in ('id', 'madre_id', 'padre_id') and es_entero_json(v)]
+    propios = _ids_de_traba(cursor, traba, referencias) if referencias else set()
+    actualizados, errores, con_padres_nuevos = [], [], []
+    
+    for n, elemento in enumerate(elementos):
+        cambios, error = validar_edicion_api(cursor, elemento, propios)
+        if error:
+            errores.append({"indice": n, "id": elemento.get('id'), "error": error})
+            continue
+        id_ = elemento['id']
+        cursor.execute('SAVEPOINT api_edicion')
+        try:
+            if aplicar_edicion(cursor, traba, id_, cambios):
+                con_padres_nuevos.append(id_)
+            cursor.execute('RELEASE api_edicion')
+        except sqlite3.IntegrityError:
+            cursor.execute('ROLLBACK TO api_edicion')
+            cursor.execute('RELEASE api_edicion')
+            errores.append({"indice": n, "id": id_, "error": f"Ya existe un gallo con placa '{cambios.get('placa_traba')}' en tu traba."})
+            continue
+        actualizados.append(id_)
+    
+    if con_padres_nuevos:
+        invalidar_consanguinidad(cursor, con_padres_nuevos)
+    conn.commit()
+    if actualizados:
+        invalidar_autocompletar(traba)
+    return respuesta_api({"actualizados": actualizados, "errores": errores}, 200 if actualizados else 422)
+
+
+@app.route('/api/v1/cruces')
+@app.route('/api/v1/cruces/<int:id>')
+@proteger_api
+def api_cruces(id=None):
+    """Lista de cruces por keyset (?tipo= opcional) o un cruce"""
+    campos = _campos_api(CAMPOS_API_CRUCES)
+    where, params = ['traba = ?'], [session['traba']]
+    if id is not None:
+        where.append('id = ?')
+        params.append(id)
+    elif request.args.get('tipo'):
+        where.append('tipo = ?')
+        params.append(request.args['tipo'])
+    n, despues = _pagina_api()
+    if id is None and despues is not None:
+        where.append('id > ?')
+        params.append(despues)
+    cursor = get_db().cursor()
+    cursor.execute(f"SELECT {', '.join(campos)} FROM cruces WHERE {' AND '.join(where)} ORDER BY id LIMIT ?", (*params, n + 1))
+    filas = [dict(r) for r in cursor.fetchall()]
+    if id is not None:
+        return respuesta_api(filas[0]) if filas else (jsonify({"error": "Cruce no encontrado"}), 404)
+    return respuesta_api(_pagina_json(filas, n))
+
+
+# =============================================================================
+# SINCRONIZACIÓN INCREMENTAL (clientes sin conexión)
+# =============================================================================
+# Cada alta o cambio en individuos, progenitores y cruces recibe, por
+# trigger, el siguiente valor del contador global secuencias['version'];
+# cada borrado deja una lápida en `eliminados` con su propia versión. Como
+# SQLite serializa las escrituras, las versiones crecen en orden de commit:
+# GET /api/sync?since=<v> devuelve exactamente lo cambiado después de v.
+# POST /api/sync aplica un lote del cliente en una sola transacción; cada
+# edición o borrado lleva la versión en que se basa y, si la fila cambió
+# desde entonces, el lote entero se rechaza con 409 y las filas actuales.
+# madre_id/padre_id viven en `progenitores`: si una edición de individuos
+# los trae, se comprueban contra `version_base_progenitores`.
+
+# tabla: (clave que ve el cliente, columnas que cuentan como cambio, traba de la fila borrada)
+TABLAS_SINCRONIZADAS = {
+    'individuos': ('id', ('traba', 'placa_traba', 'placa_regional', 'nombre', 'raza', 'color', 'apariencia',
+                          'n_pelea', 'nacimiento', 'foto', 'generacion', 'codigo'), 'OLD.traba'),
+    'progenitores': ('individuo_id', ('individuo_id', 'madre_id', 'padre_id'),
+                     '(SELECT traba FROM individuos WHERE id = OLD.individuo_id)'),
+    'cruces': ('id', ('traba', 'tipo', 'individuo1_id', 'individuo2_id', 'generacion', 'porcentaje',
+                      'fecha', 'notas', 'foto'), 'OLD.traba'),
+}
+CAMPOS_SYNC_CRUCES = ('tipo', 'fecha', 'notas')  # Editables de un cruce desde el cliente
+
+
+def crear_seguimiento_cambios(cursor):
+    """Columna `version`, lápidas y triggers de versión (numera las filas previas una vez)"""
+    cursor.execute("INSERT OR IGNORE INTO secuencias (nombre, clave) VALUES ('version', '')")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS eliminados (
+        version INTEGER PRIMARY KEY,
+        tabla TEXT NOT NULL,
+        fila_id INTEGER NOT NULL,
+        traba TEXT NOT NULL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_eliminados_traba_version ON eliminados(traba, version)')
+    
+    siguiente = "(SELECT valor FROM secuencias WHERE nombre = 'version')"
+    incrementar = "UPDATE secuencias SET valor = valor + 1 WHERE nombre = 'version';"
+    for tabla, (clave, columnas, traba_borrada) in TABLAS_SINCRONIZADAS.items():
+        if 'version' not in [col[1] for col in cursor.execute(f"PRAGMA table_info({tabla})").fetchall()]:
+            cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN version INTEGER")
+            # Filas ya existentes: versiones consecutivas a partir del contador actual
+            cursor.execute(f"UPDATE {tabla} SET version = {siguiente} + rowid")
+            cursor.execute(f"UPDATE secuencias SET valor = valor + (SELECT COALESCE(MAX(rowid), 0) FROM {tabla}) WHERE nombre = 'version'")
+        if tabla == 'progenitores':
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_progenitores_version ON progenitores(version)')
+        else:
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{tabla}_traba_version ON {tabla}(traba, version)')
+        
+        asignar = f"UPDATE {tabla} SET version = {siguiente} WHERE rowid = NEW.rowid;"
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_version_ai AFTER INSERT ON {tabla}
+            BEGIN {incrementar} {asignar} END
+        ''')
+        # Solo columnas de datos: la F memorizada (consanguinidad) no es un cambio del usuario
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_version_au AFTER UPDATE OF {', '.join(columnas)} ON {tabla}
+            BEGIN {incrementar} {asignar} END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_version_ad AFTER DELETE ON {tabla}
+            BEGIN
+                {incrementar}
+                INSERT INTO eliminados (version, tabla, fila_id, traba)
+                SELECT {siguiente}, '{tabla}', OLD.{clave}, {traba_borrada} WHERE {traba_borrada} IS NOT NULL;
+            END
+        ''')
+
+
+def consultar_filas_sync(cursor, traba, tabla, ids):
+    """Filas completas (con su versión) de una tabla sincronizada, por clave"""
+    filas = []
+    for filtro, params in _filtro_ids(ids, None):
+        if tabla == 'individuos':
+            columnas = ', '.join(c for c in CAMPOS_API_INDIVIDUOS if c not in ('madre_id', 'padre_id', 'consanguinidad'))
+            cursor.execute(f"SELECT {columnas}, version FROM individuos WHERE traba = ? AND id {filtro}", (traba, *params))
+        elif tabla == 'progenitores':
+            cursor.execute(f'''
+                SELECT p.individuo_id, p.madre_id, p.padre_id, p.version FROM progenitores p
+                JOIN individuos i ON i.id = p.individuo_id
+                WHERE i.traba = ? AND p.individuo_id {filtro}
+            ''', (traba, *params))
+        else:
+            cursor.execute(f"SELECT {', '.join(CAMPOS_API_CRUCES)}, version FROM cruces WHERE traba = ? AND id {filtro}", (traba, *params))
+        filas.extend(dict(r) for r in cursor.fetchall())
+    return sorted(filas, key=lambda f: f['version'])
+
+
+def consultar_cambios(cursor, traba, desde, limite):
+    """Cambios de la traba con versión > desde, en orden de versión: (cambios, hasta, hay_mas)"""
+    cursor.execute('''
+        SELECT tabla, fila_id, version, borrado FROM (
+            SELECT 'individuos' AS tabla, id AS fila_id, version, 0 AS borrado FROM individuos WHERE traba = ? AND version > ?
+            UNION ALL
+            SELECT 'progenitores', p.individuo_id, p.version, 0 FROM progenitores p
+            JOIN individuos i ON i.id = p.individuo_id WHERE i.traba = ? AND p.version > ?
+            UNION ALL
+            SELECT 'cruces', id, version, 0 FROM cruces WHERE traba = ? AND version > ?
+            UNION ALL
+            SELECT tabla, fila_id, version, 1 FROM eliminados WHERE traba = ? AND version > ?
+        ) ORDER BY version LIMIT ?
+    ''', (traba, desde) * 4 + (limite + 1,))
+    marcas = cursor.fetchall()
+    hay_mas = len(marcas) > limite
+    marcas = marcas[:limite]
+    
+    cambios = {tabla: [] for tabla in TABLAS_SINCRONIZADAS}
+    cambios['eliminados'] = [{"tabla": m['tabla'], "id": m['fila_id'], "version": m['version']} for m in marcas if m['borrado']]
+    for tabla in TABLAS_SINCRONIZADAS:
+        ids = [m['fila_id'] for m in marcas if m['tabla'] == tabla and not m['borrado']]
+        if ids:
+            cambios[tabla] = consultar_filas_sync(cursor, traba, tabla, ids)
+    return cambios, (marcas[-1]['version'] if marcas else desde), hay_mas
+
+
+def version_fila(cursor, traba, tabla, id_):
+    """Versión actual de una fila de la traba (None si no existe)"""
+    filas = consultar_filas_sync(cursor, traba, tabla, [id_])
+    return filas[0]['version'] if filas else None
+
+
+class ConflictoSync(Exception):
+    """La fila cambió en el servidor después de la versión en que se basa el cliente"""
+
+
+def aplicar_cambios_sync(cursor, traba, cambios):
+    """Aplica en orden los cambios de un lote del cliente (dentro de la transacción del llamador).
+
+    Los ids pueden ser enteros (filas del servidor) o cadenas: referencias
+    locales a filas creadas antes en el mismo lote. Devuelve
+    (referencias {ref: id}, fotos a borrar, errores, conflictos).
+    """
+    referencias, fotos, errores, conflictos, con_padres_nuevos = {}, [], [], [], []
+    enteros = [v for c in cambios if isinstance(c.get('datos') or {}, dict)
+               for v in [c.get('id'), *(c.get('datos') or {}).values()] if es_entero_json(v)]
+    propios = _ids_de_traba(cursor, traba, enteros) if enteros else set()
+    
+    def resolver(valor):
+        if isinstance(valor, str):
+            if valor not in referencias:
+                raise ValueError(f"Referencia desconocida: '{valor}'.")
+            return referencias[valor]
+        if valor is not None and not es_entero_json(valor):
+            raise ValueError(f"Id no válido: {json.dumps(valor)}.")
+        return valor
+    
+    def comprobar_version(tabla, id_, base, obligatoria=True):
+        actual = version_fila(cursor, traba, tabla, id_)
+        if actual is None and not obligatoria:
+            return
+        if actual is None or actual != base:
+            fila = consultar_filas_sync(cursor, traba, tabla, [id_])
+            raise ConflictoSync({"tabla": tabla, "id": id_, "version": actual, "fila": fila[0] if fila else None})
+    
+    for n, cambio in enumerate(cambios):
+        tabla, op, datos = cambio.get('tabla'), cambio.get('op'), cambio.get('datos') or {}
+        try:
+            if not isinstance(datos, dict):
+                raise ValueError("'datos' debe ser un objeto.")
+            error = error_compuestos(datos)
+            if error:
+                raise ValueError(error)
+            datos = dict(datos)
+            ref = cambio.get('ref')
+            if ref is not None and not (isinstance(ref, str) or es_entero_json(ref)):
+                raise ValueError(f"Referencia no válida: {json.dumps(ref)}.")
+            for campo in ('madre_id', 'padre_id', 'individuo_id', 'individuo1_id', 'individuo2_id'):
+                if campo in datos:
+                    datos[campo] = resolver(datos[campo])
+            
+            if tabla == 'individuos' and op == 'crear':
+                fila = {COLUMNAS_IMPORTACION[k]: _valor_celda(v) for k, v in datos.items()
+                        if k in COLUMNAS_IMPORTACION and COLUMNAS_IMPORTACION[k] not in ('madre', 'padre')}
+                registro, error = validar_fila_importacion(fila, _ids_por_placa(cursor, traba, [fila.get('placa', '')]))
+                if error:
+                    raise ValueError(error)
+                cursor.execute('''
+                    INSERT INTO individuos
+                    (traba, placa_traba, placa_regional, nombre, raza, color, apariencia, n_pelea, nacimiento, generacion, codigo)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (traba, *registro, reservar_codigos(cursor, 1)[0]))
+                id_ = cursor.lastrowid
+                propios.add(id_)
+                if ref is not None:
+                    referencias[str(ref)] = id_
+                padres = {k: datos[k] for k in ('madre_id', 'padre_id') if datos.get(k) is not None}
+                if padres:
+                    cambios_padres, error = validar_edicion_api(cursor, {'id': id_, **padres}, propios)
+                    if error:
+                        raise ValueError(error)
+                    aplicar_edicion(cursor, traba, id_, cambios_padres)
+            
+            elif tabla in ('individuos', 'progenitores') and op == 'editar':
+                id_ = resolver(cambio.get('id'))
+                comprobar_version(tabla, id_, cambio.get('version_base'), obligatoria=(tabla == 'individuos'))
+                if tabla == 'progenitores':
+                    datos = {k: v for k, v in datos.items() if k in ('madre_id', 'padre_id')}
+                elif 'madre_id' in datos or 'padre_id' in datos:
+                    comprobar_version('progenitores', id_, cambio.get('version_base_progenitores'), obligatoria=False)
+                cambios_validos, error = validar_edicion_api(cursor, {'id': id_, **datos}, propios)
+                if error:
+                    raise ValueError(error)
+                if aplicar_edicion(cursor, traba, id_, cambios_validos):
+                    con_padres_nuevos.append(id_)
+            
+            elif tabla == 'individuos' and op == 'eliminar':
+                id_ = resolver(cambio.get('id'))
+                comprobar_version(tabla, id_, cambio.get('version_base'))
+                foto = cursor.execute('SELECT foto FROM individuos WHERE id = ?', (id_,)).fetchone()[0]
+                eliminar_individuo(cursor, traba, id_)
+                if foto:
+                    fotos.append(foto)
+            
+            elif tabla == 'cruces' and op == 'crear':
+                id1, id2 = datos.get('individuo1_id'), datos.get('individuo2_id')
+                if id1 not in propios or id2 not in propios:
+                    raise ValueError("Los ejemplares del cruce no existen en tu traba.")
+                if id1 == id2:
+                    raise ValueError("No puedes cruzar un gallo consigo mismo.")
+                if not str(datos.get('tipo') or '').strip():
+                    raise ValueError("Selecciona un tipo de cruce.")
+                cursor.execute('''
+                    SELECT 1 FROM cruces
+                    WHERE traba = ? AND ((individuo1_id = ? AND individuo2_id = ?) OR (individuo1_id = ? AND individuo2_id = ?))
+                    LIMIT 1
+                ''', (traba, id1, id2, id2, id1))
+                if cursor.fetchone():
+                    raise ValueError("Este cruce ya está registrado.")
+                porcentaje = round(calcular_coi(cursor, id1, id2) * 100, 4)
+                cursor.execute('''
+                    INSERT INTO cruces (traba, tipo, individuo1_id, individuo2_id, generacion, porcentaje, fecha, notas)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (traba, str(datos['tipo']).strip(), id1, id2, 1, porcentaje,
+                      datos.get('fecha') or datetime.now().strftime('%Y-%m-%d'), datos.get('notas')))
+                if ref is not None:
+                    referencias[str(ref)] = cursor.lastrowid
+            
+            elif tabla == 'cruces' and op in ('editar', 'eliminar'):
+                id_ = resolver(cambio.get('id'))
+                comprobar_version(tabla, id_, cambio.get('version_base'))
+                if op == 'eliminar':
+                    cursor.execute('DELETE FROM cruces WHERE id = ? AND traba = ?', (id_, traba))
+                else:
+                    columnas = {k: v for k, v in datos.items() if k in CAMPOS_SYNC_CRUCES}
+                    if columnas:
+                        cursor.execute(f"UPDATE cruces SET {', '.join(f'{c} = ?' for c in columnas)} WHERE id = ? AND traba = ?",
+                                       (*columnas.values(), id_, traba))
+            
+            else:
+                raise ValueError(f"Operación no válida: {tabla}/{op}.")
+        
+        except ConflictoSync as e:
+            conflictos.append({"indice": n, **e.args[0]})
+        except ValueError as e:
+            errores.append({"indice": n, "error": str(e)})
+        except sqlite3.IntegrityError as e:
+            errores.append({"indice": n, "error": f"Restricción de la base de datos: {e}"})
+        except sqlite3.Error as e:
+            errores.append({"indice": n, "error": f"Error de base de datos: {e}"})
+    
+    if con_padres_nuevos:
+        invalidar_consanguinidad(cursor, con_padres_nuevos)
+    return referencias, fotos, errores, conflictos
+
+
+@app.route('/api/sync')
+@proteger_api
+def api_sync():
+    """Cambios de la traba posteriores a ?since= (0 = todo), en páginas de ?n= por orden de versión"""
+    try:
+        desde = max(0, int(request.args.get('since', 0)))
+        n = max(1, min(int(request.args.get('n', SYNC_POR_PAGINA)), SYNC_POR_PAGINA_MAX))
+    except ValueError:
+        raise ValueError("since y n deben ser enteros.")
+    conn = get_db()
+    cursor = conn.cursor()
+    # Una sola instantánea de lectura para los cambios y la versión final
+    cursor.execute('BEGIN')
+    try:
+        cambios, hasta, hay_mas = consultar_cambios(cursor, session['traba'], desde, n)
+        if not hay_mas:
+            hasta = max(hasta, cursor.execute("SELECT valor FROM secuencias WHERE nombre = 'version'").fetchone()[0])
+    finally:
+        conn.commit()
+    return respuesta_api({"desde": desde, "hasta": hasta, "mas": hay_mas, **cambios})
+
+
+@app.route('/api/sync', methods=['POST'])
+@proteger_api
+@csrf.exempt
+def api_sync_subir():
+    """Aplica {"cambios": [...]} del cliente: todo o nada, 409 si hay conflictos"""
+    traba = session['traba']
+    if not request.is_json:
+        raise ValueError("El cuerpo debe ser JSON (Content-Type: application/json).")
+    cambios = (request.get_json(silent=True) or {}).get('cambios')
+    if not isinstance(cambios, list) or not all(isinstance(c, dict) for c in cambios):
+        raise ValueError("Se espera {\"cambios\": [...]}.")
+    if len(cambios) > API_LOTE_MAX:
+        raise ValueError(f"Como mucho {API_LOTE_MAX} cambios por lote.")
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    # IMMEDIATE: las versiones comprobadas no pueden cambiar hasta el commit
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        referencias, fotos, errores, conflictos = aplicar_cambios_sync(cursor, traba, cambios)
+        if conflictos or errores:
+            conn.rollback()
+            return jsonify({"conflictos": conflictos, "errores": errores}), 409 if conflictos else 422
+        version = cursor.execute("SELECT valor FROM secuencias WHERE nombre = 'version'").fetchone()[0]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    for foto in fotos:
+        ruta = os.path.join(app.config['UPLOAD_FOLDER'], foto)
+        if os.path.exists(ruta):
+            os.remove(ruta)
+        eliminar_miniaturas(foto)
+    invalidar_autocompletar(traba)
+    app.logger.info(f"🔄 Sincronización de {traba}: {len(cambios)} cambio(s) aplicados")
+    return jsonify({"aplicados": len(cambios), "referencias": referencias, "version": version})
+
+
+# =============================================================================
+# COMANDOS DE ADMINISTRACIÓN (flask --app app <comando>)
+# =============================================================================
+
+@app.cli.command('respaldar')
+def comando_respaldar():
+    """Toma un snapshot incremental y aplica la retención (para cron)"""
+    snapshot_id = crear_snapshot()
+    snapshots, blobs = aplicar_retencion()
+    print(f"✅ Snapshot {snapshot_id} ({snapshots} snapshots y {blobs} blobs podados)")
+
+
+@app.cli.command('respaldos')
+def comando_respaldos():
+    """Lista los snapshots conservados"""
+    for m in listar_snapshots():
+        print(f"{m['id']}  {m['fecha'][:19]}  {len(m['uploads'])} fotos  db {m['db']['tamaño'] / 1e6:.1f} MB")
+
+
+@app.cli.command('restaurar')
+@click.argument('snapshot_id')
+@click.argument('destino', required=False)
+def comando_restaurar(snapshot_id, destino):
+    """Reconstruye gallos.db y uploads/ de un snapshot en DESTINO"""
+    destino = destino or f'restaurado_{snapshot_id}'
+    manifiesto = restaurar_snapshot(snapshot_id, destino)
+    print(f"✅ Snapshot del {manifiesto['fecha'][:19]} restaurado en {destino}/")
+
+
+@app.cli.command('miniaturas')
+@click.option('--forzar', is_flag=True, help='Regenerar también las que ya existen')
+def comando_miniaturas(forzar):
+    """Genera las miniaturas que faltan y procesa las subidas pendientes que quedaron sin pool"""
+    hechas = errores = 0
+    if os.path.isdir(CARPETA_PENDIENTES):
+        for nombre in sorted(os.listdir(CARPETA_PENDIENTES)):
+            try:
+                procesar_foto(nombre)
+                hechas += 1
+            except Exception as e:
+                errores += 1
+                print(f"⚠️ {nombre}: {e}")
+    for nombre in sorted(os.listdir(UPLOAD_FOLDER)):
+        if not os.path.isfile(os.path.join(UPLOAD_FOLDER, nombre)) or not allowed_file(nombre):
+            continue
+        try:
+            generar_miniaturas(nombre, forzar)
+            hechas += 1
+        except Exception as e:
+            errores += 1
+            print(f"⚠️ {nombre}: {e}")
+    print(f"✅ {hechas} fotos procesadas, {errores} con error")
+
+
 # =============================================================================
 # EJECUCIÓN PRINCIPAL
 # =============================================================================
@@ -0,0 +1,88 @@
+// Registro de cruce: descripción de la estrategia y autocompletado de ejemplares
+document.addEventListener('DOMContentLoaded', function() {
+    const selectTipo = document.getElementById('tipo');
+    const descripcionDiv = document.getElementById('descripcion-cruce');
+    const titulo1 = document.getElementById('titulo1');
+    const titulo2 = document.getElementById('titulo2');
+    
+    const descripciones = {
+        'vertical': {
+            titulo: '1. Inbreeding Vertical',
+            texto: 'Cruzar al mejor gallo con su mejor descendiente (hija, nieta). Fundamental para fijar características del macho fundador. Requiere selección rigurosa.'
+        },
+        'horizontal': {
+            titulo: '2. Inbreeding Horizontal',
+            texto: 'Cruzar hermanos completos entre sí. Método intensivo para rápida concentración de genes deseables. Aumenta riesgo de fijar defectos.'
+        },
+        'line': {
+            titulo: '3. Line Breeding',
+            texto: 'Forma moderada de inbreeding. Cruces entre parientes lejanos (medios hermanos, tíos/sobrinas). Fortalece virtudes con menor riesgo.'
+        }
+    };
+    
+    function actualizarCampos() {
+        const opt = selectTipo.options[selectTipo.selectedIndex];
+        const estrategia = opt.getAttribute('data-estrategia');
+        const ej1 = opt.getAttribute('data-ej1') || 'Ejemplar 1';
+        const ej2 = opt.getAttribute('data-ej2') || 'Ejemplar 2';
+        
+        titulo1.innerHTML = '🐔 Ejemplar 1 (' + ej1 + ')';
+        titulo2.innerHTML = '🐔 Ejemplar 2 (' + ej2 + ')';
+        
+        if (estrategia && descripciones[estrategia]) {
+            const info = descripciones[estrategia];
+            descripcionDiv.innerHTML = '<h3>' + info.titulo + '</h3><p>' + info.texto + '</p>';
+        } else {
+            descripcionDiv.innerHTML = '<p>Selecciona un tipo de cruce para ver la estrategia asociada.</p>';
+        }
+    }
+    
+    selectTipo.addEventListener('change', actualizarCampos);
+    actualizarCampos();
+    
+    // Autocompletado: elegir un ejemplar existente envía solo su id
+    document.querySelectorAll('input[data-ejemplar]').forEach(input => {
+        const k = input.dataset.ejemplar;
+        const lista = document.getElementById('sugerencias' + k);
+        const campoId = document.getElementById('id' + k);
+        const aviso = document.getElementById('existente' + k);
+        const otros = input.closest('.section').querySelectorAll('input:not([data-ejemplar]):not([type="hidden"]), select');
+        let sugerencias = {}, temporizador = null;
+        
+        function elegir() {
+            const s = sugerencias[input.value.trim()];
+            campoId.value = s ? s.id : '';
+            aviso.textContent = s ? '✅ Ejemplar existente' + (s.nombre ? ': ' + s.nombre : '') : '';
+            otros.forEach(el => el.disabled = !!s);
+        }
+        input.addEventListener('input', () => {
+            elegir();
+            clearTimeout(temporizador);
+            const q = input.value.trim();
+            if (q.length < 1) return;
+            temporizador = setTimeout(() => {
+                fetch('/api/autocompletar?q=' + encodeURIComponent(q))
+                    .then(r => r.json())
+                    .then(datos => {
+                        sugerencias = {};
+                        lista.innerHTML = '';
+                        datos.forEach(s => {
+                            sugerencias[s.placa] = s;
+                            const opt = document.createElement('option');
+                            opt.value = s.placa;
+                            opt.label = s.nombre || s.placa;
+                            lista.appendChild(opt);
+                        });
+                        elegir();
+                    })
+                    .catch(() => {});
+            }, 150);
+        });
+    });
+    
+    // Indicador de carga
+    document.querySelector('form').addEventListener('submit', function() {
+        const btn = this.querySelector('.btn-submit');
+        if (btn) { btn.disabled = true; btn.textContent = '⏳ Registrando...'; }
+    });
+});
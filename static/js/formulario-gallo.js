@@ -0,0 +1,5 @@
+// Formulario de registro de gallo
+document.querySelector('form').addEventListener('submit', function() {
+    const btn = this.querySelector('button[type="submit"]');
+    if (btn) { btn.disabled = true; btn.textContent = '⏳ Registrando...'; }
+});
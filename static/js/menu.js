@@ -0,0 +1,36 @@
+// Respaldo en segundo plano: POST /backup y sondeo de /backup/estado/<job>
+function crearBackup(btn) {
+    const mensaje = document.getElementById("mensaje-backup");
+    const terminar = () => { btn.disabled = false; btn.textContent = '💾 Respaldo'; };
+    const error = texto => { mensaje.innerHTML = `<span style="color:#e74c3c;">❌ ${texto}</span>`; terminar(); };
+    const consultar = job => {
+        fetch("/backup/estado/" + job)
+            .then(r => r.json())
+            .then(d => {
+                if (d.estado === "completado") {
+                    mensaje.innerHTML = `<span style="color:#27ae60;">✅ Copia de seguridad creada.</span>`;
+                    terminar();
+                    window.location.href = "/download/" + d.archivo;
+                } else if (d.estado === "en_curso") {
+                    btn.textContent = `⏳ ${d.porcentaje}%`;
+                    setTimeout(() => consultar(job), 1000);
+                } else {
+                    error(d.error || "Error creando el respaldo");
+                }
+            })
+            .catch(() => error("Error de red"));
+    };
+    btn.disabled = true; btn.textContent = '⏳ Creando...';
+    fetch("/backup", {method: "POST"})
+        .then(r => r.json())
+        .then(d => {
+            // 409: ya hay uno en curso para la traba, se sigue ese mismo
+            if (d.job) {
+                mensaje.innerHTML = `<span style="color:#27ae60;">${d.mensaje || d.error}</span>`;
+                consultar(d.job);
+            } else {
+                error(d.error);
+            }
+        })
+        .catch(() => error("Error de red"));
+}